@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Factornado benchmarks
+---------------------
+
+Each module can be run as a script, against a local mongod:
+
+>>> python -m benchmarks.assign_one --mongo mongodb://127.0.0.1:27017
+
+or against an in-memory mongomock stand-in:
+
+>>> python -m benchmarks.assign_one --mongomock
+"""
+
+import argparse
+import threading
+import time
+
+
+def get_parser(description):
+    """Create an argument parser with the options shared by all benchmarks."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--mongo', default='mongodb://127.0.0.1:27017',
+                        help='The address of the mongod to run against.')
+    parser.add_argument('--mongomock', action='store_true',
+                        help='Run against an in-memory mongomock collection.')
+    return parser
+
+
+def get_collection(args, name='bench_factornado_tasks'):
+    """Get an empty collection, based on parsed arguments."""
+    if args.mongomock:
+        import mongomock
+        collection = LockedCollection(mongomock.MongoClient()['test'][name])
+    else:
+        import pymongo
+        collection = pymongo.MongoClient(args.mongo)['test'][name]
+    collection.drop()
+    return collection
+
+
+class LockedCollection(object):
+    """Wraps a mongomock collection so that each operation is atomic, as on a real server."""
+    _lock = threading.Lock()
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, attr):
+        method = getattr(self.collection, attr)
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                out = method(*args, **kwargs)
+                # Cursors are lazy: we consume them while holding the lock.
+                return list(out) if attr in ('find', 'aggregate') else out
+        return locked
+
+
+class Timer(object):
+    """A context manager measuring wall time."""
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.duration = time.perf_counter() - self.start
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Action contention benchmark
+---------------------------
+
+Lets concurrent workers stack, assign and complete the same few "hot" keys, and compares
+the throughput of `factornado.tasks.perform_action` (read, then conditional write, retried on
+conflicts) with `factornado.tasks.perform_action_atomic` (one update pipeline).
+"""
+
+import random
+import threading
+
+import yaml
+from tornado import web
+
+from factornado.tasks import perform_action, perform_action_atomic
+from benchmarks import get_parser, get_collection, Timer
+
+ACTIONS = yaml.safe_load("""
+    stack: {none: todo, todo: todo, doing: toredo, toredo: toredo, done: todo, fail: todo}
+    assign: {todo: doing}
+    success: {doing: done, toredo: todo}
+    """)
+
+
+def run(collection, function, nb_workers, nb_keys, nb_actions, task='bench'):
+    """Let `nb_workers` threads perform `nb_actions` random actions each on `nb_keys` keys."""
+    counts = {'ok': 0, 'refused': 0}
+
+    def worker():
+        for i in range(nb_actions):
+            key = str(random.randrange(nb_keys))
+            action = random.choice(list(ACTIONS))
+            try:
+                out = function(collection, ACTIONS, task, key, action, data={'i': i})
+            except web.HTTPError:
+                # The action does not apply to the task's status.
+                out = None
+            counts['ok' if out is not None else 'refused'] += 1
+
+    threads = [threading.Thread(target=worker) for i in range(nb_workers)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return counts['ok'], timer.duration
+
+
+if __name__ == '__main__':
+    parser = get_parser(__doc__)
+    parser.add_argument('--keys', type=int, default=1, help='The number of hot keys.')
+    parser.add_argument('--actions', type=int, default=500,
+                        help='The number of actions per worker.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 5, 10, 20],
+                        help='The numbers of concurrent workers to try.')
+    args = parser.parse_args()
+    collection = get_collection(args)
+
+    print('{:>10} {:>10} {:>15} {:>15}'.format('engine', 'workers', 'actions/sec', 'applied/sec'))
+    for nb_workers in args.workers:
+        for name, function in [('legacy', perform_action), ('atomic', perform_action_atomic)]:
+            collection.delete_many({})
+            nb, duration = run(collection, function, nb_workers, args.keys, args.actions)
+            print('{:>10} {:>10} {:>15.1f} {:>15.1f}'.format(
+                name, nb_workers, nb_workers * args.actions / duration, nb / duration))
+    collection.drop()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+AssignOne benchmark
+-------------------
+
+Measures the claim throughput of `factornado.tasks.assign_one` vs. the number of concurrent
+claimers, and compares it with the former scan-and-retry implementation.
+"""
+
+import threading
+
+import bson
+import pandas as pd
+
+from factornado.tasks import assign_one
+from benchmarks import get_parser, get_collection, Timer
+
+
+def legacy_assign_one(collection, task):
+    """The former AssignOne implementation: scan the `todo` tasks and retry on conflicts."""
+    while True:
+        nb = 0
+        for todo in collection.find({'status': 'todo', 'task': task},
+                                    sort=[('priority', -1), ('ldt', 1)]):
+            nb += 1
+            r = collection.update_one(
+                {'_id': todo['_id'], 'id': todo['id']},
+                {'$set': {
+                    'status': 'doing',
+                    'statusSince': pd.Timestamp.utcnow().value,
+                    'id': bson.ObjectId(),
+                    }})
+            if r.modified_count == 1:
+                return todo
+        if nb == 0:
+            return None
+
+
+def fill(collection, nb_tasks, task='bench'):
+    collection.delete_many({})
+    collection.insert_many([{
+        '_id': '{}/{}'.format(task, i),
+        'id': bson.ObjectId(),
+        'task': task,
+        'key': str(i),
+        'status': 'todo',
+        'data': {},
+        'statusSince': None,
+        'try': 0,
+        'priority': i % 3,
+        } for i in range(nb_tasks)])
+
+
+def run(collection, function, nb_claimers, task='bench'):
+    """Let `nb_claimers` threads claim tasks till there is none left."""
+    claimed = []
+
+    def claimer():
+        while True:
+            todo = function(collection, task)
+            if todo is None:
+                break
+            claimed.append(todo['_id'])
+
+    threads = [threading.Thread(target=claimer) for i in range(nb_claimers)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert len(claimed) == len(set(claimed)), 'A task has been claimed twice.'
+    return len(claimed), timer.duration
+
+
+if __name__ == '__main__':
+    parser = get_parser(__doc__)
+    parser.add_argument('--tasks', type=int, default=2000, help='The number of tasks to claim.')
+    parser.add_argument('--claimers', type=int, nargs='+', default=[1, 2, 5, 10, 20],
+                        help='The numbers of concurrent claimers to try.')
+    args = parser.parse_args()
+    collection = get_collection(args)
+
+    print('{:>10} {:>10} {:>15}'.format('engine', 'claimers', 'claims/sec'))
+    for nb_claimers in args.claimers:
+        for name, function in [('legacy', legacy_assign_one), ('atomic', assign_one)]:
+            fill(collection, args.tasks)
+            nb, duration = run(collection, function, nb_claimers)
+            print('{:>10} {:>10} {:>15.1f}'.format(name, nb_claimers, nb / duration))
+    collection.drop()
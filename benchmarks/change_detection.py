@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Change detection benchmark
+--------------------------
+
+Compares the CPU time of `factornado.utils.has_changed` with the comparison of the
+JSON serializations of a task document, for data of growing sizes ; and measures the
+CPU time of a whole `factornado.tasks.perform_action` (what `Action.put` runs) that
+stacks the same data again.
+"""
+
+import json
+import time
+
+from factornado.tasks import next_task, perform_action
+from factornado.utils import has_changed, tansform_bson_id
+from benchmarks import get_parser, get_collection
+
+ACTIONS = {'stack': {'none': 'todo', 'todo': 'todo'}}
+
+
+def run(collection, size, nb):
+    """Time `nb` change detections, and `nb` actions, on a task whose data weighs about
+    `size` bytes."""
+    data = {'field{}'.format(i): 'x' * 90 for i in range(size // 100)}
+    perform_action(collection, ACTIONS, 'bench', 'key', 'stack', data=data)
+    before = collection.find_one({'_id': 'bench/key'})
+    after = next_task(before, ACTIONS, 'stack', data=data)
+
+    start = time.process_time()
+    for i in range(nb):
+        has_changed(before, after)
+    structural_time = (time.process_time() - start) / nb
+    start = time.process_time()
+    for i in range(nb):
+        (json.dumps(tansform_bson_id(before), sort_keys=True, default=str) ==
+         json.dumps(tansform_bson_id(after), sort_keys=True, default=str))
+    serialized_time = (time.process_time() - start) / nb
+    start = time.process_time()
+    for i in range(nb):
+        perform_action(collection, ACTIONS, 'bench', 'key', 'stack', data=data)
+    action_time = (time.process_time() - start) / nb
+    return structural_time, serialized_time, action_time
+
+
+if __name__ == '__main__':
+    parser = get_parser(__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='The sizes of the task data to try, in bytes.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='The number of comparisons and actions per size.')
+    args = parser.parse_args()
+    collection = get_collection(args)
+
+    print('{:>10} {:>15} {:>15} {:>15}'.format(
+        'bytes', 'structural ms', 'serialized ms', 'action ms'))
+    for size in args.sizes:
+        collection.delete_many({})
+        structural_time, serialized_time, action_time = run(collection, size, args.repeat)
+        print('{:>10} {:>15.3f} {:>15.3f} {:>15.3f}'.format(
+            size, 1000 * structural_time, 1000 * serialized_time, 1000 * action_time))
+    collection.drop()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Indexes benchmark
+-----------------
+
+Measures the latency of `factornado.tasks.assign_one` on tasks collections of growing
+sizes, with and without the indexes declared in `factornado.tasks.INDEXES`.
+"""
+
+import bson
+
+from factornado.mongo import ensure_indexes
+from factornado.tasks import assign_one, INDEXES
+from benchmarks import get_parser, get_collection, Timer
+
+
+def fill(collection, nb_tasks, nb_categories=10, todo_ratio=0.1, batch_size=10000):
+    """Fill the collection with `nb_tasks` tasks, a fraction `todo_ratio` of which are `todo`."""
+    collection.delete_many({})
+    for begin in range(0, nb_tasks, batch_size):
+        collection.insert_many([{
+            '_id': 'task{}/{}'.format(i % nb_categories, i),
+            'id': bson.ObjectId(),
+            'task': 'task{}'.format(i % nb_categories),
+            'key': str(i),
+            'status': 'todo' if (i // nb_categories) % int(1 / todo_ratio) == 0 else 'done',
+            'data': {},
+            'statusSince': None,
+            'try': 0,
+            'priority': 0,
+            } for i in range(begin, min(begin + batch_size, nb_tasks))])
+
+
+def run(collection, nb_claims, task='task0'):
+    """Return the mean latency (in ms) of `nb_claims` claims."""
+    with Timer() as timer:
+        for i in range(nb_claims):
+            assert assign_one(collection, task) is not None
+    return 1000. * timer.duration / nb_claims
+
+
+if __name__ == '__main__':
+    parser = get_parser(__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='The numbers of tasks in the collection.')
+    parser.add_argument('--claims', type=int, default=100,
+                        help='The number of claims to measure.')
+    args = parser.parse_args()
+    collection = get_collection(args)
+
+    print('{:>10} {:>10} {:>15}'.format('tasks', 'indexes', 'latency (ms)'))
+    for size in args.sizes:
+        fill(collection, size)
+        for indexed in [False, True]:
+            collection.drop_indexes()
+            if indexed:
+                ensure_indexes(collection, INDEXES)
+            collection.update_many({'status': 'doing'}, {'$set': {'status': 'todo'}})
+            latency = run(collection, args.claims)
+            print('{:>10} {:>10} {:>15.3f}'.format(size, str(indexed), latency))
+    collection.drop()
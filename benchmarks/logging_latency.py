@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Logging latency benchmark
+-------------------------
+
+Measures the latency of requests that log several DEBUG records (as `Todo` and `Do` do
+for each task), with synchronous handlers and with `queue: true` (see
+`factornado.get_logger`).
+
+>>> python -m benchmarks.logging_latency --slow-ms 1
+
+`--slow-ms` simulates a slow log destination (a busy disk, a network file system...).
+"""
+
+import os
+import time
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+
+import factornado
+from factornado.logger import BoundedQueueHandler
+
+logger = logging.getLogger('factornado.benchmark')
+
+
+class Handler(factornado.RequestHandler):
+    nb_lines = 10
+
+    def get(self):
+        for i in range(self.nb_lines):
+            logger.debug('Processing item %s of %s', i, self.request.uri)
+        self.write('ok')
+
+
+class SlowFileHandler(logging.FileHandler):
+    """A FileHandler that takes `slow` seconds more to write each record."""
+    slow = 0
+
+    def emit(self, record):
+        time.sleep(self.slow)
+        super(SlowFileHandler, self).emit(record)
+
+
+def run(app, nb_requests):
+    """Send `nb_requests` requests to `app` ; return their latencies in milliseconds."""
+    latencies = []
+    for i in range(nb_requests):
+        start = time.perf_counter()
+        app.get('/')
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=1000, help='The number of requests.')
+    parser.add_argument('--lines', type=int, default=10,
+                        help='The number of DEBUG records logged per request.')
+    parser.add_argument('--slow-ms', type=float, default=0,
+                        help='The extra time to write each record, in milliseconds.')
+    args = parser.parse_args()
+    Handler.nb_lines = args.lines
+    SlowFileHandler.slow = args.slow_ms / 1000
+
+    print('{:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'logging', 'p50 (ms)', 'p99 (ms)', 'max (ms)', 'dropped'))
+    for queue in [False, True]:
+        filename = os.path.join(tempfile.mkdtemp(), 'benchmark.log')
+        # `get_logger` creates a FileHandler: we replace it with a slow one.
+        logging.FileHandler, FileHandler = SlowFileHandler, logging.FileHandler
+        root = factornado.get_logger(
+            'factornado.benchmark', stdout=False, file=filename, level=10, queue=queue,
+            queue_size=100000)
+        logging.FileHandler = FileHandler
+        app = factornado.Application({'log': {'stdout': False}}, [('/', Handler)],
+                                     logger=root)
+        latencies = run(app, args.requests)
+        handler = root.handlers[0]
+        if isinstance(handler, BoundedQueueHandler):
+            handler.stop()
+        print('{:>10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10}'.format(
+            'queue' if queue else 'sync',
+            np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max(),
+            getattr(handler, 'dropped', 0)))
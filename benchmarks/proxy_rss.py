@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Proxy RSS benchmark
+-------------------
+
+Downloads and uploads large bodies through `factornado.registry.Proxy` and
+`factornado.registry.StreamingProxy`, and measures the peak RSS of the proxy process.
+
+>>> python -m benchmarks.proxy_rss --sizes 64 1024
+
+Each transfer runs against a fresh proxy process, so that peaks do not add up.
+No mongo is needed: the proxy's service table is filled in memory.
+"""
+
+import time
+import socket
+import argparse
+import resource
+import multiprocessing
+
+import requests
+import pandas as pd
+from tornado import web, ioloop
+
+import factornado
+from factornado.registry import ServiceTable, Proxy, StreamingProxy
+from benchmarks import Timer
+
+CHUNK_SIZE = 2 ** 20
+
+
+class Data(web.RequestHandler):
+    """Serves `size` bytes."""
+    async def get(self):
+        size = int(self.get_argument('size'))
+        for i in range(0, size, CHUNK_SIZE):
+            self.write(b'x' * min(CHUNK_SIZE, size - i))
+            await self.flush()
+
+
+@web.stream_request_body
+class Upload(web.RequestHandler):
+    """Counts the bytes posted."""
+    def prepare(self):
+        self.request.connection.set_max_body_size(2 ** 40)
+        self.size = 0
+
+    def data_received(self, chunk):
+        self.size += len(chunk)
+
+    def post(self):
+        self.write({'size': self.size})
+
+
+class RSS(web.RequestHandler):
+    """Returns the peak RSS of the process, in MB."""
+    def get(self):
+        self.write({'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+
+def get_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def serve(app, port):
+    app.listen(port, address='127.0.0.1')
+    ioloop.IOLoop.current().start()
+
+
+def start(app):
+    """Run an application in a forked process ; return the process and its url."""
+    port = get_port()
+    process = multiprocessing.get_context('fork').Process(target=serve, args=(app, port))
+    process.start()
+    url = 'http://127.0.0.1:{}'.format(port)
+    for i in range(100):
+        try:
+            requests.get(url + '/rss')
+            break
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    return process, url
+
+
+def proxy_app(handler, upstream_url):
+    app = factornado.Application(
+        {'log': {'stdout': False}},
+        [('/rss', RSS), ('/([^/]*?)/(.*)', handler)])
+    app.service_table = ServiceTable(None, ttl=float('inf'))
+    app.service_table.instances = {'up': [
+        {'_id': upstream_url, 'name': 'up', 'id': pd.Timestamp.utcnow().value, 'info': {}}]}
+    app.service_table.fetched = time.time()
+    return app
+
+
+def transfer(url, direction, size):
+    """Download or upload `size` bytes through the proxy ; return the number transferred."""
+    if direction == 'download':
+        r = requests.get(url + '/up/data', params={'size': size}, stream=True)
+        r.raise_for_status()
+        return sum(len(chunk) for chunk in r.iter_content(CHUNK_SIZE))
+    else:
+        r = requests.post(url + '/up/upload', data=(
+            b'y' * min(CHUNK_SIZE, size - i) for i in range(0, size, CHUNK_SIZE)))
+        r.raise_for_status()
+        return r.json()['size']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 1024],
+                        help='The body sizes to transfer, in MB.')
+    args = parser.parse_args()
+
+    upstream, upstream_url = start(factornado.Application(
+        {'log': {'stdout': False}}, [('/rss', RSS), ('/data', Data), ('/upload', Upload)]))
+
+    print('{:>10} {:>10} {:>10} {:>15} {:>10}'.format(
+        'engine', 'direction', 'size (MB)', 'peak RSS (MB)', 'MB/sec'))
+    for size in args.sizes:
+        for direction in ['download', 'upload']:
+            for name, handler in [('buffered', Proxy), ('streaming', StreamingProxy)]:
+                proxy, url = start(proxy_app(handler, upstream_url))
+                try:
+                    with Timer() as timer:
+                        nb = transfer(url, direction, size * 2 ** 20)
+                    assert nb == size * 2 ** 20, 'Transferred {} bytes.'.format(nb)
+                    speed = '{:.1f}'.format(size / timer.duration)
+                except Exception as e:
+                    speed = 'failed ({})'.format(type(e).__name__)
+                maxrss = requests.get(url + '/rss').json()['maxrss']
+                proxy.terminate()
+                print('{:>10} {:>10} {:>10} {:>15.1f} {:>10}'.format(
+                    name, direction, size, maxrss, speed))
+    upstream.terminate()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Proxy throughput benchmark
+--------------------------
+
+Sends small requests through `factornado.registry.Proxy` from concurrent clients, and
+measures the throughput for several configurations of the proxy's upstream client
+(the `proxy` section of the registry's config, see `factornado.registry.UpstreamClient`).
+
+>>> python -m benchmarks.proxy_throughput --clients 10 50
+
+No mongo is needed: the proxy's service table is filled in memory.
+"""
+
+import argparse
+import threading
+
+import requests
+from tornado import web
+
+import factornado
+from factornado.registry import Proxy, UpstreamClient
+from benchmarks import Timer
+from benchmarks.proxy_rss import RSS, start, proxy_app
+
+CONFIGS = {
+    'default': {'max_clients': 10},
+    'max_clients=100': {'max_clients': 100},
+    'per_host=20': {'max_clients': 100, 'max_connections_per_host': 20},
+    'curl': {'max_clients': 100, 'curl': True},
+    }
+
+
+class Hello(web.RequestHandler):
+    def get(self):
+        self.write('Hello')
+
+
+def run(url, nb_clients, nb_requests):
+    """Let `nb_clients` threads send `nb_requests` requests each ; return requests/sec."""
+    errors = []
+
+    def client():
+        session = requests.Session()
+        for i in range(nb_requests):
+            r = session.get(url + '/up/hello')
+            if r.status_code != 200:
+                errors.append(r.status_code)
+
+    threads = [threading.Thread(target=client) for i in range(nb_clients)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return (nb_clients * nb_requests - len(errors)) / timer.duration, len(errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50],
+                        help='The numbers of concurrent clients to try.')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='The number of requests per client.')
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS),
+                        help='The upstream client configurations to try.')
+    args = parser.parse_args()
+
+    upstream, upstream_url = start(factornado.Application(
+        {'log': {'stdout': False}}, [('/rss', RSS), ('/hello', Hello)]))
+
+    print('{:>20} {:>10} {:>15} {:>10}'.format('config', 'clients', 'requests/sec', 'errors'))
+    for name in args.configs:
+        app = proxy_app(Proxy, upstream_url)
+        app.config['proxy'] = CONFIGS[name]
+        proxy, url = start(app)
+        if CONFIGS[name].get('curl') and not UpstreamClient(curl=True).curl:
+            name += ' (no pycurl)'
+        for nb_clients in args.clients:
+            throughput, nb_errors = run(url, nb_clients, args.requests)
+            print('{:>20} {:>10} {:>15.1f} {:>10}'.format(
+                name, nb_clients, throughput, nb_errors))
+        proxy.terminate()
+    upstream.terminate()
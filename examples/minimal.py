@@ -23,7 +23,7 @@ To end up the process, you can use:
 import factornado
 import os
 
-from factornado.handlers import Swagger, Log, Heartbeat
+from factornado.handlers import Swagger, Log, Heartbeat, Metrics
 from tornado import web
 
 
@@ -56,7 +56,8 @@ app = factornado.Application(config, [
     ("/swagger.json", Swagger),
     ("/swagger", web.RedirectHandler, {'url': '/swagger.json'}),
     ("/heartbeat", Heartbeat),
-    ("/log", Log)
+    ("/log", Log),
+    ("/metrics", Metrics),
 ])
 
 if __name__ == "__main__":
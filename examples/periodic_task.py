@@ -4,7 +4,7 @@ import factornado
 
 import bson
 
-from factornado.handlers import Swagger, Log, Heartbeat
+from factornado.handlers import Swagger, Log, Heartbeat, Metrics
 from tornado import web
 
 
@@ -83,6 +83,7 @@ app = factornado.Application(
         ("/swagger", web.RedirectHandler, {'url': '/swagger.json'}),
         ("/heartbeat", Heartbeat),
         ("/log", Log),
+        ("/metrics", Metrics),
         ("/todo", Todo),
         ("/do", Do),
         ("/latest", LatestDoc),
@@ -2,7 +2,7 @@ import os
 import factornado
 import factornado.tasks
 
-from factornado.handlers import Swagger, Log, Heartbeat
+from factornado.handlers import Swagger, Log, Heartbeat, Metrics
 from tornado import web
 
 
@@ -38,11 +38,16 @@ app = factornado.Application(
         ("/swagger", web.RedirectHandler, {'url': '/swagger.json'}),
         ("/heartbeat", Heartbeat),
         ("/log", Log),
+        ("/metrics", Metrics),
         ("/action/([^/]*?)/([^/]*?)/([^/]*?)", factornado.tasks.Action),
+        ("/actions", factornado.tasks.Actions),
         ("/force/([^/]*?)/([^/]*?)/([^/]*?)", factornado.tasks.Force),
         ("/assignOne/([^/]*?)", factornado.tasks.AssignOne),
+        ("/assignMany/([^/]*?)", factornado.tasks.AssignMany),
         ("/getByKey/([^/]*?)/([^/]*?)", factornado.tasks.GetByKey),
         ("/getByStatus/([^/]*?)/([^/]*?)", factornado.tasks.GetByStatus),
+        ("/stats", factornado.tasks.Stats, {'ttl': 1}),
+        ("/stats/([^/]*?)", factornado.tasks.Stats, {'ttl': 1}),
     ])
 
 
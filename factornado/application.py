@@ -7,7 +7,11 @@ import socket
 import yaml
 import re
 import signal
+import shutil
+import atexit
 import asyncio
+import tempfile
+import functools
 
 import pymongo
 import requests
@@ -15,6 +19,12 @@ import pandas as pd
 from tornado import ioloop, web, httpserver, iostream, http1connection, concurrent
 
 from factornado.logger import get_logger
+from factornado.authentication import TokenManager
+from factornado.handlers import build_swagger
+from factornado.metrics import registry as metrics_registry
+from factornado.mongo import ensure_indexes, MongoExecutor
+from factornado.timing import span, current_spans, ServerTiming
+from factornado.utils import Executor
 
 factornado_logger = logging.getLogger('factornado')
 
@@ -53,17 +63,53 @@ async def _execute(self):
     return b''.join(self.handler._write_buffer)
 
 
+def _remove_directory(directory, pid):
+    """Remove `directory`, if called in process `pid`: forked processes run exit hooks too."""
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
 class Kwargs(object):
     def __init__(self, **kwargs):
         for key, val in kwargs.items():
             self.__setattr__(key, val)
 
 
+class HTTPSession(object):
+    """A pool of keep-alive connections, to be shared by `WebMethod` instances.
+
+    Each process gets its own `requests.Session`, so that no connection is shared
+    by forked processes.
+
+    Parameters
+    ----------
+    max_connections: int, default 10
+        The maximum number of connections kept to each host.
+        When they are all busy, further requests wait for one of them to be released.
+    """
+    def __init__(self, max_connections=10):
+        self.max_connections = max_connections
+        self._session = None
+        self._pid = None
+
+    def get(self):
+        if self._session is None or self._pid != os.getpid():
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_connections,
+                                                    pool_block=True)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._pid = os.getpid()
+        return self._session
+
+
 class WebMethod(object):
-    def __init__(self, method, url, logger=None):
+    def __init__(self, method, url, logger=None, session=None, timeout=None):
         self.logger = logger if logger is not None else logging.root
         self.method = method
         self.url = url
+        self.session = session
+        self.timeout = timeout
         self.params = re.findall("{(.*?)}", self.url)
         self.__doc__ = (
             '\nParameters\n----------\n' +
@@ -71,12 +117,15 @@ class WebMethod(object):
 
     def __call__(self, data='', headers=None, **kwargs):
         url = self.url.format(**kwargs)
-        response = requests.request(
-            method=self.method,
-            url=url,
-            data=data if isinstance(data, (str, bytes, type(None))) else pd.io.json.dumps(data),
-            headers=headers if headers is not None else {},
-            )
+        with span('http'):
+            response = (self.session.get() if self.session is not None else requests).request(
+                method=self.method,
+                url=url,
+                data=(data if isinstance(data, (str, bytes, type(None)))
+                      else pd.io.json.dumps(data)),
+                headers=headers if headers is not None else {},
+                timeout=self.timeout,
+                )
         try:
             response.raise_for_status()
         except Exception:
@@ -85,6 +134,23 @@ class WebMethod(object):
         return response
 
 
+class AsyncWebMethod(WebMethod):
+    """A `WebMethod` that does not block the IOLoop: calling it returns an awaitable.
+
+    Example:
+        response = await self.application.services.tasks.action.put(
+            task='someTask', key='someKey', action='stack')
+    """
+    def __init__(self, method, url, logger=None, session=None, timeout=None, executor=None):
+        super(AsyncWebMethod, self).__init__(method, url, logger=logger, session=session,
+                                             timeout=timeout)
+        self.executor = executor if executor is not None else Executor(name='factornado-http')
+
+    def __call__(self, data='', headers=None, **kwargs):
+        return self.executor.run(super(AsyncWebMethod, self).__call__,
+                                 data=data, headers=headers, **kwargs)
+
+
 class Callback(object):
     def __init__(self, application, uri, sleep_duration=0, method='post'):
         self.application = application
@@ -93,7 +159,7 @@ class Callback(object):
         self.method = method
 
     def __call__(self):
-        factornado_logger.debug('{} callback started'.format(self.uri))
+        factornado_logger.debug('%s callback started', self.uri)
         url = 'http://localhost:{}/{}'.format(self.application.get_port(), self.uri.lstrip('/'))
         response = requests.request(self.method, url)
         try:
@@ -103,11 +169,10 @@ class Callback(object):
                 self.method, url, response.reason)
             raise web.HTTPError(response.status_code, reason, reason=reason)
         if response.status_code != 200:
-            factornado_logger.debug('{} callback returned {}. Sleep for a while.'.format(
-                self.uri, response.status_code))
+            factornado_logger.debug('%s callback returned %s. Sleep for a while.',
+                                    self.uri, response.status_code)
             time.sleep(self.sleep_duration)
-        factornado_logger.debug('{} callback finished : {}'.format(self.uri,
-                                                                   response.text))
+        factornado_logger.debug('%s callback finished : %s', self.uri, response.text)
 
 
 class Application(web.Application):
@@ -135,23 +200,74 @@ class Application(web.Application):
             for dbname, db in _mongo.get('database', {}).items() if db['host'] == hostname
             for collname, coll in _mongo.get('collection', {}).items() if coll['database'] == dbname
             })
+        # Blocking mongo calls can be run in a pool of threads through `self.mongo_executor`.
+        self.mongo_executor = MongoExecutor(max_workers=_mongo.get('max_workers', 10))
 
         # Create service attribute
+        _client = self.config.get('services_client', {})
+        self.services_session = HTTPSession(max_connections=_client.get('max_connections', 10))
+        if _client.get('async', False):
+            self.services_executor = Executor(
+                max_workers=_client.get('max_workers', _client.get('max_connections', 10)),
+                name='factornado-http')
+            web_method = functools.partial(AsyncWebMethod, executor=self.services_executor)
+        else:
+            web_method = WebMethod
         self.services = Kwargs(**{
             key: Kwargs(**{
                 subkey: Kwargs(**{
-                    subsubkey: WebMethod(
+                    subsubkey: web_method(
                         subsubkey,
                         (self.config.get('services_prefix', '').rstrip('/') + subsubval
                          if subsubval.lower().startswith('/')
                          else subsubval),
                         logger=self.logger,
+                        session=self.services_session,
+                        timeout=(_client.get('connect_timeout'), _client.get('request_timeout')),
                         )
                     for subsubkey, subsubval in subval.items()})
                 for subkey, subval in val.items()
                 })
             for key, val in self.config.get('services', {}).items()})
 
+        # The service token is created before forking, so that processes share it.
+        _sso = self.config.get('sso')
+        self.token_manager = (TokenManager(self, skew=_sso.get('token_skew', 60))
+                              if _sso else None)
+
+        # The `task` label of the metrics may come from requests: only the tasks listed in
+        # `metrics.tasks` (by default, those of the `tasks` section) are kept.
+        _metrics = self.config.get('metrics', {})
+        metrics_registry.limit_label(
+            'task', _metrics.get('tasks', list(self.config.get('tasks', {}).values())))
+
+        # The swagger documentation is built once for all.
+        self.swagger_document = build_swagger(self)
+
+        # Eventually record where time goes in each request.
+        self.timing = self.config.get('timing')
+        if self.timing is not None:
+            self.transforms.append(ServerTiming)
+
+    def log_request(self, handler):
+        """Log the request, and count it in the metrics (see `handlers.Metrics`)."""
+        super(Application, self).log_request(handler)
+        handler_name = type(handler).__name__
+        metrics_registry.inc('http_requests_total', method=handler.request.method,
+                             handler=handler_name, status=handler.get_status())
+        metrics_registry.observe('http_request_duration_seconds',
+                                 handler.request.request_time(),
+                                 method=handler.request.method, handler=handler_name)
+
+        spans = current_spans.get()
+        slow_request = (self.timing or {}).get('slow_request')
+        if (spans is not None and slow_request is not None and
+                handler.request.request_time() > slow_request):
+            factornado_logger.warning(
+                'Slow request: %s %s %.1fms %s', handler.request.method, handler.request.uri,
+                handler.request.request_time() * 1000, spans.server_timing(),
+                extra={'spans': spans.to_dict()})
+
     def request(self, **kwargs):
         """Performs a request in the application without going through the network.
 
@@ -208,6 +324,36 @@ class Application(web.Application):
         """
         return self.request(method='PUT', uri=uri, **kwargs)
 
+    def get_indexes(self):
+        """Gather the index specs of each mongo collection.
+
+        They are declared in the config (`db.mongo.collection.{name}.indexes`)
+        and in the handlers' `mongo_indexes` attribute ({collection_name: [specs]}).
+        """
+        _collections = self.config.get('db', {}).get('mongo', {}).get('collection', {})
+        indexes = {collname: list(coll.get('indexes', []))
+                   for collname, coll in _collections.items()}
+        for h in self.handler_list:
+            handler = h[1]
+            for collname, specs in getattr(handler, 'mongo_indexes', {}).items():
+                for spec in specs:
+                    if spec not in indexes.setdefault(collname, []):
+                        indexes[collname].append(spec)
+        return indexes
+
+    def ensure_indexes(self):
+        """Create the indexes required on mongo collections, if they do not exist yet."""
+        for collname, specs in self.get_indexes().items():
+            collection = getattr(self.mongo, collname, None)
+            if collection is None:
+                factornado_logger.warning(
+                    'Indexes are declared on collection %s, that is not configured.', collname)
+                continue
+            try:
+                ensure_indexes(collection, specs)
+            except pymongo.errors.PyMongoError:
+                factornado_logger.exception('Failed to ensure indexes on %s.', collname)
+
     def get_port(self):
         if 'port' not in self.config:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -222,7 +368,7 @@ class Application(web.Application):
         return self.config['host']
 
     def run_callback(self, name, uri, period, sleep=0, method='post'):
-        self.logger.debug('Callback {}, pid: {}'.format(name, os.getpid()))
+        self.logger.debug('Callback %s, pid: %s', name, os.getpid())
         self.process_nb += 1
         time.sleep(2)  # We sleep for a few seconds to let the registry start.
         ioloop.PeriodicCallback(
@@ -242,14 +388,31 @@ class Application(web.Application):
         factornado_logger.info('='*80)
 
         port = self.get_port()  # We need to have a fixed port in both forks.
-        factornado_logger.info('Listening on port {}'.format(port))
+        factornado_logger.info('Listening on port %s', port)
         self.process_nb = 0
 
+        if self.config.get('db', {}).get('mongo', {}).get('ensure_indexes', True):
+            self.ensure_indexes()
+
+        _log = self.config.get('log', {})
+        if (_log.get('file') and not _log.get('per_process') and
+                (_log.get('max_bytes') is not None or _log.get('when') is not None)):
+            factornado_logger.warning(
+                'Log file %s is shared and rotated by all processes: set log.per_process',
+                _log['file'])
+
+        # The processes share their metrics through files.
+        metrics_directory = self.config.get('metrics', {}).get('directory')
+        if metrics_directory is None:
+            metrics_directory = tempfile.mkdtemp(prefix='factornado-metrics-')
+            atexit.register(_remove_directory, metrics_directory, os.getpid())
+        metrics_registry.set_directory(metrics_directory)
+
         child_process = os.fork()
         if child_process:
             self.child_processes.append(child_process)
         else:
-            self.logger.debug('First heartbeat, pid: {}'.format(os.getpid()))
+            self.logger.debug('First heartbeat, pid: %s', os.getpid())
             self.process_nb += 1
             time.sleep(2)  # We sleep for a few seconds to let the registry start.
             # Send a heartbeat callback
@@ -276,8 +439,8 @@ class Application(web.Application):
 
         self.server = httpserver.HTTPServer(self)
         self.server.bind(self.get_port(), address=self.config.get('ip', '0.0.0.0'))
-        self.logger.debug('Server, pid: {}'.format(os.getpid()))
-        self.logger.debug('Child processes: {}'.format(self.child_processes))
+        self.logger.debug('Server, pid: %s', os.getpid())
+        self.logger.debug('Child processes: %s', self.child_processes)
         self.server.start(self.config['threads_nb'])
         signal.signal(signal.SIGINT, self.stop_server)
         signal.signal(signal.SIGTERM, self.stop_server)
@@ -290,11 +453,11 @@ class Application(web.Application):
 
     def stop_instance(self, sig, frame):
         self.logger.info(
-            'stopping instance {} due to signal {} ({})'.format(self.process_nb, sig, os.getpid()))
+            'stopping instance %s due to signal %s (%s)', self.process_nb, sig, os.getpid())
         ioloop.IOLoop.instance().stop()
 
     def stop_server(self, sig, frame):
-        self.logger.info('STOPPING SERVER {} DUE TO SIGNAL {}'.format(self.config['name'], sig))
+        self.logger.info('STOPPING SERVER %s DUE TO SIGNAL %s', self.config['name'], sig)
         for child_process in self.child_processes:
             try:
                 os.kill(child_process, sig)
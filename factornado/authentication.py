@@ -1,15 +1,164 @@
 import jwt
 import json
-import datetime
-
-from tornado import httpclient
+import time
+import logging
+import hashlib
+import threading
+import collections
+import multiprocessing
+
+from tornado import httpclient, ioloop
 from jwt.algorithms import RSAAlgorithm
 from urllib.parse import urlencode
 
+from factornado.utils import SingleFlight
+from factornado.timing import span
+
 # Authentication data key
 AUTH_DATA = 'auth_data'
 
 
+class JWKSCache(object):
+    """An in-process cache of the JSON Web Key Sets of the SSO realms, keyed by `certs` url.
+
+    Parameters
+    ----------
+    ttl: float, default 300
+        The number of seconds after which a key set is refreshed. Expired key sets are
+        still served while they are refreshed in the background.
+    min_refresh_interval: float, default 10
+        The minimal number of seconds between two fetches of a key set, when a token
+        refers to an unknown `kid`.
+    """
+    def __init__(self, ttl=300, min_refresh_interval=10):
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.key_sets = {}
+        self.single_flight = SingleFlight()
+
+    async def fetch(self, url):
+        """Fetch a key set, and parse it into {kid: {'key': public_key, 'alg': alg}}."""
+        response = await httpclient.AsyncHTTPClient().fetch(url, method='GET', raise_error=False)
+        if response.code != 200:
+            raise httpclient.HTTPError(response.code, 'Cannot fetch JWKS on {}'.format(url))
+        keys = {}
+        for jwk in json.loads(response.body.decode('utf-8'))['keys']:
+            if jwk.get('kty') != 'RSA' or jwk.get('use', 'sig') != 'sig':
+                continue
+            keys[jwk.get('kid')] = {
+                'key': RSAAlgorithm.from_jwk(json.dumps(jwk)),
+                'alg': jwk.get('alg', 'RS256'),
+                }
+        return keys
+
+    async def _refresh(self, url):
+        keys = await self.fetch(url)
+        self.key_sets[url] = {'keys': keys, 'fetched': time.time()}
+        return self.key_sets[url]
+
+    def refresh(self, url):
+        """Fetch a key set and store it in the cache.
+        Concurrent refreshes of the same key set share one fetch."""
+        return self.single_flight.run(url, self._refresh, url)
+
+    async def _refresh_in_background(self, url):
+        try:
+            await self.refresh(url)
+        except Exception:
+            logging.getLogger('factornado').exception('[SSO] Cannot refresh JWKS on %s', url)
+
+    async def get(self, url, kid=None, ttl=None):
+        """Get the key (and its algorithm) of id `kid` in the key set of `url`.
+
+        If `kid` is None, the only key of the set is returned.
+        The key set is fetched if it is not in cache, or if it does not contain `kid`
+        (at most once every `min_refresh_interval` seconds).
+
+        Returns
+        -------
+        A dict {'key': public_key, 'alg': alg}, or None if no such key exists.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        key_set = self.key_sets.get(url)
+        now = time.time()
+        if key_set is None:
+            key_set = await self.refresh(url)
+        elif (kid is not None and kid not in key_set['keys']
+              and now - key_set['fetched'] > self.min_refresh_interval):
+            # The keys may have been rotated.
+            key_set = await self.refresh(url)
+        elif now - key_set['fetched'] > ttl and url not in self.single_flight.pending:
+            ioloop.IOLoop.current().spawn_callback(self._refresh_in_background, url)
+
+        keys = key_set['keys']
+        if kid is None:
+            return list(keys.values())[0] if len(keys) == 1 else None
+        return keys.get(kid)
+
+
+jwks_cache = JWKSCache()
+
+
+class TokenCache(object):
+    """A bounded LRU cache of verified tokens, keyed by their sha256 hash.
+
+    Each token is kept until its `exp` claim ; tokens without `exp` are not cached.
+
+    Parameters
+    ----------
+    maxsize: int, default 1024
+        The maximal number of tokens in the cache.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.tokens = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        """Get the decoded data of a verified token, or None if it is not in cache or expired."""
+        key = self._key(token)
+        with self.lock:
+            auth_data = self.tokens.get(key)
+            if auth_data is not None and auth_data['exp'] <= time.time():
+                del self.tokens[key]
+                auth_data = None
+            if auth_data is None:
+                self.misses += 1
+            else:
+                self.tokens.move_to_end(key)
+                self.hits += 1
+            return auth_data
+
+    def set(self, token, auth_data):
+        """Store the decoded data of a verified token."""
+        if not isinstance(auth_data.get('exp'), (int, float)) or self.maxsize <= 0:
+            return
+        with self.lock:
+            self.tokens[self._key(token)] = auth_data
+            self.tokens.move_to_end(self._key(token))
+            while len(self.tokens) > self.maxsize:
+                self.tokens.popitem(last=False)
+
+    def stats(self):
+        """Get the cache counters: {size, hits, misses, hitRate}."""
+        nb = self.hits + self.misses
+        return {
+            'size': len(self.tokens),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / nb if nb else None,
+            }
+
+
+token_cache = TokenCache()
+
+
 def authenticated(handler_class):
     """ Handle Tornado HTTP Bearer authentication using keycloak
     This decorator can be used on class like the following sample:
@@ -19,10 +168,12 @@ def authenticated(handler_class):
                 self.write('Only authenticated')
     """
     def wrap_execute(handler_execute):
-        def _execute(self, transforms, *args, **kwargs):
-            if not _check_auth(self, kwargs):
+        async def _execute(self, transforms, *args, **kwargs):
+            with span('auth'):
+                authorized = await _check_auth(self, kwargs)
+            if not authorized:
                 return False
-            return handler_execute(self, transforms, *args, **kwargs)
+            return await handler_execute(self, transforms, *args, **kwargs)
 
         return _execute
 
@@ -44,7 +195,7 @@ def roles(roles=None, clientId=None):
     """
     def decorator(func):
         def decorated(self, *args, **kwargs):
-            auth_data = self.request.headers.get(AUTH_DATA)
+            auth_data = getattr(self, AUTH_DATA, None)
 
             if auth_data is None:
                 return _unauthorized(401, self)
@@ -65,6 +216,173 @@ def roles(roles=None, clientId=None):
     return decorator
 
 
+def _token_request(application):
+    """Build the request that retrieves a token using client credentials."""
+    sso = application.config['sso']
+    url = '{}realms/{}/protocol/openid-connect/token'.format(sso['url'], sso['realm'])
+    parameters = urlencode({
+        'grant_type': 'client_credentials',
+        'client_id': sso['client_id'],
+        'client_secret': sso['client_secret']
+    })
+    application.logger.debug('[SSO] Get token on %s for client : %s ', url, sso['client_id'])
+    return httpclient.HTTPRequest(
+        url,
+        method='POST',
+        headers={'Content-Type': 'application/x-www-form-urlencoded'},
+        body=(parameters)
+    )
+
+
+def _store_token(application, response):
+    """Parse a token response, and store the token in the application's config."""
+    if response.code == 200:
+        token = json.loads(response.body.decode('utf-8'))['access_token']
+        application.config['token'] = token
+    else:
+        token = None
+    return token
+
+
+class TokenManager(object):
+    """Keeps the service token of an application, and refreshes it ahead of its expiry.
+
+    The token and its expiry are kept in shared memory, so that the processes forked by
+    `Application.start_server` share them: one of them refreshes the token for all.
+
+    Parameters
+    ----------
+    application: factornado.Application
+        The application whose `sso` config is used to retrieve tokens.
+    skew: float, default 60
+        The number of seconds before expiry when the token is refreshed in the background.
+    max_size: int, default 8192
+        The maximal size of a shared token, in bytes. Larger tokens are kept per process.
+    claim_timeout: float, default 30
+        The number of seconds after which a process that started a refresh is considered
+        to have failed, so that another one can try.
+    """
+    def __init__(self, application, skew=60, max_size=8192, claim_timeout=30):
+        self.application = application
+        self.skew = skew
+        self.max_size = max_size
+        self.claim_timeout = claim_timeout
+        # The local copy of the token.
+        self.token = None
+        self.exp = 0
+        self.version = 0
+        # The shared copy of the token. It is inherited by the processes forked in
+        # `Application.start_server` ; an explicit context keeps the global start method unset.
+        ctx = multiprocessing.get_context('fork')
+        self._lock = ctx.Lock()
+        self._buffer = ctx.RawArray('c', max_size)
+        self._size = ctx.RawValue('i', 0)
+        self._exp = ctx.RawValue('d', 0)
+        self._version = ctx.RawValue('i', 0)
+        self._claimed_until = ctx.RawValue('d', 0)
+        self.single_flight = SingleFlight()
+
+    def _read(self):
+        """Update the local token from the shared memory, if it has changed."""
+        if self._version.value != self.version:
+            with self._lock:
+                self.token = self._buffer.raw[:self._size.value].decode('utf-8')
+                self.exp = self._exp.value
+                self.version = self._version.value
+
+    def _write(self, token):
+        """Store a new token, locally and in the shared memory, and release the claim."""
+        if token is not None:
+            self.token = token
+            self.exp = jwt.decode(token, options={'verify_signature': False})['exp']
+            data = token.encode('utf-8')
+            if len(data) > self.max_size:
+                self.application.logger.warning(
+                    '[SSO] Token of %s bytes is too large to be shared', len(data))
+                token = None
+        with self._lock:
+            self._claimed_until.value = 0
+            if token is not None:
+                self._buffer[:len(data)] = data
+                self._size.value = len(data)
+                self._exp.value = self.exp
+                self._version.value += 1
+                self.version = self._version.value
+
+    def _claim(self):
+        """Claim the refresh of the token for this process ; return whether it succeeded."""
+        now = time.time()
+        with self._lock:
+            if self._claimed_until.value > now:
+                return False
+            self._claimed_until.value = now + self.claim_timeout
+            return True
+
+    def _fetch(self):
+        client = httpclient.HTTPClient()
+        try:
+            response = client.fetch(_token_request(self.application), raise_error=False)
+        finally:
+            client.close()
+        token = _store_token(self.application, response)
+        self._write(token)
+        return token
+
+    async def _fetch_async(self):
+        response = await httpclient.AsyncHTTPClient().fetch(
+            _token_request(self.application), raise_error=False)
+        token = _store_token(self.application, response)
+        self._write(token)
+        return token
+
+    def _refresh_in_thread(self):
+        try:
+            self._fetch()
+        except Exception:
+            self._write(None)
+            self.application.logger.exception('[SSO] Cannot refresh token')
+
+    async def _refresh_in_background(self):
+        try:
+            await self.single_flight.run('token', self._fetch_async)
+        except Exception:
+            self._write(None)
+            self.application.logger.exception('[SSO] Cannot refresh token')
+
+    def get(self):
+        """Get a valid token, retrieving a new one if needed.
+
+        This blocks only if there is no valid token: a token that expires within `skew`
+        seconds is returned, and refreshed in a background thread.
+        """
+        self._read()
+        now = time.time()
+        if self.token is None or self.exp <= now:
+            return self._fetch()
+        if self.exp - self.skew <= now and self._claim():
+            threading.Thread(target=self._refresh_in_thread, daemon=True).start()
+        return self.token
+
+    async def get_async(self):
+        """Coroutine version of `get`: the token is retrieved without blocking the IOLoop,
+        and concurrent calls share one request to the SSO server."""
+        self._read()
+        now = time.time()
+        if self.token is None or self.exp <= now:
+            return await self.single_flight.run('token', self._fetch_async)
+        if self.exp - self.skew <= now and self._claim():
+            ioloop.IOLoop.current().spawn_callback(self._refresh_in_background)
+        return self.token
+
+
+def _get_token_manager(application):
+    manager = getattr(application, 'token_manager', None)
+    if manager is None:
+        manager = TokenManager(application, skew=application.config['sso'].get('token_skew', 60))
+        application.token_manager = manager
+    return manager
+
+
 def get_token(application):
     """ Use SSO server to get JWT token
         Take care, to get a new token, service need to be declare in sso
@@ -82,43 +400,23 @@ def get_token(application):
             headers={'Authorization': 'bearer {}'.format(token)},
             body=(parameters)
         )
+
+        The token is managed by `application.token_manager` (see `TokenManager`).
+        This function blocks while a new token is retrieved:
+        in coroutines, prefer `await get_token_async(application)`.
     """
-    sso = application.config['sso']
-    if not sso:
+    if not application.config.get('sso'):
         return None
+    return _get_token_manager(application).get()
 
-    # Check if a token exists and verify validity
-    token = application.config.get('token', None)
-    now = datetime.datetime.now().timestamp()
-    if (token is not None and jwt.decode(token, verify=False)['exp'] > now):
-        return token
-    else:
-        url = '{}realms/{}/protocol/openid-connect/token'.format(sso['url'], sso['realm'])
-        parameters = urlencode({
-            'grant_type': 'client_credentials',
-            'client_id': sso['client_id'],
-            'client_secret': sso['client_secret']
-        })
-        application.logger.debug(
-            '[SSO] Get token on {} for client : {} '.format(url, sso['client_id'])
-        )
-        # Retrieve token using client credentials
-        request = httpclient.HTTPRequest(
-            url,
-            method='POST',
-            headers={'Content-Type': 'application/x-www-form-urlencoded'},
-            body=(parameters)
-        )
-        response = httpclient.HTTPClient().fetch(request, raise_error=False)
-
-        if response.code == 200:
-            token = json.loads(response.body.decode('utf-8'))['access_token']
-            application.config['token'] = token
-        else:
-            token = None
-        httpclient.HTTPClient().close()
 
-        return token
+async def get_token_async(application):
+    """ Coroutine version of `get_token`, that does not block the IOLoop.
+        Concurrent calls that need a new token share one request to the SSO server.
+    """
+    if not application.config.get('sso'):
+        return None
+    return await _get_token_manager(application).get_async()
 
 
 def _unauthorized(code, handler):
@@ -131,7 +429,7 @@ def _unauthorized(code, handler):
     return False
 
 
-def _check_auth(handler, kwargs):
+async def _check_auth(handler, kwargs):
     """ Check authentication using bearer and sso server """
     # Check if bearer is present in authorization header
     header = handler.request.headers.get('Authorization')
@@ -140,7 +438,7 @@ def _check_auth(handler, kwargs):
     if header is None or not header.lower().startswith('bearer ') or not sso:
         return _unauthorized(401, handler)
 
-    # Retrieve JWK from server
+    # Retrieve JWK from server (through an in-process cache)
     # JWK contains public key that is used for decode JWT token
     # Only keycloak server know private key and can generate tokens
     # For more flexibility it possible to use .weel-known url
@@ -148,32 +446,31 @@ def _check_auth(handler, kwargs):
     # /auth/realms/fleetscience/.well-known/openid-configuration
     bearer = header.split(' ')[1]
 
+    auth_data = token_cache.get(bearer)
+    if auth_data is not None:
+        setattr(handler, AUTH_DATA, auth_data)
+        return True
+
     try:
-        handler.application.logger.debug(
-            '[SSO] Check authentication for realm {}'.format(sso['realm'])
-        )
-        request = httpclient.HTTPRequest(
+        handler.application.logger.debug('[SSO] Check authentication for realm %s', sso['realm'])
+        jwk = await jwks_cache.get(
             '{}realms/{}/protocol/openid-connect/certs'.format(sso['url'], sso['realm']),
-            method='GET',
+            kid=jwt.get_unverified_header(bearer).get('kid'),
+            ttl=sso.get('jwks_ttl'),
         )
-        response = httpclient.HTTPClient().fetch(request, raise_error=False)
-        if response.code == 200:
-            jwk = json.loads(response.body.decode('utf-8'))
-            public_key = RSAAlgorithm.from_jwk(json.dumps(jwk['keys'][0]))
-            auth_data = jwt.decode(bearer,
-                                   public_key,
-                                   algorithms=jwk['keys'][0]['alg'],
-                                   options={'verify_aud': False})
-            httpclient.HTTPClient().close()
-        else:
-            httpclient.HTTPClient().close()
+        if jwk is None:
             return _unauthorized(401, handler)
-
-    except jwt.ExpiredSignatureError:
+        auth_data = jwt.decode(bearer,
+                               jwk['key'],
+                               algorithms=[jwk['alg']],
+                               options={'verify_aud': False})
+    except (jwt.InvalidTokenError, httpclient.HTTPError):
         return _unauthorized(401, handler)
+    token_cache.set(bearer, auth_data)
 
     # Store connected authentication data in the handler
-    handler.request.headers.add(AUTH_DATA, auth_data)
+    # (HTTPHeaders only accept strings)
+    setattr(handler, AUTH_DATA, auth_data)
 
     return True
 
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import os
+import gzip
 import json
+import time
+import asyncio
+import functools
+import hashlib
 from collections import OrderedDict
-from subprocess import Popen, PIPE
 import traceback
 import pandas as pd
 import logging
 
-from tornado import web, escape, httpclient
+from tornado import web, escape, httpclient, ioloop, iostream
 
-from factornado.utils import ArgParseError, MissingArgError
+from factornado.logger import tail_files, log_files, level_pattern
+from factornado.metrics import registry as metrics_registry
+from factornado.utils import ArgParseError, MissingArgError, maybe_await
 
 factornado_logger = logging.getLogger('factornado')
 
@@ -109,36 +116,57 @@ class Heartbeat(web.RequestHandler):
             }
         }
     }
+    # The keys set in the config at runtime, that are not sent to the registry:
+    # the service token changes at each refresh, and is a secret.
+    runtime_keys = ['token']
 
     async def post(self):
+        """Send a heartbeat to the registry.
+
+        The full config is sent only when its hash has changed since it was last registered
+        (or if the registry asks for it) ; otherwise the heartbeat is a tiny liveness ping.
+        """
         if 'host_url' in self.application.config:
             url = self.application.config['host_url']
         else:
             url = 'http://{}:{}'.format(self.application.get_host(),
                                         self.application.get_port())
-        request = httpclient.HTTPRequest(
-            '{}/register/{}'.format(
-                self.application.config['registry']['url'].rstrip('/'),
-                self.application.config['name'],
-                ),
-            method='POST',
-            body=json.dumps({
-                'url': url,
-                'config': self.application.config,
-                }),
-            )
-        self.client = httpclient.AsyncHTTPClient()
-        response = await self.client.fetch(request)
+        config = {key: val for key, val in self.application.config.items()
+                  if key not in self.runtime_keys}
+        config_hash = hashlib.sha1(
+            json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+        if getattr(self.application, 'registered_config_hash', None) == config_hash:
+            response = await self.register({'url': url, 'hash': config_hash})
+            if response.error is None and response.body == b'config_needed':
+                response = await self.register(
+                    {'url': url, 'hash': config_hash, 'config': config})
+        else:
+            response = await self.register(
+                {'url': url, 'hash': config_hash, 'config': config})
+        if response.error is None:
+            self.application.registered_config_hash = config_hash
 
-        factornado_logger.debug('HEARTBEAT: {} ({}).'.format(
-                response.code, response.reason[:30]))
+        factornado_logger.debug('HEARTBEAT: %s (%.30s).', response.code, response.reason,
+                                extra={'status': response.code})
 
         if response.error is None:
             self.write('ok')
         else:
             self.write('ko: ({}) {}'.format(
                     response.code, response.reason))
-        self.client.close()
+
+    def register(self, body):
+        """Post `body` to the registry."""
+        request = httpclient.HTTPRequest(
+            '{}/register/{}'.format(
+                self.application.config['registry']['url'].rstrip('/'),
+                self.application.config['name'],
+                ),
+            method='POST',
+            body=json.dumps(body),
+            )
+        return httpclient.AsyncHTTPClient().fetch(request, raise_error=False)
 
 
 class Todo(web.RequestHandler):
@@ -159,34 +187,38 @@ class Todo(web.RequestHandler):
 
     todo_task = 'todo'
     do_task = 'do'
+    # If the `actions` service is declared, tasks are stacked by batches of this size.
+    stack_batch_size = 1000
 
-    def post(self):
-        out = self.todo()
+    async def post(self):
+        out = await self.todo()
         if out['nb'] == 0:
             self.set_status(201)  # Nothing to do.
         self.write(json.dumps(out))
 
     def todo_list(self, data):
+        """Return the list of (task_key, task_data) to be stacked, and the updated `data`.
+        It may be a coroutine."""
         raise NotImplementedError()
 
-    def todo(self):
+    async def todo(self):
         nb_created_tasks = 0
 
         # We get the `todo` task.
-        r = self.application.services.tasks.action.put(
+        r = await maybe_await(self.application.services.tasks.action.put(
             task=self.application.config['tasks'][self.todo_task],
             key=self.application.config['tasks'][self.todo_task],
             action='stack',
             data={},
-            )
+            ))
 
         factornado_logger.debug('TODO: Start scanning for new tasks')
         nb_loops = 0
 
         while True:
             # Get and self-assign the task.
-            r = self.application.services.tasks.assignOne.put(
-                    task=self.application.config['tasks'][self.todo_task])
+            r = await maybe_await(self.application.services.tasks.assignOne.put(
+                    task=self.application.config['tasks'][self.todo_task]))
             if r.status_code != 200:
                 break
 
@@ -199,29 +231,20 @@ class Todo(web.RequestHandler):
 
                 # Get all documents after `lastScanObjectId`
                 # #########################################
-                todo_tasks, data = self.todo_list(data)
-                factornado_logger.debug('TODO: Found {} tasks'.format(len(todo_tasks)))
-                for task_key, task_data in todo_tasks:
-                    factornado_logger.debug('TODO: Set task {}/{}'.format(task_key,
-                                                                          task_data))
-                    r = self.application.services.tasks.action.put(
-                        task=self.application.config['tasks'][self.do_task],
-                        key=escape.url_escape(task_key),
-                        action='stack',
-                        data=task_data,
-                        )
-                    nb_created_tasks += 1
+                todo_tasks, data = await maybe_await(self.todo_list(data))
+                factornado_logger.debug('TODO: Found %s tasks', len(todo_tasks))
+                nb_created_tasks += await self.stack(todo_tasks)
 
                 # Update the task to `done` if nothing happenned since last GET.
-                r = self.application.services.tasks.action.put(
+                r = await maybe_await(self.application.services.tasks.action.put(
                     task=self.application.config['tasks'][self.todo_task],
                     key=self.application.config['tasks'][self.todo_task],
                     action='success',
                     data=data,
-                    )
+                    ))
             except Exception as e:
                 # Update the task to `done` if nothing happenned since last GET.
-                r = self.application.services.tasks.action.put(
+                r = await maybe_await(self.application.services.tasks.action.put(
                     task=self.application.config['tasks'][self.todo_task],
                     key=self.application.config['tasks'][self.todo_task],
                     action='error',
@@ -232,21 +255,51 @@ class Todo(web.RequestHandler):
                             'datetime': pd.Timestamp(pd.Timestamp.utcnow().value).isoformat(),
                             }
                         },
-                    )
+                    ))
                 factornado_logger.exception('TODO: Failed todoing.')
+                metrics_registry.inc('factornado_todo_errors_total',
+                                     task=self.application.config['tasks'][self.todo_task])
                 return {'nb': 0, 'ok': False, 'reason': e.__repr__()}
 
             nb_loops += 1
 
-        log_str = 'TODO: Finished scanning for new tasks. Found {} in {} loops.'.format(
-            nb_created_tasks, nb_loops)
-        if nb_created_tasks > 0:
-            factornado_logger.info(log_str)
-        else:
-            factornado_logger.debug(log_str)
+        factornado_logger.log(
+            logging.INFO if nb_created_tasks > 0 else logging.DEBUG,
+            'TODO: Finished scanning for new tasks. Found %s in %s loops.',
+            nb_created_tasks, nb_loops,
+            extra={'nb_tasks': nb_created_tasks, 'nb_loops': nb_loops})
 
         return {'nb': nb_created_tasks, 'nbLoops': nb_loops}
 
+    async def stack(self, todo_tasks):
+        """Stack the tasks returned by `todo_list`, and return the number of tasks stacked."""
+        todo_tasks = list(todo_tasks)
+        if hasattr(self.application.services.tasks, 'actions'):
+            for i in range(0, len(todo_tasks), self.stack_batch_size):
+                batch = todo_tasks[i:i + self.stack_batch_size]
+                factornado_logger.debug('TODO: Set %s tasks', len(batch))
+                await maybe_await(self.application.services.tasks.actions.put(data=[
+                    {
+                        'task': self.application.config['tasks'][self.do_task],
+                        'key': task_key,
+                        'action': 'stack',
+                        'data': task_data,
+                        }
+                    for task_key, task_data in batch]))
+        else:
+            for task_key, task_data in todo_tasks:
+                factornado_logger.debug('TODO: Set task %s/%s', task_key, task_data,
+                                        extra={'task_key': task_key})
+                await maybe_await(self.application.services.tasks.action.put(
+                    task=self.application.config['tasks'][self.do_task],
+                    key=escape.url_escape(task_key),
+                    action='stack',
+                    data=task_data,
+                    ))
+        metrics_registry.inc('factornado_todo_tasks_total', len(todo_tasks),
+                             task=self.application.config['tasks'][self.do_task])
+        return len(todo_tasks)
+
 
 class Do(web.RequestHandler):
     swagger = {
@@ -265,20 +318,39 @@ class Do(web.RequestHandler):
     }
 
     do_task = 'do'
+    # If set, `batch_size` tasks are assigned at once through the `assignMany` service,
+    # and their outcomes are reported in one request through the `actions` service.
+    batch_size = None
 
-    def post(self):
-        out = self.do()
+    async def post(self):
+        out = await (self.do() if self.batch_size is None else self.do_batch())
         if out['nb'] == 0:
             self.set_status(201)  # Nothing to do.
         self.write(json.dumps(out))
 
     def do_something(self, task_key, task_data):
+        """Do the task. It may be a coroutine."""
         raise NotImplementedError()
 
-    def do(self):
+    async def do_one(self, task_key, task_data):
+        """Run `do_something`, and count its outcome and duration in the metrics."""
+        task = self.application.config['tasks'][self.do_task]
+        start = time.time()
+        try:
+            out = await maybe_await(self.do_something(task_key, task_data))
+        except Exception:
+            metrics_registry.inc('factornado_do_tasks_total', task=task, status='error')
+            raise
+        finally:
+            metrics_registry.observe('factornado_do_duration_seconds', time.time() - start,
+                                     task=task)
+        metrics_registry.inc('factornado_do_tasks_total', task=task, status='success')
+        return out
+
+    async def do(self):
         # Get a task and parse it.
-        r = self.application.services.tasks.assignOne.put(
-                task=self.application.config['tasks'][self.do_task])
+        r = await maybe_await(self.application.services.tasks.assignOne.put(
+                task=self.application.config['tasks'][self.do_task]))
         if r.status_code != 200:
             return {'nb': 0, 'code': r.status_code, 'reason': r.reason, 'ok': False}
 
@@ -287,22 +359,23 @@ class Do(web.RequestHandler):
         task_data = task['data']
 
         try:
-            factornado_logger.debug('DO: Got task: {}'.format(task_key))
-            factornado_logger.debug('DO: Got task data: {}'.format(task_data))
+            factornado_logger.debug('DO: Got task: %s', task_key, extra={'task_key': task_key})
+            factornado_logger.debug('DO: Got task data: %s', task_data,
+                                    extra={'task_key': task_key})
             # Load the statuses.
-            out = self.do_something(task_key, task_data)
+            out = await self.do_one(task_key, task_data)
 
             # Set the task as `done`.
-            self.application.services.tasks.action.put(
+            await maybe_await(self.application.services.tasks.action.put(
                 task=self.application.config['tasks'][self.do_task],
                 key=escape.url_escape(task_key),
                 action='success',
                 data=task_data,
-                )
+                ))
             return {'nb': 1, 'key': task_key, 'ok': True, 'out': out}
         except Exception as e:
             # Set the task as `fail`.
-            self.application.services.tasks.action.put(
+            await maybe_await(self.application.services.tasks.action.put(
                 task=self.application.config['tasks'][self.do_task],
                 key=escape.url_escape(task_key),
                 action='error',
@@ -313,29 +386,96 @@ class Do(web.RequestHandler):
                         'datetime': pd.Timestamp(pd.Timestamp.utcnow().value).isoformat(),
                         }
                     },
-                )
-            factornado_logger.exception('DO: Failed doing task {}.'.format(task_key))
+                ))
+            factornado_logger.exception('DO: Failed doing task %s.', task_key,
+                                        extra={'task_key': task_key})
             return {'nb': 0, 'key': task_key, 'ok': False, 'reason': e.__repr__()}
 
+    async def do_batch(self):
+        # Get a batch of tasks.
+        r = await maybe_await(self.application.services.tasks.assignMany.put(
+                task=self.application.config['tasks'][self.do_task],
+                n=self.batch_size))
+        if r.status_code != 200:
+            return {'nb': 0, 'code': r.status_code, 'reason': r.reason, 'ok': False}
+
+        actions, results = [], []
+        for task in r.json():
+            task_key = task['key']
+            task_data = task['data']
+            try:
+                factornado_logger.debug('DO: Got task: %s', task_key, extra={'task_key': task_key})
+                factornado_logger.debug('DO: Got task data: %s', task_data,
+                                        extra={'task_key': task_key})
+                out = await self.do_one(task_key, task_data)
+                actions.append({
+                    'task': self.application.config['tasks'][self.do_task],
+                    'key': task_key,
+                    'action': 'success',
+                    'data': task_data,
+                    })
+                results.append({'key': task_key, 'ok': True, 'out': out})
+            except Exception as e:
+                actions.append({
+                    'task': self.application.config['tasks'][self.do_task],
+                    'key': task_key,
+                    'action': 'error',
+                    'data': {
+                        'lastError': {
+                            'reason': e.__repr__(),
+                            'traceback': traceback.format_exc(),
+                            'datetime': pd.Timestamp(pd.Timestamp.utcnow().value).isoformat(),
+                            }
+                        },
+                    })
+                results.append({'key': task_key, 'ok': False, 'reason': e.__repr__()})
+                factornado_logger.exception('DO: Failed doing task %s.', task_key,
+                                            extra={'task_key': task_key})
+
+        # Set the tasks as `done` or `fail`.
+        await maybe_await(self.application.services.tasks.actions.put(data=actions))
+
+        nb = sum(result['ok'] for result in results)
+        return {'nb': nb, 'ok': nb == len(results), 'tasks': results}
+
 
 class Log(web.RequestHandler):
     swagger = {
         "/{name}/{uri}": {
             "get": {
                 "description": "Get the server logs.",
-                "parameters": [{
-                    "in": "query",
-                    "name": "n",
-                    "required": False,
-                    "description": "The number of lines to retrieve.",
-                    "schema": {
-                        "type": "integer",
-                        "format": "int32",
-                        "default": 20
-                    }
-                }],
+                "parameters": [
+                    {
+                        "in": "query",
+                        "name": "n",
+                        "required": False,
+                        "description": "The number of lines to retrieve (at most 10000).",
+                        "schema": {
+                            "type": "integer",
+                            "format": "int32",
+                            "default": 20
+                        }
+                    },
+                    {
+                        "in": "query",
+                        "name": "level",
+                        "required": False,
+                        "description": "Only get the lines of this level or above "
+                                       "(DEBUG, INFO, WARNING, ERROR, CRITICAL or a number).",
+                        "schema": {"type": "string"}
+                    },
+                    {
+                        "in": "query",
+                        "name": "follow",
+                        "required": False,
+                        "description": "Whether to keep streaming the new lines, "
+                                       "for at most `max_follow` seconds.",
+                        "schema": {"type": "boolean", "default": False}
+                    },
+                ],
                 "responses": {
                     200: {"description": "OK"},
+                    400: {"description": "Bad Request"},
                     401: {"description": "Unauthorized"},
                     403: {"description": "Forbidden"},
                     404: {"description": "Not Found"},
@@ -343,17 +483,180 @@ class Log(web.RequestHandler):
             }
         }
     }
+    max_lines = 10000
+    batch_size = 1000
+    follow_interval = 0.5
+    max_follow = 3600
 
-    def get(self):
+    async def get(self):
         n = self.get_argument('n', '20')
         try:
-            n = int(n)
+            n = min(int(n), self.max_lines)
         except Exception:
             raise web.HTTPError(400, 'Argument {} is not an int'.format(n))
+        level = self.get_argument('level', None)
+        try:
+            pattern = None if level is None else level_pattern(level)
+        except ValueError:
+            raise web.HTTPError(400, 'Argument {} is not a level'.format(level))
+        follow = self.get_argument('follow', 'false').lower() in ['true', '1']
 
         filename = self.application.config['log']['file']
-        tail = Popen(['tail', '-%d' % n, filename], stdout=PIPE).communicate()[0]
-        self.write(tail)
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        # With `per_process` logs, each process has its own file: we merge them.
+        lines = await ioloop.IOLoop.current().run_in_executor(
+            None, functools.partial(tail_files, log_files(filename), n=n, level=level))
+        for i in range(0, len(lines), self.batch_size):
+            self.write(b''.join(lines[i:i + self.batch_size]))
+            await self.flush()
+
+        if follow:
+            # Send the headers, even if there were no lines yet.
+            await self.flush()
+            await self.follow(filename, pattern)
+
+    def on_connection_close(self):
+        self.closed = True
+
+    async def follow(self, filename, pattern):
+        """Stream the lines appended to `filename` (and its per-process shards),
+        till the client disconnects."""
+        self.closed = False
+        self.rest = {}
+        files = {}
+        try:
+            for name in log_files(filename):
+                files[name] = open(name, 'rb')
+                files[name].seek(0, 2)
+            start = time.time()
+            while not self.closed and time.time() - start < self.max_follow:
+                await asyncio.sleep(self.follow_interval)
+                for name in log_files(filename):
+                    if name not in files:
+                        # A new process has started logging.
+                        files[name] = open(name, 'rb')
+                for name, f in list(files.items()):
+                    await self.write_new_lines(f, pattern)
+                    try:
+                        rotated = os.stat(name).st_ino != os.fstat(f.fileno()).st_ino
+                    except FileNotFoundError:
+                        rotated = True
+                    if rotated:
+                        # The file has been rotated: we finish reading it, and reopen it
+                        # at the next iteration.
+                        await self.write_new_lines(f, pattern)
+                        f.close()
+                        del files[name]
+                        self.rest.pop(name, None)
+        except iostream.StreamClosedError:
+            pass
+        finally:
+            for f in files.values():
+                f.close()
+
+    async def write_new_lines(self, f, pattern, chunk_size=2 ** 20):
+        while True:
+            chunk = f.read(chunk_size)
+            lines = (self.rest.get(f.name, b'') + chunk).split(b'\n')
+            self.rest[f.name] = lines.pop()
+            lines = [line + b'\n' for line in lines
+                     if line and (pattern is None or pattern.search(line))]
+            if len(lines):
+                self.write(b''.join(lines))
+                await self.flush()
+            if len(chunk) < chunk_size:
+                break
+
+
+class Metrics(web.RequestHandler):
+    swagger = {
+        "/{name}/{uri}": {
+            "get": {
+                "description": "Get the metrics of the service (all processes), "
+                               "in Prometheus' text format.",
+                "parameters": [],
+                "responses": {
+                    200: {"description": "OK"},
+                    401: {"description": "Unauthorized"},
+                    403: {"description": "Forbidden"},
+                    404: {"description": "Not Found"},
+                }
+            }
+        }
+    }
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics_registry.render())
+
+
+def build_swagger(application):
+    """Build the swagger documentation of an application.
+
+    Returns
+    -------
+    A dict {json, gzip, etag}, with the document encoded in JSON, gzipped, and its ETag.
+    """
+    sw = OrderedDict([
+        ("openapi", "3.0.0"),
+        ("info", {
+            "title": application.config.get('name'),
+            "version": (
+                'v1.0'
+                if 'tag' not in application.config
+                else application.config['tag']
+            ),
+        }),
+        ("servers", [{
+            "url": "/api"
+        }]),
+        ("paths", {}),
+        ("components", {})
+    ])
+
+    for h in application.handler_list:
+        uri, handler = h[:2]
+        # Attribute swagger contains path declaration
+        # https://swagger.io/specification/#pathsObject
+        if hasattr(handler, 'swagger') and len(handler.swagger.keys()) > 0:
+            path = list(handler.swagger.keys())[0]
+            final_path = path.format(
+                name=application.config.get('name'),
+                uri=uri.lstrip('/')
+            )
+            sw['paths'][final_path] = handler.swagger[path]
+
+    # Security context in swagger
+    if 'sso' in application.config:
+        sso = application.config['sso']
+        sw['components']['securitySchemes'] = {
+            "oauth": {
+                "type": "oauth2",
+                "description": "This API uses OAuth 2 with the password grant flow",
+                "flows": {
+                    "password": {
+                        "tokenUrl": "{}realms/{}/protocol/openid-connect/token".format(
+                            sso['url'],
+                            sso['realm']
+                        )
+                    }
+                }
+            }
+        }
+    # This object is usefull to declare generic types,
+    # service response representation...
+    # https://swagger.io/docs/specification/components/
+    # https://swagger.io/specification/#schemaObject
+    if application.swagger_components is not None:
+        for key, value in application.swagger_components.items():
+            sw['components'][key] = value
+
+    body = json.dumps(sw, indent=2).encode('utf-8')
+    return {
+        'json': body,
+        'gzip': gzip.compress(body),
+        'etag': '"{}"'.format(hashlib.sha1(body).hexdigest()),
+        }
 
 
 class Swagger(web.RequestHandler):
@@ -376,58 +679,18 @@ class Swagger(web.RequestHandler):
         self.handlers = handlers
 
     def get(self):
-        sw = OrderedDict([
-            ("openapi", "3.0.0"),
-            ("info", {
-                "title": self.application.config['name'],
-                "version": (
-                    'v1.0'
-                    if 'tag' not in self.application.config
-                    else self.application.config['tag']
-                ),
-            }),
-            ("servers", [{
-                "url": "/api"
-            }]),
-            ("paths", {}),
-            ("components", {})
-        ])
-
-        for h in self.application.handler_list:
-            uri, handler = h[:2]
-            # Attribute swagger contains path declaration
-            # https://swagger.io/specification/#pathsObject
-            if hasattr(handler, 'swagger') and len(handler.swagger.keys()) > 0:
-                path = list(handler.swagger.keys())[0]
-                final_path = path.format(
-                    name=self.application.config['name'],
-                    uri=uri.lstrip('/')
-                )
-                sw['paths'][final_path] = handler.swagger[path]
-
-        # Security context in swagger
-        if 'sso' in self.application.config:
-            sso = self.application.config['sso']
-            sw['components']['securitySchemes'] = {
-                "oauth": {
-                    "type": "oauth2",
-                    "description": "This API uses OAuth 2 with the password grant flow",
-                    "flows": {
-                        "password": {
-                            "tokenUrl": "{}realms/{}/protocol/openid-connect/token".format(
-                                sso['url'],
-                                sso['realm']
-                            )
-                        }
-                    }
-                }
-            }
-        # This object is usefull to declare generic types,
-        # service response representation...
-        # https://swagger.io/docs/specification/components/
-        # https://swagger.io/specification/#schemaObject
-        if self.application.swagger_components is not None:
-            for key, value in self.application.swagger_components.iteritems():
-                sw['components'][key] = value
-
-        self.write(json.dumps(sw, indent=2))
+        document = self.application.swagger_document
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(document['gzip'])
+        else:
+            self.write(document['json'])
+
+    def compute_etag(self):
+        return self.application.swagger_document['etag']
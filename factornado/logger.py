@@ -1,5 +1,16 @@
-import logging
+import os
+import re
 import sys
+import glob
+import json
+import copy
+import heapq
+import queue
+import atexit
+import weakref
+import datetime
+import logging
+import logging.handlers
 
 
 def get_logger(name=None, **kwargs):
@@ -15,9 +26,29 @@ def get_logger(name=None, **kwargs):
         Whether you want a STDOUT handler.
     file: str, default None
         Eventually the filename where you want a FileHandler to write.
+    max_bytes: int, default None
+        If set, the file is rotated when it reaches this size (see `RotatingFileHandler`).
+    when: str, default None
+        If set, the file is rotated periodically: 'S', 'M', 'H', 'D', 'midnight'...
+        (see `TimedRotatingFileHandler`).
+    interval: int, default 1
+        The number of `when` units between two rotations.
+    backup_count: int, default 5
+        The number of rotated files to keep.
+        Without `per_process`, the processes forked by `Application.start_server` share one
+        file and each rotates it on its own, so records get lost or interleaved: use
+        `per_process` with `max_bytes` or `when`.
+    per_process: bool, default False
+        Whether each process writes its own file (`service.pid<pid>.log` for
+        `file='service.log'`), instead of sharing one.
+        This is useful with the processes forked by `Application.start_server`: they do not
+        contend on one file, and each can rotate its own. See `log_files` to find them.
     format: str
         The format that you want the handlers to use.
         Default: '%(asctime)s (%(filename)s:%(lineno)s)- %(levelname)s - %(message)s'
+    json: bool, default False
+        Whether records are written as JSON objects, one per line (see `JSONFormatter`),
+        instead of with `format`.
     level: int, default 10
         The level of your logger.
         (DEBUG=10, INFO=20, WARNING=30, ERROR=40, CRITICAL=50)
@@ -27,35 +58,65 @@ def get_logger(name=None, **kwargs):
     levels: dict, default {}
         If you want to set the level of other loggers.
         Exemple: {'requests': 30, 'factornado': 20}
+    queue: bool, default False
+        Whether records are written by a background thread, so that logging calls do not
+        block on writes. The records go through a `QueueHandler` to a `QueueListener`.
+    queue_size: int, default 10000
+        The maximal number of records waiting to be written.
+    queue_policy: str, default 'drop'
+        What happens to a record when the queue is full: 'drop' it, or 'block' till there
+        is room. Dropped records are counted in the handler's `dropped` attribute.
     """
     logger = logging.getLogger(name) if name else logging.root
-    logger_format = logging.Formatter(kwargs.get(
-            'format',
-            '%(asctime)s (%(name)s:%(filename)s:%(lineno)s)- %(levelname)s - %(message)s',
-            ))
+    if kwargs.get('json'):
+        logger_format = JSONFormatter()
+    else:
+        logger_format = logging.Formatter(kwargs.get(
+                'format',
+                '%(asctime)s (%(name)s:%(filename)s:%(lineno)s)- %(levelname)s - %(message)s',
+                ))
 
     # Eventually remove previously defined handlers
     if kwargs.get('purge_handlers') or (kwargs.get('purge_handlers') is None and name is not None):
         while len(logger.handlers):
-            logger.removeHandler(logger.handlers[0])
+            handler = logger.handlers[0]
+            if isinstance(handler, BoundedQueueHandler):
+                handler.stop()
+            logger.removeHandler(handler)
+
+    handlers = []
 
     # Eventually set a STDOUT logger
     if kwargs.get('stdout', True):
         stdout_handler = logging.StreamHandler(stream=sys.stdout)
         stdout_handler.setFormatter(logger_format)
-        logger.addHandler(stdout_handler)
+        handlers.append(stdout_handler)
 
     # Eventually set a stream logger
     if kwargs.get('stream'):
         stdout_handler = logging.StreamHandler(stream=kwargs['stream'])
         stdout_handler.setFormatter(logger_format)
-        logger.addHandler(stdout_handler)
+        handlers.append(stdout_handler)
 
     # Eventually set a file logger
     if kwargs.get('file'):
-        file_handler = logging.FileHandler(filename=kwargs['file'], mode='a')
+        file_kwargs = {key: kwargs[key] for key in ['max_bytes', 'when', 'interval',
+                                                    'backup_count'] if key in kwargs}
+        if kwargs.get('per_process'):
+            file_handler = PerProcessFileHandler(kwargs['file'], **file_kwargs)
+        else:
+            file_handler = file_handler_factory(kwargs['file'], **file_kwargs)
         file_handler.setFormatter(logger_format)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    # Eventually write the records in a background thread
+    if kwargs.get('queue') and len(handlers):
+        handlers = [BoundedQueueHandler(handlers,
+                                        maxsize=kwargs.get('queue_size', 10000),
+                                        block=kwargs.get('queue_policy', 'drop') == 'block')]
+
+    for handler in handlers:
+        logger.addHandler(handler)
 
     logger.setLevel(kwargs.get('level', 10))
 
@@ -63,3 +124,288 @@ def get_logger(name=None, **kwargs):
         logging.getLogger(lib).setLevel(lib_level)
 
     return logger
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as JSON objects, for log pipelines.
+
+    Each record gives one line, with the fields `time`, `name`, `level`, `file`, `line`,
+    `pid` and `message` ; `exception` if any ; and the fields passed in `extra`.
+    Values that are not JSON serializable are written as strings.
+    """
+    # The attributes of any LogRecord: the others have been passed in `extra`.
+    record_attributes = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+        'message', 'asctime'}
+
+    def format(self, record):
+        doc = {
+            'time': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'file': record.filename,
+            'line': record.lineno,
+            'pid': record.process,
+            'message': record.getMessage(),
+            }
+        if record.exc_info:
+            doc['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            doc['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in self.record_attributes:
+                doc[key] = value
+        return json.dumps(doc, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return datetime.datetime.fromtimestamp(
+            record.created, datetime.timezone.utc).isoformat(timespec='milliseconds')
+
+
+def file_handler_factory(filename, max_bytes=None, when=None, interval=1, backup_count=5):
+    """Create a handler writing to `filename`, that eventually rotates it.
+
+    Parameters
+    ----------
+    See `get_logger`.
+    """
+    if max_bytes is not None:
+        return logging.handlers.RotatingFileHandler(
+            filename, mode='a', maxBytes=max_bytes, backupCount=backup_count)
+    elif when is not None:
+        return logging.handlers.TimedRotatingFileHandler(
+            filename, when=when, interval=interval, backupCount=backup_count)
+    else:
+        return logging.FileHandler(filename=filename, mode='a')
+
+
+def shard_filename(filename, pid):
+    """The log file of process `pid`, when logs are written `per_process`:
+    'service.log' gives 'service.pid<pid>.log'."""
+    root, ext = os.path.splitext(filename)
+    return '{}.pid{}{}'.format(root, pid, ext)
+
+
+def log_files(filename):
+    """List the log files that may be written for `filename`: itself and its per-process
+    shards (but not the rotated ones, such as 'service.log.1' or 'service.pid12.log.1')."""
+    root, ext = os.path.splitext(filename)
+    shards = [x for x in glob.glob('{}.pid*{}'.format(glob.escape(root), glob.escape(ext)))
+              if re.match(r'pid\d+$', x[len(root) + 1:len(x) - len(ext)])]
+    return ([filename] if os.path.exists(filename) else []) + sorted(shards)
+
+
+class PerProcessFileHandler(logging.Handler):
+    """A handler that writes to one file per process (see `shard_filename`).
+
+    The file is opened by the first record of each process, so that the handler can be
+    created before forking.
+
+    Parameters
+    ----------
+    filename: str
+        The base filename.
+    **kwargs:
+        The rotation parameters passed to `file_handler_factory`.
+    """
+    def __init__(self, filename, **kwargs):
+        super(PerProcessFileHandler, self).__init__()
+        self.filename = filename
+        self.kwargs = kwargs
+        self.handler = None
+        self.pid = None
+
+    def get_handler(self):
+        if self.handler is None or self.pid != os.getpid():
+            # The parent's file is left open: it is the parent's to close.
+            self.pid = os.getpid()
+            self.handler = file_handler_factory(shard_filename(self.filename, self.pid),
+                                                **self.kwargs)
+            self.handler.setFormatter(self.formatter)
+        return self.handler
+
+    def setFormatter(self, fmt):
+        super(PerProcessFileHandler, self).setFormatter(fmt)
+        if self.handler is not None:
+            self.handler.setFormatter(fmt)
+
+    def emit(self, record):
+        self.get_handler().emit(record)
+
+    def close(self):
+        if self.handler is not None and self.pid == os.getpid():
+            self.handler.close()
+        super(PerProcessFileHandler, self).close()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """A `QueueHandler` with a bounded queue, and its `QueueListener` writing to `handlers`.
+
+    Parameters
+    ----------
+    handlers: list of logging.Handler
+        The handlers that write the records, in the listener's thread.
+    maxsize: int, default 10000
+        The maximal number of records in the queue.
+    block: bool, default False
+        Whether to wait for room when the queue is full. Otherwise, the record is dropped.
+    """
+    def __init__(self, handlers, maxsize=10000, block=False):
+        super(BoundedQueueHandler, self).__init__(queue.Queue(maxsize=maxsize))
+        self.maxsize = maxsize
+        self.block = block
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        _queue_handlers.add(self)
+
+    def _restart(self):
+        if self.listener._thread is not None:
+            self.queue = queue.Queue(maxsize=self.maxsize)
+            self.listener.queue = self.queue
+            self.listener._thread = None
+            self.listener.start()
+
+    def stop(self):
+        """Write the queued records, and stop the listener's thread."""
+        thread = self.listener._thread
+        if thread is not None:
+            # This is the listener's sentinel ; we wait for room if the queue is full.
+            self.queue.put(None)
+            thread.join()
+            self.listener._thread = None
+        _queue_handlers.discard(self)
+
+    def prepare(self, record):
+        """Merge the record's arguments into its message, so that it no longer depends on
+        objects that may change before it is written.
+
+        Unlike `QueueHandler.prepare`, the record is not formatted here: the listener's
+        handlers format it, with its exception (which `JSONFormatter` writes apart).
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.listener._thread is None:
+            # The listener is stopped (e.g. at exit): nothing would empty the queue.
+            self.listener.handle(record)
+        elif self.block:
+            self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+
+# The live `BoundedQueueHandler`s, stopped at exit, and restarted in forked processes.
+_queue_handlers = weakref.WeakSet()
+
+
+def _stop_queue_handlers():
+    for handler in list(_queue_handlers):
+        handler.stop()
+
+
+def _restart_queue_handlers():
+    for handler in list(_queue_handlers):
+        handler._restart()
+
+
+atexit.register(_stop_queue_handlers)
+if hasattr(os, 'register_at_fork'):
+    # The listeners' threads do not survive a fork: each process needs its own.
+    os.register_at_fork(after_in_child=_restart_queue_handlers)
+
+
+def level_pattern(level):
+    """Build a regex matching the log lines of level `level` or above.
+
+    Parameters
+    ----------
+    level: int or str
+        A level number (30) or name ('WARNING').
+    """
+    if isinstance(level, str) and not level.isdigit():
+        number = logging.getLevelName(level.upper())
+        if not isinstance(number, int):
+            raise ValueError('Unknown level {}'.format(level))
+    else:
+        number = int(level)
+    names = [name for name in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+             if logging.getLevelName(name) >= number]
+    return re.compile(r'\b({})\b'.format('|'.join(names)).encode('utf-8'))
+
+
+def iter_lines_reversed(f, block_size=65536):
+    """Iterate over the lines of a binary file, from the end, reading it block-wise.
+
+    Each line is yielded with its trailing newline (except perhaps the last one).
+    """
+    f.seek(0, 2)
+    position = f.tell()
+    rest = b''
+    while position > 0:
+        size = min(block_size, position)
+        position -= size
+        f.seek(position)
+        lines = (f.read(size) + rest).split(b'\n')
+        # The first line may be incomplete: it is kept for the next block.
+        rest = lines[0]
+        for line in reversed(lines[1:]):
+            if line:
+                yield line + b'\n'
+    if rest:
+        yield rest + b'\n'
+
+
+def tail(filename, n=20, level=None, block_size=65536):
+    """Get the last lines of a log file, without reading it all.
+
+    Parameters
+    ----------
+    filename: str
+        The log file.
+    n: int, default 20
+        The number of lines to get.
+    level: int or str, default None
+        If not None, only the lines of this level or above are returned.
+        The level is detected by its name in the line.
+    block_size: int, default 65536
+        The number of bytes read at once.
+
+    Returns
+    -------
+    A list of lines (bytes), in the file's order.
+    """
+    pattern = None if level is None else level_pattern(level)
+    lines = []
+    with open(filename, 'rb') as f:
+        for line in iter_lines_reversed(f, block_size=block_size):
+            if len(lines) >= n:
+                break
+            if pattern is None or pattern.search(line):
+                lines.append(line)
+    return lines[::-1]
+
+
+def tail_files(filenames, n=20, level=None, block_size=65536):
+    """Get the last lines of several log files, merged in one.
+
+    The lines of each file are kept in order, and merged assuming they start with a
+    sortable timestamp (as with the default format).
+
+    Parameters
+    ----------
+    filenames: list of str
+        The log files.
+    n, level, block_size:
+        See `tail`.
+    """
+    lines = [tail(filename, n=n, level=level, block_size=block_size)
+             for filename in filenames]
+    return list(heapq.merge(*lines))[-n:] if n > 0 else []
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import glob
+import bisect
+import threading
+
+# The upper bounds of the histograms' buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MetricsRegistry(object):
+    """An in-process registry of counters and histograms, rendered in Prometheus' text format.
+
+    Each process counts on its own, and writes its values in `directory` (at most every
+    `flush_interval` seconds), so that any process can render the sum over all of them.
+    Forked processes start from zero.
+
+    Parameters
+    ----------
+    directory: str, default None
+        The directory where processes share their values.
+        If None, only the current process' values are rendered.
+    flush_interval: float, default 1
+        The maximal delay, in seconds, before new values are written in `directory`.
+    buckets: tuple of float, default DEFAULT_BUCKETS
+        The upper bounds of the histograms' buckets.
+    """
+    def __init__(self, directory=None, flush_interval=1, buckets=DEFAULT_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self.label_values = {}
+        self.reset()
+
+    def reset(self):
+        """Forget all values of the current process."""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._timer = None
+        self.counters = {}
+        self.histograms = {}
+
+    def set_directory(self, directory):
+        """Share the values in `directory`, forgetting those written there before."""
+        os.makedirs(directory, exist_ok=True)
+        for filename in self.files(directory):
+            os.remove(filename)
+        self.directory = directory
+
+    def limit_label(self, label, values):
+        """Only keep the given values of `label` (e.g. the values that come from requests):
+        the others are counted as 'other', so that the number of series is bounded.
+
+        If `values` is None, any value is kept.
+        """
+        if values is None:
+            self.label_values.pop(label, None)
+        else:
+            self.label_values[label] = {str(value) for value in values}
+
+    def _limited_key(self, name, labels):
+        for label, values in self.label_values.items():
+            if label in labels and str(labels[label]) not in values:
+                labels[label] = 'other'
+        return _key(name, labels)
+
+    def inc(self, name, value=1, **labels):
+        """Add `value` to the counter `name`."""
+        if self._pid != os.getpid():
+            self.reset()
+        key = self._limited_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._schedule_flush()
+
+    def observe(self, name, value, **labels):
+        """Add an observation of `value` to the histogram `name`."""
+        if self._pid != os.getpid():
+            self.reset()
+        key = self._limited_key(name, labels)
+        with self._lock:
+            # The counts of each bucket (not cumulative), then the sum.
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+        self._schedule_flush()
+
+    def snapshot(self):
+        """The values of the current process, as a JSON serializable dict."""
+        if self._pid != os.getpid():
+            self.reset()
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value]
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), list(values)]
+                               for (name, labels), values in self.histograms.items()],
+                }
+
+    def _schedule_flush(self):
+        if self.directory is not None and self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write the values of the current process in `directory`."""
+        timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            # An explicit flush makes the scheduled one useless.
+            timer.cancel()
+        if self.directory is None:
+            return
+        filename = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def files(directory):
+        return [filename for filename in glob.glob(os.path.join(glob.escape(directory), '*.json'))
+                if os.path.basename(filename)[:-len('.json')].isdigit()]
+
+    def collect(self):
+        """Sum the values of all processes.
+
+        Returns
+        -------
+        A pair of dicts ({(name, labels): value}, {(name, labels): histogram}).
+        """
+        snapshots = [self.snapshot()]
+        if self.directory is not None:
+            for filename in self.files(self.directory):
+                if filename == os.path.join(self.directory, '{}.json'.format(os.getpid())):
+                    continue
+                try:
+                    with open(filename) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    # The file has been removed, or is being written.
+                    continue
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = _key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = _key(name, labels)
+                if key in histograms:
+                    histograms[key] = [x + y for x, y in zip(histograms[key], values)]
+                else:
+                    histograms[key] = list(values)
+        return counters, histograms
+
+    def render(self):
+        """Render the values of all processes, in Prometheus' text format."""
+        counters, histograms = self.collect()
+        lines = []
+        for name, group in _group(counters):
+            lines.append('# TYPE {} counter'.format(name))
+            for labels, value in group:
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+        for name, group in _group(histograms):
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, values in group:
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(labels + (('le', _number(bound)),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(values[-1])))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _group(values):
+    """Group {(name, labels): value} by name, sorted."""
+    out = {}
+    for (name, labels), value in sorted(values.items()):
+        out.setdefault(name, []).append((labels, value))
+    return out.items()
+
+
+def _labels(labels):
+    if not len(labels):
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, re.sub(r'(["\\])', r'\\\1', str(value)).replace('\n', '\\n'))
+        for key, value in labels))
+
+
+def _number(value):
+    return value if isinstance(value, str) else repr(value)
+
+
+# The registry of this process.
+registry = MetricsRegistry()
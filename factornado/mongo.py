@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pymongo
+
+from factornado.utils import Executor
+from factornado.timing import timed
+
+factornado_logger = logging.getLogger('factornado')
+
+
+def index_model(spec):
+    """Create a `pymongo.IndexModel` from a declarative index spec.
+
+    Parameters
+    ----------
+    spec: dict
+        The index description. Key `keys` contains the indexed fields, either as
+        a list of [field, direction] pairs or as a dict {field: direction}.
+        Other keys are passed to `pymongo.IndexModel` (`name`, `unique`, `sparse`...).
+        Example: {'keys': [['task', 1], ['status', 1]], 'name': 'task_status'}
+    """
+    spec = dict(spec)
+    keys = spec.pop('keys')
+    if isinstance(keys, dict):
+        keys = list(keys.items())
+    return pymongo.IndexModel([tuple(key) for key in keys], **spec)
+
+
+def ensure_indexes(collection, specs):
+    """Create the indexes described by `specs` on a collection, if they do not exist yet.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+        The collection to index.
+    specs: list of dict
+        The index specs. See `index_model` for details.
+    """
+    if len(specs):
+        names = collection.create_indexes([index_model(spec) for spec in specs])
+        factornado_logger.info('Indexes ensured on %s: %s', collection.full_name, ', '.join(names))
+
+
+class MongoExecutor(Executor):
+    """Runs blocking pymongo calls in a pool of threads, so that they do not block the IOLoop.
+
+    Example:
+        doc = await self.application.mongo_executor.run(
+            self.application.mongo.tasks.find_one, {'_id': _id})
+
+    Parameters
+    ----------
+    max_workers: int, default 10
+        The maximum number of threads, i.e. of concurrent mongo calls, in each process.
+    """
+    def __init__(self, max_workers=10):
+        super(MongoExecutor, self).__init__(max_workers=max_workers, name='factornado-mongo')
+
+    def run(self, function, *args, **kwargs):
+        """Run `function(*args, **kwargs)` in the thread pool, in a `mongo` span."""
+        return super(MongoExecutor, self).run(timed, 'mongo', function, *args, **kwargs)
@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+"""
+Registry handlers
+-----------------
+
+Handlers to build a registry: services register themselves with heartbeats, and the
+registry proxies the requests to their instances.
+
+The registered instances are kept in an in-memory `ServiceTable`, configured in the
+`service_table` section of the registry's config:
+
+    service_table:
+        collection: registry_collection  # The mongo collection of registered instances.
+        ttl: 5                           # Seconds between two reloads of the collection.
+        max_age: 60                      # Instances without heartbeat for longer are evicted.
+        balancing: round_robin           # Or least_outstanding.
+
+The proxies' HTTP client (see `UpstreamClient`) is configured in the `proxy` section:
+
+    proxy:
+        max_clients: 100                 # Simultaneous requests per process.
+        max_connections_per_host: 20     # Simultaneous requests per instance.
+        curl: true                       # Use pycurl (with keep-alive) if installed.
+        connect_timeout: 5
+        request_timeout: 300
+"""
+
+import time
+import json
+import asyncio
+import logging
+import itertools
+
+import pymongo
+import pandas as pd
+from urllib.parse import urlsplit
+
+from tornado import web, httputil, httpclient, ioloop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient, _HTTPConnection
+
+from factornado.utils import SingleFlight
+
+
+class ServiceTable(object):
+    """An in-memory table of the instances registered in a mongo collection.
+
+    Parameters
+    ----------
+    collection: pymongo.Collection
+        The collection of registered instances {_id: url, name, id: timestamp, info}.
+    ttl: float, default 5
+        The number of seconds after which the table is reloaded from the collection.
+        Stale tables are still served while they are reloaded in the background.
+    max_age: float, default None
+        The number of seconds after which an instance without heartbeat is evicted.
+        If None, instances are never evicted.
+    balancing: str, default 'round_robin'
+        How instances are chosen: 'round_robin' or 'least_outstanding'
+        (the instance with the fewest pending requests in this process).
+    """
+    balancing_strategies = ['round_robin', 'least_outstanding']
+
+    def __init__(self, collection, ttl=5, max_age=None, balancing='round_robin'):
+        if balancing not in self.balancing_strategies:
+            raise ValueError('balancing must be one of {}.'.format(self.balancing_strategies))
+        self.collection = collection
+        self.ttl = ttl
+        self.max_age = max_age
+        self.balancing = balancing
+        self.instances = {}
+        self.fetched = None
+        self.outstanding = {}
+        self.counters = {}
+        self.single_flight = SingleFlight()
+
+    def is_alive(self, doc, now=None):
+        """Whether an instance's last heartbeat is recent enough."""
+        if self.max_age is None:
+            return True
+        now = pd.Timestamp.utcnow().value if now is None else now
+        return now - doc['id'] <= self.max_age * 1e9
+
+    def load(self):
+        """Load the table from the collection. This is a blocking call."""
+        now = pd.Timestamp.utcnow().value
+        instances = {}
+        for doc in self.collection.find(sort=[('id', -1)]):
+            if self.is_alive(doc, now=now):
+                instances.setdefault(doc['name'], []).append(doc)
+        self.instances = instances
+        self.fetched = time.time()
+        return instances
+
+    def register(self, doc):
+        """Add or update an instance in the table, after a heartbeat."""
+        others = [x for x in self.instances.get(doc['name'], []) if x['_id'] != doc['_id']]
+        self.instances[doc['name']] = [doc] + others
+
+    async def _load_in_background(self, executor):
+        try:
+            await self.single_flight.run('load', executor.run, self.load)
+        except Exception:
+            logging.getLogger('factornado').exception('[Registry] Cannot load service table')
+
+    async def refresh(self, executor):
+        """Reload the table if it is older than `ttl`.
+
+        Parameters
+        ----------
+        executor: factornado.utils.Executor
+            The pool of threads where the collection is read.
+        """
+        if self.fetched is None:
+            await self.single_flight.run('load', executor.run, self.load)
+        elif time.time() - self.fetched > self.ttl and 'load' not in self.single_flight.pending:
+            ioloop.IOLoop.current().spawn_callback(self._load_in_background, executor)
+
+    def get(self, name):
+        """Get the live instances of a service, most recent heartbeat first."""
+        now = pd.Timestamp.utcnow().value
+        return [doc for doc in self.instances.get(name, []) if self.is_alive(doc, now=now)]
+
+    def get_all(self):
+        """Get the live instances of all services: {name: [instances]}."""
+        return {name: docs for name, docs in ((name, self.get(name)) for name in self.instances)
+                if len(docs)}
+
+    def choose(self, name):
+        """Choose an instance of a service, or return None if there is none alive."""
+        docs = self.get(name)
+        if len(docs) == 0:
+            return None
+        # Sort by url, so that the round robin does not depend on heartbeats order.
+        docs = sorted(docs, key=lambda doc: doc['_id'])
+        counter = self.counters.setdefault(name, itertools.count())
+        start = next(counter)
+        docs = docs[start % len(docs):] + docs[:start % len(docs)]
+        if self.balancing == 'least_outstanding':
+            # `min` keeps the first of ties, in round robin order.
+            return min(docs, key=lambda doc: self.outstanding.get(doc['_id'], 0))
+        return docs[0]
+
+    def acquire(self, doc):
+        """Record that a request is pending on an instance."""
+        self.outstanding[doc['_id']] = self.outstanding.get(doc['_id'], 0) + 1
+
+    def release(self, doc):
+        """Record that a request on an instance is over."""
+        self.outstanding[doc['_id']] -= 1
+        if self.outstanding[doc['_id']] <= 0:
+            self.outstanding.pop(doc['_id'])
+
+
+def get_service_table(application):
+    """Get the application's `ServiceTable`, created from its `service_table` config."""
+    table = getattr(application, 'service_table', None)
+    if table is None:
+        config = application.config.get('service_table', {})
+        table = ServiceTable(
+            getattr(application.mongo, config.get('collection', 'registry_collection')),
+            ttl=config.get('ttl', 5),
+            max_age=config.get('max_age'),
+            balancing=config.get('balancing', 'round_robin'),
+            )
+        application.service_table = table
+    return table
+
+
+class UpstreamClient(object):
+    """The HTTP client used by the proxies to reach the services' instances.
+
+    Parameters
+    ----------
+    max_clients: int, default 100
+        The maximum number of simultaneous requests, in each process.
+    max_connections_per_host: int, default None
+        The maximum number of simultaneous requests to one instance, in each process.
+        If None, there is no limit but `max_clients`.
+    curl: bool, default False
+        Whether to use `curl_httpclient`, that keeps connections alive, if `pycurl` is
+        installed. Requests with a `body_producer` or a `streaming_callback` always use
+        `simple_httpclient`.
+    connect_timeout: float, default 20
+        The timeout for the connection to an instance, in seconds.
+    request_timeout: float, default 300
+        The timeout for a whole request, in seconds.
+    streaming_request_timeout: float, default 3600
+        The timeout for a whole request of `StreamingProxy`, in seconds.
+    max_body_size: int, default 100 * 2 ** 20
+        The maximal size of a response body buffered by `Proxy`, in bytes.
+    streaming_max_body_size: int, default 100 * 2 ** 30
+        The maximal size of a request or response body streamed by `StreamingProxy`,
+        in bytes.
+    """
+    def __init__(self, max_clients=100, max_connections_per_host=None, curl=False,
+                 connect_timeout=20, request_timeout=300, streaming_request_timeout=3600,
+                 max_body_size=100 * 2 ** 20, streaming_max_body_size=100 * 2 ** 30):
+        self.max_clients = max_clients
+        self.max_connections_per_host = max_connections_per_host
+        self.curl = curl and _has_pycurl()
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.streaming_request_timeout = streaming_request_timeout
+        self.max_body_size = max_body_size
+        self.streaming_max_body_size = streaming_max_body_size
+        self._clients = {}
+        self._semaphores = {}
+
+    def get_client(self, simple=False, streaming=False):
+        """Get the `AsyncHTTPClient` of the current IOLoop.
+
+        Parameters
+        ----------
+        simple: bool, default False
+            Whether to get a `simple_httpclient` even if `curl` is True.
+        streaming: bool, default False
+            Whether to get a `StreamingHTTPClient`, whose responses may be up to
+            `streaming_max_body_size` instead of `max_body_size`.
+        """
+        loop = ioloop.IOLoop.current()
+        curl = self.curl and not simple and not streaming
+        client = self._clients.get((loop, curl, streaming))
+        if client is None:
+            if streaming:
+                client = StreamingHTTPClient(force_instance=True, max_clients=self.max_clients,
+                                             max_body_size=self.streaming_max_body_size)
+            elif curl:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                client = CurlAsyncHTTPClient(force_instance=True, max_clients=self.max_clients,
+                                             max_body_size=self.max_body_size)
+            else:
+                client = SimpleAsyncHTTPClient(force_instance=True, max_clients=self.max_clients,
+                                               max_body_size=self.max_body_size)
+            self._clients[(loop, curl, streaming)] = client
+        return client
+
+    def _semaphore(self, request):
+        if self.max_connections_per_host is None:
+            return None
+        key = (ioloop.IOLoop.current(), urlsplit(request.url).netloc)
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_connections_per_host)
+            self._semaphores[key] = semaphore
+        return semaphore
+
+    async def fetch(self, request, **kwargs):
+        """Fetch a request, waiting for a free connection to its host if needed."""
+        if request.connect_timeout is None:
+            request.connect_timeout = self.connect_timeout
+        if request.request_timeout is None:
+            request.request_timeout = self.request_timeout
+        client = self.get_client(simple=request.body_producer is not None,
+                                 streaming=request.streaming_callback is not None)
+        semaphore = self._semaphore(request)
+        if semaphore is None:
+            return await client.fetch(request, **kwargs)
+        async with semaphore:
+            return await client.fetch(request, **kwargs)
+
+
+class _StreamingHTTPConnection(_HTTPConnection):
+    def data_received(self, chunk):
+        if self.request.streaming_callback is not None and not self._should_follow_redirect():
+            # The connection waits for the returned future, if any, before reading on.
+            return self.request.streaming_callback(chunk)
+        return super(_StreamingHTTPConnection, self).data_received(chunk)
+
+
+class StreamingHTTPClient(SimpleAsyncHTTPClient):
+    """A `simple_httpclient` whose `streaming_callback` may return a future: the next chunk
+    of the response is read once it is done."""
+    def _connection_class(self):
+        return _StreamingHTTPConnection
+
+
+def _has_pycurl():
+    try:
+        import pycurl  # noqa
+        return True
+    except ImportError:
+        return False
+
+
+def get_upstream_client(application):
+    """Get the application's `UpstreamClient`, created from its `proxy` config."""
+    client = getattr(application, 'upstream_client', None)
+    if client is None:
+        client = UpstreamClient(**application.config.get('proxy', {}))
+        application.upstream_client = client
+    return client
+
+
+class Register(web.RequestHandler):
+    """Register a new service."""
+    swagger = {
+        "/{name}/{uri}": {
+            "get": {
+                "description": "Lists the instances of a service that have been registered.",
+                "parameters": [],
+                "responses": {
+                    200: {"description": "OK"},
+                    401: {"description": "Unauthorized"},
+                    403: {"description": "Forbidden"},
+                    404: {"description": "Not Found"},
+                }
+            },
+            "post": {
+                "description": "Registers an instance of a service.",
+                "parameters": [],
+                "responses": {
+                    200: {"description": "OK"},
+                    401: {"description": "Unauthorized"},
+                    403: {"description": "Forbidden"},
+                    404: {"description": "Not Found"},
+                }
+            }
+        }
+    }
+
+    async def post(self, name=None):
+        """Register an instance, or record its heartbeat.
+
+        The body is either a full registration {url, hash, config, ...}, or a liveness
+        ping {url, hash}. A ping only updates the heartbeat timestamp ; it is answered with
+        `config_needed` if the instance is not registered with this config hash.
+        """
+        body = json.loads(self.request.body.decode('utf-8'))
+        if 'url' not in body:
+            raise web.HTTPError(500, 'body must at least contain `url`.')
+        url = body.pop('url')
+        config_hash = body.pop('hash', None)
+        table = get_service_table(self.application)
+        now = pd.Timestamp.utcnow().value
+
+        if config_hash is not None and len(body) == 0:
+            # This is a ping.
+            doc = await self.application.mongo_executor.run(
+                table.collection.find_one_and_update,
+                {'_id': url, 'name': name, 'hash': config_hash},
+                {'$set': {'id': now}},
+                return_document=pymongo.ReturnDocument.AFTER)
+            if doc is None:
+                self.write('config_needed')
+                return
+        else:
+            doc = {'id': now,
+                   '_id': url,
+                   'name': name,
+                   'hash': config_hash,
+                   'info': body,
+                   }
+            await self.application.mongo_executor.run(
+                table.collection.replace_one, {'_id': doc['_id']}, doc, upsert=True)
+        table.register(doc)
+        self.write('ok')
+
+    async def get(self, name=None):
+        table = get_service_table(self.application)
+        await table.refresh(self.application.mongo_executor)
+        self.write({name: table.get(name)})
+
+
+class GetAll(web.RequestHandler):
+    """Get the list of all registered services."""
+    swagger = {
+        "/{name}/{uri}": {
+            "get": {
+                "description": "Lists the instances of all services that have been registered.",
+                "parameters": [],
+                "responses": {
+                    200: {"description": "OK"},
+                    401: {"description": "Unauthorized"},
+                    403: {"description": "Forbidden"},
+                    404: {"description": "Not Found"},
+                }
+            }
+        }
+    }
+
+    async def get(self):
+        table = get_service_table(self.application)
+        await table.refresh(self.application.mongo_executor)
+        self.write(table.get_all())
+
+
+class Proxy(web.RequestHandler):
+    """Proxy the requests `/{name}/{uri}` to an instance of the service `name`."""
+    async def choose_instance(self, name):
+        """Choose the instance of service `name` to send the request to."""
+        table = get_service_table(self.application)
+        await table.refresh(self.application.mongo_executor)
+        conf = table.choose(name)
+        if conf is None:
+            raise web.HTTPError(500, reason='Service {} not known.'.format(name))
+        if conf.get('_id', None) is None:
+            raise web.HTTPError(500, reason='Service {} has no url.'.format(name))
+        return conf
+
+    def upstream_request(self, conf, method, name, **kwargs):
+        """Build the request to send to the instance `conf`.
+
+        Parameters
+        ----------
+        **kwargs:
+            Extra arguments for `httpclient.HTTPRequest`.
+        """
+        url = conf['_id']
+        user = conf.get('info', {}).get('user', None)
+        password = conf.get('info', {}).get('password', None)
+
+        # Parse the uri.
+        uri = self.request.uri[1:]
+        if not uri.startswith(name):
+            raise web.HTTPError(
+                500,
+                reason='Uri {} does not start with {}.'.format(uri, name))
+        uri = uri[len(name):]
+
+        return httpclient.HTTPRequest(
+            url + uri,
+            method=method,
+            headers=httputil.HTTPHeaders({
+                k: v for k, v in self.request.headers.get_all()
+                if k.lower() not in ['host', 'transfer-encoding']
+                }),
+            auth_username=user,
+            auth_password=password,
+            allow_nonstandard_methods=True,
+            validate_cert=False,
+            **kwargs)
+
+    async def redirection(self, method, name):
+        conf = await self.choose_instance(name)
+        request = self.upstream_request(conf, method, name, body=self.request.body)
+
+        # Proxy the request.
+        table = get_service_table(self.application)
+        table.acquire(conf)
+        try:
+            return await get_upstream_client(self.application).fetch(request)
+        finally:
+            table.release(conf)
+
+    async def get(self, name, uri=''):
+        response = await self.redirection('GET', name)
+        self.on_response(response)
+
+    async def post(self, name, uri=''):
+        response = await self.redirection('POST', name)
+        self.on_response(response)
+
+    async def put(self, name, uri=''):
+        response = await self.redirection('PUT', name)
+        self.on_response(response)
+
+    async def delete(self, name, uri=''):
+        response = await self.redirection('DELETE', name)
+        self.on_response(response)
+
+    def on_response(self, response):
+        if response.code == 304:
+            self.set_status(304)
+            return
+
+        if response.error is not None:
+            raise web.HTTPError(response.code, reason=response.reason)
+
+        self.set_status(response.code)
+
+        for key, val in response.headers.get_all():
+            if key not in ['Transfer-Encoding', 'Content-Encoding']:
+                self.add_header(key, val)
+
+        if response.body:
+            self.write(response.body)
+
+
+@web.stream_request_body
+class StreamingProxy(Proxy):
+    """Proxy the requests `/{name}/{uri}` to an instance of the service `name`,
+    streaming the bodies instead of buffering them.
+
+    The request body is piped to the instance through a queue of at most
+    `max_buffered_chunks` chunks: the client is not read faster than the instance reads.
+    The response body is written to the client chunk by chunk, as it is received ; the
+    next chunk is read from the instance once the former is sent to the client.
+    """
+    max_buffered_chunks = 16
+
+    async def prepare(self):
+        client = get_upstream_client(self.application)
+        self.request.connection.set_max_body_size(client.streaming_max_body_size)
+        self.chunks = asyncio.Queue(maxsize=self.max_buffered_chunks)
+        self.response_headers = []
+
+        name = self.path_args[0]
+        conf = await self.choose_instance(name)
+        if self.request.method in ['POST', 'PUT', 'PATCH']:
+            kwargs = {'body_producer': self.body_producer}
+        else:
+            kwargs = {}
+        request = self.upstream_request(
+            conf, self.request.method, name,
+            header_callback=self.on_header_line,
+            streaming_callback=self.on_chunk,
+            follow_redirects=False,
+            decompress_response=False,
+            request_timeout=client.streaming_request_timeout,
+            **kwargs)
+
+        table = get_service_table(self.application)
+        table.acquire(conf)
+        self.upstream = asyncio.ensure_future(client.fetch(request, raise_error=False))
+        self.upstream.add_done_callback(lambda future: table.release(conf))
+        self.upstream.add_done_callback(self._discard_chunks)
+
+    async def body_producer(self, write):
+        while True:
+            chunk = await self.chunks.get()
+            if chunk is None:
+                break
+            await write(chunk)
+
+    async def data_received(self, chunk):
+        if not self.upstream.done():
+            # This waits if the instance is slower than the client.
+            await self.chunks.put(chunk)
+
+    def _discard_chunks(self, future):
+        # If the upstream request ended before the body was sent, no one reads the queue.
+        while not self.chunks.empty():
+            self.chunks.get_nowait()
+
+    def on_header_line(self, line):
+        line = line.rstrip('\r\n')
+        if line.startswith('HTTP/'):
+            # The response may start with `100 Continue` ; only the last start line is kept.
+            self.response_headers = [line]
+        elif line:
+            self.response_headers.append(line)
+        else:
+            self.on_headers()
+
+    def on_headers(self):
+        start_line = httputil.parse_response_start_line(self.response_headers[0])
+        if start_line.code == 100:
+            return
+        headers = httputil.HTTPHeaders()
+        for line in self.response_headers[1:]:
+            headers.parse_line(line)
+        self.set_status(start_line.code, reason=start_line.reason)
+        for key in set(headers.keys()):
+            self.clear_header(key)
+        for key, val in headers.get_all():
+            if key not in ['Transfer-Encoding', 'Connection']:
+                self.add_header(key, val)
+
+    def on_chunk(self, chunk):
+        self.write(chunk)
+        return self.flush()
+
+    async def proxy(self):
+        await self.chunks.put(None)
+        response = await self.upstream
+        if response.code == 599:
+            raise web.HTTPError(502, reason='Bad Gateway')
+
+    async def get(self, name, uri=''):
+        await self.proxy()
+
+    async def post(self, name, uri=''):
+        await self.proxy()
+
+    async def put(self, name, uri=''):
+        await self.proxy()
+
+    async def patch(self, name, uri=''):
+        await self.proxy()
+
+    async def delete(self, name, uri=''):
+        await self.proxy()
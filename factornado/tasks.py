@@ -1,15 +1,544 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
 import json
+import time
+import itertools
+import collections
 import bson
 import pymongo
 import logging
 
 from tornado import web, escape
-from factornado.utils import SwaggerPath, tansform_bson_id
+from factornado.utils import SwaggerPath, tansform_bson_id, has_changed
+from factornado.metrics import registry as metrics_registry
 
 factornado_logger = logging.getLogger('factornado')
 
+# The indexes required by the handlers of this module on the `tasks` collection.
+INDEXES = [
+    {'keys': [['task', 1], ['status', 1], ['priority', -1], ['ldt', 1]]},
+    {'keys': [['task', 1], ['key', 1]]},
+    ]
+
+
+def empty_task(task, key):
+    """The document of a task that does not exist (yet)."""
+    return {
+        '_id': '/'.join([task, key]),
+        'id': None,
+        'task': task,
+        'key': key,
+        'status': 'none',
+        'data': {},
+        'statusSince': None,
+        'try': 0,
+        'priority': 0,
+        }
+
+
+def next_task(before, actions, action, data=None, priority=None):
+    """Compute the task document resulting from applying an action.
+
+    Parameters
+    ----------
+    before: dict
+        The task document before the action.
+    actions: dict
+        The state machine: for each action, a dict {status_before: status_after}.
+    action: str
+        The action to perform.
+    data: dict, default None
+        Data to be merged into the task's data.
+    priority: int, default None
+        The new priority of the task. If None, the former one is kept.
+
+    Returns
+    -------
+    The task document after the action. Its `id` is left unchanged.
+    Raises `web.HTTPError(411)` if the action cannot be performed.
+    """
+    if action not in actions:
+        raise web.HTTPError(
+            411,
+            reason="Action '{}' not understood. Expect {}.".format(
+                action, '|'.join(actions)))
+    next_status = actions[action].get(before['status'])
+    if next_status is None:
+        raise web.HTTPError(
+            411,
+            reason="Action '{}' cannot be performed on status '{}'.".format(
+                action, before['status']))
+    return {
+        '_id': before['_id'],
+        'id': before['id'],
+        'task': before['task'],
+        'key': before['key'],
+        'status': next_status,
+        'data': dict(before['data'], **(data or {})),
+        'statusSince': (
+            before['statusSince'] if next_status == before['status']
+            else pd.Timestamp.utcnow().value),
+        'try': before['try'] + (action == 'error'),
+        'priority': priority if priority is not None else before.get('priority')
+        }
+
+
+def perform_action(collection, actions, task, key, action, data=None, priority=None):
+    """Apply an action on a task, following the state machine described in `actions`.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+        The tasks collection.
+    actions: dict
+        The state machine: for each action, a dict {status_before: status_after}.
+    task: str
+        The task category.
+    key: str
+        The task key.
+    action: str
+        The action to perform.
+    data: dict, default None
+        Data to be merged into the task's data.
+    priority: int, default None
+        The new priority of the task. If None, the former one is kept.
+
+    Returns
+    -------
+    A dict {'changed', 'before', 'after'}, or None if the action is `assign`
+    and someone assigned the task before.
+    Raises `web.HTTPError(411)` if the action cannot be performed.
+    """
+    action = action.lower()
+    _id = '/'.join([task, key])
+
+    while True:
+        before = collection.find_one({'_id': _id})
+        if before is None:
+            before = empty_task(task, key)
+
+        after = next_task(before, actions, action, data=data, priority=priority)
+
+        changed = has_changed(before, after)
+        if changed:
+            if after['status'] == 'none':
+                change = collection.delete_one({'_id': _id, 'id': before['id']})
+                count = change.deleted_count
+                assert change.raw_result['ok']
+            elif before['status'] == 'none':
+                factornado_logger.debug('Will insert')
+                after['id'] = bson.ObjectId()
+                try:
+                    collection.insert_one(after)
+                    count = 1
+                except pymongo.errors.DuplicateKeyError:
+                    count = 0
+            else:
+                after['id'] = bson.ObjectId()
+                change = collection.replace_one(
+                    {'_id': _id, 'id': before['id']}, after, upsert=False)
+                count = change.modified_count
+                assert change.raw_result['ok']
+
+            if count == 0:
+                # Someone came before
+                metrics_registry.inc('factornado_task_conflicts_total', task=task, action=action)
+                if action == 'assign':
+                    # Cannot assign the task if someone came before.
+                    return None
+                else:
+                    # You can perform the action ; let's try again.
+                    pass
+            else:
+                # We got the right to write
+                break
+        else:
+            # We had nothing to write
+            break
+
+    return {'changed': changed,
+            'before': tansform_bson_id(before),
+            'after': tansform_bson_id(after)}
+
+
+def action_pipeline(transitions, task, key, action, data, priority, now, new_id):
+    """Compile an action into an update pipeline, that applies it on the server side.
+
+    Parameters
+    ----------
+    transitions: dict
+        The transitions of the action {status_before: status_after}, without deletions.
+    task, key, action, data, priority:
+        See `perform_action`.
+    now: int
+        The timestamp to set in `statusSince` if the status changes.
+    new_id: bson.ObjectId
+        The `id` to set if the task changes.
+    """
+    stages = [
+        {'$set': {'_before': {
+            'status': {'$ifNull': ['$status', 'none']},
+            'data': {'$ifNull': ['$data', {}]},
+            'try': {'$ifNull': ['$try', 0]},
+            'priority': {'$ifNull': ['$priority', 0]},
+            }}},
+        {'$set': {
+            'task': {'$literal': task},
+            'key': {'$literal': key},
+            'status': {'$switch': {
+                'branches': [{'case': {'$eq': ['$_before.status', before]},
+                              'then': {'$literal': after}}
+                             for before, after in transitions.items()],
+                'default': '$_before.status',
+                }},
+            'data': '$_before.data',
+            'try': {'$add': ['$_before.try', int(action == 'error')]},
+            'priority': '$_before.priority' if priority is None else {'$literal': priority},
+            }},
+        ]
+    if len(data):
+        stages.append({'$set': {'data.' + k: {'$literal': v} for k, v in data.items()}})
+    stages += [
+        {'$set': {'_changed': {'$or': [
+            {'$ne': ['$' + field, '$_before.' + field]}
+            for field in ['status', 'data', 'try', 'priority']]}}},
+        {'$set': {
+            'id': {'$cond': ['$_changed', new_id, '$id']},
+            'statusSince': {'$cond': [{'$eq': ['$status', '$_before.status']},
+                                      '$statusSince', now]},
+            }},
+        {'$project': {'_before': 0, '_changed': 0}},
+        ]
+    return stages
+
+
+def perform_action_atomic(collection, actions, task, key, action, data=None, priority=None):
+    """Apply an action on a task, like `perform_action`, but on the server side.
+
+    The action is compiled into a conditional `find_one_and_update` (or `find_one_and_delete`
+    for transitions to `none`), so that the transition is performed in one atomic round trip,
+    without optimistic-concurrency retries. Requires MongoDB >= 4.2.
+
+    Parameters and returned value are the same as `perform_action`'s, except that there is
+    no assignment conflict: an action is always applied on the task's current status, and
+    raises `web.HTTPError(411)` if this status does not allow it.
+    """
+    action = action.lower()
+    data = data or {}
+    if action not in actions:
+        raise web.HTTPError(
+            411,
+            reason="Action '{}' not understood. Expect {}.".format(
+                action, '|'.join(actions)))
+    if any('.' in k or k.startswith('$') for k in data):
+        # Such keys cannot be set in an update pipeline.
+        return perform_action(collection, actions, task, key, action, data=data,
+                              priority=priority)
+
+    _id = '/'.join([task, key])
+    updates = {before: after for before, after in actions[action].items() if after != 'none'}
+    deletes = [before for before, after in actions[action].items()
+               if after == 'none' and before != 'none']
+
+    while True:
+        now = pd.Timestamp.utcnow().value
+        new_id = bson.ObjectId()
+        before = None
+        if len(updates):
+            try:
+                before = collection.find_one_and_update(
+                    {'_id': _id, 'status': {'$in': list(updates)}},
+                    action_pipeline(updates, task, key, action, data, priority, now, new_id),
+                    upsert='none' in updates,
+                    return_document=pymongo.ReturnDocument.BEFORE,
+                    )
+            except pymongo.errors.DuplicateKeyError:
+                # The task exists, but its status is not concerned by these transitions.
+                pass
+            else:
+                if before is None and 'none' in updates:
+                    # The task has been created.
+                    before = empty_task(task, key)
+        if before is None and len(deletes):
+            before = collection.find_one_and_delete({'_id': _id, 'status': {'$in': deletes}})
+
+        if before is None:
+            # No transition could be applied: we find out why.
+            before = collection.find_one({'_id': _id}) or empty_task(task, key)
+            after = next_task(before, actions, action, data=data, priority=priority)
+            if has_changed(before, after):
+                # The task has changed in the meantime ; let's try again.
+                metrics_registry.inc('factornado_task_conflicts_total', task=task, action=action)
+                continue
+
+        after = next_task(before, actions, action, data=data, priority=priority)
+        changed = has_changed(before, after)
+        if changed and after['status'] != 'none':
+            after['id'] = new_id
+            if after['status'] != before['status']:
+                after['statusSince'] = now
+        return {'changed': changed,
+                'before': tansform_bson_id(before),
+                'after': tansform_bson_id(after)}
+
+
+def perform_actions(collection, actions, items):
+    """Apply a list of actions, with one bulk write.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+        The tasks collection.
+    actions: dict
+        The state machine: for each action, a dict {status_before: status_after}.
+    items: list of dict
+        The actions to perform. Each one is a dict with keys
+        `task`, `key`, `action`, `data` and `priority`.
+
+    Returns
+    -------
+    A list with a result for each item: a dict {'ok', 'changed', 'before', 'after'}
+    if the action has been performed, {'ok': False, 'reason'} otherwise.
+    """
+    ids = ['/'.join([item['task'], item['key']]) for item in items]
+    persisted = {doc['_id']: doc for doc in collection.find({'_id': {'$in': list(set(ids))}})}
+
+    # We apply the actions in memory.
+    current = dict(persisted)
+    results = []
+    for _id, item in zip(ids, items):
+        before = current.get(_id)
+        if before is None or before['status'] == 'none':
+            # As in `perform_action`, a deleted task starts again from scratch.
+            before = empty_task(item['task'], item['key'])
+        try:
+            after = next_task(before, actions, item['action'].lower(),
+                              data=item['data'], priority=item['priority'])
+        except web.HTTPError as e:
+            results.append({'ok': False, 'reason': e.reason})
+            continue
+        changed = has_changed(before, after)
+        if changed:
+            after['id'] = bson.ObjectId()
+            current[_id] = after
+        results.append({'ok': True,
+                        'changed': changed,
+                        'before': tansform_bson_id(before),
+                        'after': tansform_bson_id(after)})
+
+    # We write the final state of each task.
+    # A replacement is an upsert: if the task has changed in the meantime, its filter does
+    # not match, and the insertion fails on the duplicate `_id`. Deletions are performed
+    # one by one, as a bulk write does not tell which ones matched.
+    writes, deletes = {}, {}
+    for _id, after in current.items():
+        before = persisted.get(_id)
+        if after is before:
+            continue
+        elif after['status'] == 'none':
+            if before is not None:
+                deletes[_id] = before['id']
+        elif before is None:
+            writes[_id] = pymongo.InsertOne(after)
+        else:
+            writes[_id] = pymongo.ReplaceOne({'_id': _id, 'id': before['id']}, after,
+                                             upsert=True)
+
+    conflicts = set()
+    if len(writes):
+        try:
+            upserted = collection.bulk_write(list(writes.values()),
+                                             ordered=False).upserted_ids.values()
+        except pymongo.errors.BulkWriteError as e:
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+            # Someone came before for these tasks.
+            conflicts.update(list(writes)[error['index']] for error in e.details['writeErrors'])
+            upserted = [doc['_id'] for doc in e.details['upserted']]
+        for _id in upserted:
+            if _id in persisted:
+                # The task has been deleted in the meantime: we take our write back.
+                collection.delete_one({'_id': _id, 'id': current[_id]['id']})
+                conflicts.add(_id)
+    for _id, version in deletes.items():
+        if collection.delete_one({'_id': _id, 'id': version}).deleted_count == 0:
+            conflicts.add(_id)
+
+    # We perform again the actions on these tasks, one by one.
+    for i, (_id, item) in enumerate(zip(ids, items)):
+        if _id in conflicts and results[i]['ok']:
+            metrics_registry.inc('factornado_task_conflicts_total', task=item['task'],
+                                 action=item['action'].lower())
+            result = perform_action(collection, actions, item['task'], item['key'],
+                                    item['action'], data=item['data'],
+                                    priority=item['priority'])
+            results[i] = (
+                {'ok': False, 'reason': 'No task to do'} if result is None
+                else dict(result, ok=True))
+    return results
+
+
+def force_status(collection, task, key, status, data=None, priority=None):
+    """Set the status of a task, whatever its current status.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+        The tasks collection.
+    task: str
+        The task category.
+    key: str
+        The task key.
+    status: str
+        The status to set.
+    data: dict, default None
+        Data to be merged into the task's data.
+    priority: int, default None
+        The new priority of the task. If None, the former one is kept.
+
+    Returns
+    -------
+    A dict {'changed', 'before', 'after'}.
+    """
+    _id = '/'.join([task, key])
+    before = collection.find_one({'_id': _id})
+    if before is None:
+        before = empty_task(task, key)
+
+    after = {
+        '_id': _id,
+        'id': before['id'],
+        'task': task,
+        'key': key,
+        'status': status,
+        'data': dict(before['data'], **(data or {})),
+        'statusSince': (
+            before['statusSince'] if status == before['status']
+            else pd.Timestamp.utcnow().value),
+        'try': before['try'],
+        'priority': priority if priority is not None else before.get('priority')
+        }
+    changed = has_changed(before, after)
+
+    if changed:
+        if after['status'] == 'none':
+            change = collection.delete_one({'_id': _id})
+        else:
+            after['id'] = bson.ObjectId()
+            change = collection.replace_one({'_id': _id}, after, upsert=True)
+        assert change.raw_result['ok']
+
+    return {'changed': changed,
+            'before': tansform_bson_id(before),
+            'after': tansform_bson_id(after)}
+
+
+def get_stats(collection, task=None):
+    """Count the tasks in each status, with one aggregation.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+        The tasks collection.
+    task: str, default None
+        The task category. If None, all categories are counted.
+
+    Returns
+    -------
+    A dict {task: {status: {'count': int, 'oldestStatusSince': int}}}.
+    """
+    pipeline = [] if task is None else [{'$match': {'task': task}}]
+    pipeline.append({'$group': {
+        '_id': {'task': '$task', 'status': '$status'},
+        'count': {'$sum': 1},
+        'oldestStatusSince': {'$min': '$statusSince'},
+        }})
+    out = {}
+    for doc in collection.aggregate(pipeline):
+        out.setdefault(doc['_id']['task'], {})[doc['_id']['status']] = {
+            'count': doc['count'],
+            'oldestStatusSince': doc['oldestStatusSince'],
+            }
+    return out
+
+
+def assign_one(collection, task):
+    """Pick the next `todo` task of a category and assign it, in one atomic operation.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+        The tasks collection.
+    task: str
+        The task category.
+
+    Returns
+    -------
+    The task document as it was before assignment, or None if there was no task to do.
+    """
+    return collection.find_one_and_update(
+        {'status': 'todo', 'task': task},
+        {'$set': {
+            'status': 'doing',
+            'statusSince': pd.Timestamp.utcnow().value,
+            'id': bson.ObjectId(),
+            }},
+        sort=[('priority', -1), ('ldt', 1)],
+        return_document=pymongo.ReturnDocument.BEFORE,
+        )
+
+
+def assign_many(collection, task, n):
+    """Pick up to `n` `todo` tasks of a category and assign them.
+
+    Each task is assigned atomically: a task is returned only if it has not
+    changed since it was read, so that it cannot be assigned twice.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+        The tasks collection.
+    task: str
+        The task category.
+    n: int
+        The maximum number of tasks to assign.
+
+    Returns
+    -------
+    The list of task documents, as they were before assignment.
+    """
+    out = []
+    while len(out) < n:
+        todos = list(collection.find(
+            {'status': 'todo', 'task': task},
+            sort=[('priority', -1), ('ldt', 1)],
+            limit=n - len(out)))
+        if len(todos) == 0:
+            # There is no more task to do.
+            break
+
+        # We assign all the tasks that have not changed since we read them.
+        claim_id = bson.ObjectId()
+        collection.update_many(
+            {'$or': [{'_id': todo['_id'], 'id': todo['id']} for todo in todos]},
+            {'$set': {
+                'status': 'doing',
+                'statusSince': pd.Timestamp.utcnow().value,
+                'id': claim_id,
+                }})
+        claimed = {doc['_id'] for doc in collection.find(
+            {'_id': {'$in': [todo['_id'] for todo in todos]}, 'id': claim_id},
+            projection=['_id'])}
+        out += [todo for todo in todos if todo['_id'] in claimed]
+
+        if len(claimed) == len(todos):
+            # We got all the tasks we asked for.
+            break
+        metrics_registry.inc('factornado_task_conflicts_total', len(todos) - len(claimed),
+                             task=task, action='assign')
+        # Otherwise, someone came before for some tasks ; let's try to get others.
+    return out
+
 
 class Action(web.RequestHandler):
     swagger = {
@@ -74,7 +603,19 @@ class Action(web.RequestHandler):
         }
     }
 
-    def put(self, task, key, action):
+    mongo_indexes = {'tasks': INDEXES}
+
+    def initialize(self, atomic=False):
+        """
+        Parameters
+        ----------
+        atomic: bool, default False
+            Whether actions are performed on the server side, in one atomic round trip
+            (see `perform_action_atomic`). Requires MongoDB >= 4.2.
+        """
+        self.atomic = atomic
+
+    async def put(self, task, key, action):
 
         # Parse arguments
         priority = self.get_argument('priority', None)
@@ -92,93 +633,109 @@ class Action(web.RequestHandler):
                 501,
                 reason="Bytes `{}...` are not JSON serializable".format(self.request.body[:30]))
 
-        action = action.lower()
-        if action not in self.application.config['actions']:
-            raise web.HTTPError(
-                411,
-                reason="Action '{}' not understood. Expect {}.".format(
-                    action, '|'.join(self.application.config['actions'])))
-        _id = '/'.join([task, key])
-
-        while True:
-            before = self.application.mongo.tasks.find_one({'_id': _id})
-            if before is None:
-                before = {
-                    '_id': _id,
-                    'id': None,
-                    'task': task,
-                    'key': key,
-                    'status': 'none',
-                    'data': {},
-                    'statusSince': None,
-                    'try': 0,
-                    'priority': 0,
+        out = await self.application.mongo_executor.run(
+            perform_action_atomic if self.atomic else perform_action,
+            self.application.mongo.tasks, self.application.config['actions'],
+            task, key, action, data=data, priority=priority)
+        if out is None:
+            # Cannot assign the task if someone came before.
+            self.set_status(204, reason='No task to do')
+        else:
+            metrics_registry.inc('factornado_task_actions_total', task=task,
+                                 action=action.lower())
+            self.write(out)
+
+
+class Actions(web.RequestHandler):
+    swagger = {
+        "/{name}/{uri}": {
+            "put": {
+                "description": "Apply several actions in one request.",
+                "parameters": [],
+                "requestBody": {
+                    "description": (
+                        "The list of actions to perform. Each one is either an object "
+                        "{task, key, action, data, priority} or an array [task, key, action, data]."
+                        ),
+                    "content": {
+                        "application/json": {
+                            "schema": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "task": {"type": "string"},
+                                        "key": {"type": "string"},
+                                        "action": {
+                                            "type": "string",
+                                            "enum": ["delete", "assign", "success", "stack",
+                                                     "error"],
+                                        },
+                                        "data": {"type": "object"},
+                                        "priority": {"type": "integer"},
+                                    }
+                                }
+                            }
+                        }
                     }
+                },
+                "responses": {
+                    200: {"description": "OK"},
+                    401: {"description": "Unauthorized"},
+                    403: {"description": "Forbidden"},
+                    404: {"description": "Not Found"},
+                }
+            }
+        }
+    }
+
+    mongo_indexes = {'tasks': INDEXES}
+
+    def parse_body(self):
+        """Parse the request body into a list of dicts {task, key, action, data, priority}."""
+        try:
+            body = escape.json_decode(self.request.body) if len(self.request.body) else []
+        except Exception:
+            raise web.HTTPError(
+                501,
+                reason="Bytes `{}...` are not JSON serializable".format(self.request.body[:30]))
+        if not isinstance(body, list):
+            raise web.HTTPError(409, reason='Body must be a list of actions.')
 
-            next_status = self.application.config['actions'][action].get(before['status'])
-            if next_status is None:
+        items = []
+        for item in body:
+            if isinstance(item, list):
+                item = dict(zip(['task', 'key', 'action', 'data'], item))
+            elif not isinstance(item, dict):
+                raise web.HTTPError(409, reason='Each action must be a dict or a list.')
+            if not {'task', 'key', 'action'}.issubset(item):
                 raise web.HTTPError(
-                    411,
-                    reason="Action '{}' cannot be performed on status '{}'.".format(
-                        action, before['status']))
-            after = {
-                '_id': _id,
-                'id': before['id'],
-                'task': task,
-                'key': key,
-                'status': next_status,
-                'data': dict(before['data'].copy(), **data),
-                'statusSince': (
-                    before['statusSince'] if next_status == before['status']
-                    else pd.Timestamp.utcnow().value),
-                'try': before['try'] + (action == 'error'),
-                'priority': priority if priority is not None else before.get('priority')
-                }
+                    409, reason='Each action must contain at least `task`, `key` and `action`.')
+            if not all(isinstance(item[field], str) for field in ['task', 'key', 'action']):
+                raise web.HTTPError(409, reason='`task`, `key` and `action` must be strings.')
+            if not isinstance(item.get('data') or {}, dict):
+                raise web.HTTPError(409, reason='`data` must be a dict.')
+            items.append({
+                'task': item['task'],
+                'key': item['key'],
+                'action': item['action'].lower(),
+                'data': item.get('data') or {},
+                'priority': item.get('priority'),
+                })
+        return items
 
-            changed = (json.dumps(tansform_bson_id(before), sort_keys=True) !=
-                       json.dumps(tansform_bson_id(after), sort_keys=True))
-            if changed:
-                if after['status'] == 'none':
-                    change = self.application.mongo.tasks.delete_one({'_id': _id,
-                                                                      'id': before['id']})
-                    count = change.deleted_count
-                    assert change.raw_result['ok']
-                elif before['status'] == 'none':
-                    factornado_logger.debug('Will insert')
-                    after['id'] = bson.ObjectId()
-                    try:
-                        self.application.mongo.tasks.insert_one(after)
-                        count = 1
-                    except pymongo.errors.DuplicateKeyError:
-                        count = 0
-                else:
-                    after['id'] = bson.ObjectId()
-                    change = self.application.mongo.tasks.replace_one(
-                        {'_id': _id, 'id': before['id']}, after, upsert=False)
-                    count = change.modified_count
-                    assert change.raw_result['ok']
-
-                if count == 0:
-                    # Someone came before
-                    if action == 'assign':
-                        # Cannot assign the task if someone came before.
-                        self.set_status(204, reason='No task to do')
-                    else:
-                        # You can perform the action ; let's try again.
-                        pass
-                else:
-                    # We got the right to write
-                    self.write({
-                            'changed': changed,
-                            'before': tansform_bson_id(before),
-                            'after': tansform_bson_id(after)})
-                    break
-            else:
-                # We had nothing to write
-                self.write({'changed': changed,
-                            'before': tansform_bson_id(before),
-                            'after': tansform_bson_id(after)})
-                break
+    async def put(self):
+        items = self.parse_body()
+        results = await self.application.mongo_executor.run(
+            perform_actions, self.application.mongo.tasks, self.application.config['actions'],
+            items)
+        for item, result in zip(items, results):
+            if result['ok']:
+                metrics_registry.inc('factornado_task_actions_total', task=item['task'],
+                                     action=item['action'].lower())
+        self.write(pd.io.json.dumps([
+            dict(result, task=item['task'], key=item['key'], action=item['action'])
+            for item, result in zip(items, results)]))
 
 
 class Force(web.RequestHandler):
@@ -244,7 +801,9 @@ class Force(web.RequestHandler):
         }
     }
 
-    def put(self, task, key, status):
+    mongo_indexes = {'tasks': INDEXES}
+
+    async def put(self, task, key, status):
         # Parse arguments
         priority = self.get_argument('priority', None)
         if priority is not None:
@@ -267,56 +826,57 @@ class Force(web.RequestHandler):
                 411,
                 reason="Status '{}' not understood. Expect {}.".format(
                     status, '|'.join(self.application.config['actions']['delete'])))
-        _id = '/'.join([task, key])
-        before = self.application.mongo.tasks.find_one({'_id': _id})
-        if before is None:
-            before = {
-                '_id': _id,
-                'id': None,
-                'task': task,
-                'key': key,
-                'status': 'none',
-                'data': {},
-                'statusSince': None,
-                'try': 0,
-                'priority': 0,
-                }
+        self.write(await self.application.mongo_executor.run(
+            force_status, self.application.mongo.tasks, task, key, status,
+            data=data, priority=priority))
+
 
-        after = {
-            '_id': _id,
-            'id': before['id'],
-            'task': task,
-            'key': key,
-            'status': status,
-            'data': dict(before['data'].copy(), **data),
-            'statusSince': (
-                before['statusSince'] if status == before['status']
-                else pd.Timestamp.utcnow().value),
-            'try': before['try'],
-            'priority': priority if priority is not None else before.get('priority')
+class AssignOne(web.RequestHandler):
+    swagger = {
+        SwaggerPath("/{name}/{uri}/{{task}}"): {
+            "put": {
+                "description": "Pick a task that has not been done yet, and assign it.",
+                "parameters": [
+                    {
+                        "in": "path",
+                        "name": "task",
+                        "required": True,
+                        "description": "The task category.",
+                        "schema": {
+                            "type": "string",
+                            "default": "someTask"
+                        }
+                    }
+                ],
+                "responses": {
+                    200: {"description": "OK"},
+                    204: {"description": "No task to do"},
+                    401: {"description": "Unauthorized"},
+                    403: {"description": "Forbidden"},
+                    404: {"description": "Not Found"},
+                }
             }
-        changed = (json.dumps(tansform_bson_id(before), sort_keys=True) !=
-                   json.dumps(tansform_bson_id(after), sort_keys=True))
+        }
+    }
 
-        if changed:
-            if after['status'] == 'none':
-                change = self.application.mongo.tasks.delete_one({'_id': _id})
-            else:
-                after['id'] = bson.ObjectId()
-                change = self.application.mongo.tasks.replace_one(
-                    {'_id': _id}, after, upsert=True)
-            assert change.raw_result['ok']
+    mongo_indexes = {'tasks': INDEXES}
 
-        self.write({'changed': changed,
-                    'before': tansform_bson_id(before),
-                    'after': tansform_bson_id(after)})
+    async def put(self, task):
+        todo = await self.application.mongo_executor.run(
+            assign_one, self.application.mongo.tasks, task)
+        if todo is None:
+            # There where no task to do.
+            self.set_status(204, reason='No task to do')
+        else:
+            metrics_registry.inc('factornado_tasks_claimed_total', task=task)
+            self.write(pd.io.json.dumps(tansform_bson_id(todo)))
 
 
-class AssignOne(web.RequestHandler):
+class AssignMany(web.RequestHandler):
     swagger = {
         SwaggerPath("/{name}/{uri}/{{task}}"): {
             "put": {
-                "description": "Pick a task that has not been done yet, and assign it.",
+                "description": "Pick several tasks that have not been done yet, and assign them.",
                 "parameters": [
                     {
                         "in": "path",
@@ -327,6 +887,18 @@ class AssignOne(web.RequestHandler):
                             "type": "string",
                             "default": "someTask"
                         }
+                    },
+                    {
+                        "in": "query",
+                        "name": "n",
+                        "required": False,
+                        "description": "The maximum number of tasks to assign "
+                                       "(at most 1000).",
+                        "schema": {
+                            "type": "integer",
+                            "format": "int32",
+                            "default": 10
+                        }
                     }
                 ],
                 "responses": {
@@ -340,39 +912,26 @@ class AssignOne(web.RequestHandler):
         }
     }
 
-    def put(self, task):
-        while True:
-            cursor = self.application.mongo.tasks.find(
-                {'status': 'todo', 'task': task},
-                sort=[('priority', -1), ('ldt', 1)])
-            yielded = 0
-            for todo in cursor:
-                r = self.application.mongo.tasks.update_one(
-                    {'_id': todo['_id'], 'id': todo['id']},
-                    {'$set': {
-                            'status': 'doing',
-                            'statusSince': pd.Timestamp.utcnow().value,
-                            'id': bson.ObjectId(),
-                        }})
-                if r.modified_count == 1:
-                    self.write(pd.io.json.dumps(tansform_bson_id(todo)))
-                    yielded = 1
-                    break
-                else:
-                    # Someone got this one before. Let's try another one
-                    pass
+    mongo_indexes = {'tasks': INDEXES}
+    max_n = 1000
 
-            if yielded == 1:
-                # We got a task. It's finished
-                break
-            elif cursor.retrieved == 0:
-                # There where no task to do.
-                self.set_status(204, reason='No task to do')
-                break
-            else:
-                # There where tasks, but they where all got by someone else.
-                # Let's retry
-                pass
+    async def put(self, task):
+        n = self.get_argument('n', '10')
+        try:
+            n = min(int(n), self.max_n)
+        except Exception:
+            raise web.HTTPError(409, 'n argument must be an int')
+        if n < 1:
+            raise web.HTTPError(409, 'n argument must be positive')
+
+        todos = await self.application.mongo_executor.run(
+            assign_many, self.application.mongo.tasks, task, n)
+        if len(todos) == 0:
+            # There where no task to do.
+            self.set_status(204, reason='No task to do')
+        else:
+            metrics_registry.inc('factornado_tasks_claimed_total', len(todos), task=task)
+            self.write(pd.io.json.dumps(list(map(tansform_bson_id, todos))))
 
 
 class GetByKey(web.RequestHandler):
@@ -413,8 +972,11 @@ class GetByKey(web.RequestHandler):
         }
     }
 
-    def get(self, task, key):
-        todo = self.application.mongo.tasks.find_one({'key': key, 'task': task})
+    mongo_indexes = {'tasks': INDEXES}
+
+    async def get(self, task, key):
+        todo = await self.application.mongo_executor.run(
+            self.application.mongo.tasks.find_one, {'key': key, 'task': task})
         if todo is None:
             self.set_status(204, reason='No task matching')
         else:
@@ -441,17 +1003,70 @@ class GetByStatus(web.RequestHandler):
                         "in": "path",
                         "name": "status",
                         "required": True,
-                        "description": "The status to be set: done|toredo|fail|todo|doing|none.",
+                        "description": "The statuses to look for, separated by commas.",
                         "schema": {
                             "type": "string",
-                            "enum": ["done", "toredo", "fail", "todo", "doing", "none"],
                             "default": "todo"
                         }
+                    },
+                    {
+                        "in": "query",
+                        "name": "limit",
+                        "required": False,
+                        "description": (
+                            "The maximum number of tasks to get for each status. "
+                            "If set, tasks are sorted by `_id`, which is always returned."),
+                        "schema": {
+                            "type": "integer",
+                            "format": "int32"
+                        }
+                    },
+                    {
+                        "in": "query",
+                        "name": "after",
+                        "required": False,
+                        "description": (
+                            "Resume token: get only the tasks whose `_id` is greater than this "
+                            "one (typically, the `_id` of the last task received). "
+                            "Requires a single status."),
+                        "schema": {
+                            "type": "string"
+                        }
+                    },
+                    {
+                        "in": "query",
+                        "name": "fields",
+                        "required": False,
+                        "description": "The fields to get, separated by commas.",
+                        "schema": {
+                            "type": "string"
+                        }
+                    },
+                    {
+                        "in": "query",
+                        "name": "exclude",
+                        "required": False,
+                        "description": "The fields not to get, separated by commas. Example: data",
+                        "schema": {
+                            "type": "string"
+                        }
+                    },
+                    {
+                        "in": "query",
+                        "name": "format",
+                        "required": False,
+                        "description": (
+                            "json: an object {status: [tasks]} ; "
+                            "ndjson: one task per line."),
+                        "schema": {
+                            "type": "string",
+                            "enum": ["json", "ndjson"],
+                            "default": "json"
+                        }
                     }
                 ],
                 "responses": {
                     200: {"description": "OK"},
-                    204: {"description": "No task matching"},
                     401: {"description": "Unauthorized"},
                     403: {"description": "Forbidden"},
                     404: {"description": "Not Found"},
@@ -460,10 +1075,147 @@ class GetByStatus(web.RequestHandler):
         }
     }
 
-    def get(self, task, status_list):
+    mongo_indexes = {'tasks': INDEXES}
+
+    # The number of tasks read from mongo between two flushes of the response.
+    batch_size = 1000
+
+    def parse_arguments(self):
+        limit = self.get_argument('limit', None)
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except Exception:
+                raise web.HTTPError(409, 'limit argument must be an int')
+
+        fields = self.get_argument('fields', None)
+        exclude = self.get_argument('exclude', None)
+        if fields is not None and exclude is not None:
+            raise web.HTTPError(409, 'fields and exclude arguments cannot be used together')
+        elif fields is not None:
+            projection = {field: 1 for field in fields.split(',')}
+        elif exclude is not None:
+            projection = {field: 0 for field in exclude.split(',')}
+        else:
+            projection = None
+
+        after = self.get_argument('after', None)
+        if projection is not None and (limit is not None or after is not None):
+            # The `_id` of the last task is the resume token of the next page.
+            projection.pop('_id', None)
+
+        fmt = self.get_argument('format', 'json')
+        if fmt not in ['json', 'ndjson']:
+            raise web.HTTPError(409, 'format argument must be json or ndjson')
+
+        return limit, after, projection or None, fmt
+
+    async def get(self, task, status_list):
         status_list = escape.url_unescape(status_list.lower()).split(',')
-        self.write(pd.io.json.dumps(
-            {status: list(map(tansform_bson_id,
-                              self.application.mongo.tasks.find({'status': status,
-                                                                 'task': task})))
-             for status in status_list}))
+        limit, after, projection, fmt = self.parse_arguments()
+        if after is not None and len(status_list) > 1:
+            raise web.HTTPError(409, 'after argument requires a single status')
+
+        self.set_header('Content-Type', 'application/x-ndjson' if fmt == 'ndjson'
+                        else 'application/json; charset=UTF-8')
+        if fmt == 'json':
+            self.write('{')
+        for i, status in enumerate(status_list):
+            if fmt == 'json':
+                self.write('{}{}: ['.format(', ' if i else '', json.dumps(status)))
+
+            query = {'status': status, 'task': task}
+            if after is not None:
+                query['_id'] = {'$gt': after}
+            cursor = self.application.mongo.tasks.find(
+                query,
+                projection=projection,
+                sort=[('_id', 1)] if limit is not None or after is not None else None,
+                limit=limit or 0,
+                )
+            nb = 0
+            try:
+                while True:
+                    # The cursor is iterated by batches, in the mongo threads.
+                    docs = await self.application.mongo_executor.run(
+                        lambda: list(itertools.islice(cursor, self.batch_size)))
+                    for doc in docs:
+                        doc = pd.io.json.dumps(tansform_bson_id(doc))
+                        if fmt == 'json':
+                            self.write('{}{}'.format(', ' if nb else '', doc))
+                        else:
+                            self.write(doc + '\n')
+                        nb += 1
+                    await self.flush()
+                    if len(docs) < self.batch_size:
+                        break
+            finally:
+                # If the client has gone, the server-side cursor is not left open.
+                await self.application.mongo_executor.run(cursor.close)
+
+            if fmt == 'json':
+                self.write(']')
+        if fmt == 'json':
+            self.write('}')
+
+
+class Stats(web.RequestHandler):
+    swagger = {
+        SwaggerPath("/{name}/{uri}/{{task}}"): {
+            "get": {
+                "description": (
+                    "Count the tasks in each status, and give the oldest `statusSince`. "
+                    "Without task category, all categories are counted."),
+                "parameters": [
+                    {
+                        "in": "path",
+                        "name": "task",
+                        "required": False,
+                        "description": "The task category.",
+                        "schema": {
+                            "type": "string",
+                            "default": "someTask"
+                        }
+                    }
+                ],
+                "responses": {
+                    200: {"description": "OK"},
+                    401: {"description": "Unauthorized"},
+                    403: {"description": "Forbidden"},
+                    404: {"description": "Not Found"},
+                }
+            }
+        }
+    }
+
+    mongo_indexes = {'tasks': INDEXES}
+
+    # Results cached by (collection, task), as (expiry, result), with LRU eviction:
+    # `task` comes from the url, so the number of keys must be bounded.
+    cache = collections.OrderedDict()
+    cache_size = 256
+
+    def initialize(self, ttl=0):
+        """
+        Parameters
+        ----------
+        ttl: float, default 0
+            The number of seconds results are cached for (in each process).
+            If 0, there is no cache.
+        """
+        self.ttl = ttl
+
+    async def get(self, task=None):
+        task = task or None
+        cache_key = (id(self.application.mongo.tasks), task)
+        expiry, out = self.cache.get(cache_key, (0, None)) if self.ttl > 0 else (0, None)
+        if expiry <= time.time():
+            out = await self.application.mongo_executor.run(
+                get_stats, self.application.mongo.tasks, task=task)
+            if self.ttl > 0:
+                self.cache[cache_key] = (time.time() + self.ttl, out)
+        if cache_key in self.cache:
+            self.cache.move_to_end(cache_key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        self.write(out)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import time
+import contextlib
+import contextvars
+
+from tornado import web
+
+# The spans of the current request, or None if it is not instrumented.
+current_spans = contextvars.ContextVar('factornado_spans', default=None)
+
+
+class Spans(object):
+    """The time spent in each kind of operation (mongo, http, auth...) during a request."""
+    def __init__(self):
+        # {name: [count, duration in seconds]}
+        self.spans = {}
+
+    def add(self, name, duration):
+        span = self.spans.setdefault(name, [0, 0.])
+        span[0] += 1
+        span[1] += duration
+
+    def to_dict(self):
+        """The spans as a dict {name: {'count', 'ms'}}."""
+        return {name: {'count': count, 'ms': round(duration * 1000, 3)}
+                for name, (count, duration) in self.spans.items()}
+
+    def server_timing(self, total=None):
+        """The spans in the format of a `Server-Timing` header."""
+        metrics = ['{};dur={:.3f};desc="{} call{}"'.format(
+            name, duration * 1000, count, 's' if count > 1 else '')
+            for name, (count, duration) in sorted(self.spans.items())]
+        if total is not None:
+            metrics.append('total;dur={:.3f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Count the time spent in the block in the spans of the current request (if any).
+
+    Example:
+        with span('mongo'):
+            doc = collection.find_one({'_id': _id})
+    """
+    spans = current_spans.get()
+    if spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.add(name, time.perf_counter() - start)
+
+
+def timed(name, function, *args, **kwargs):
+    """Run `function(*args, **kwargs)` in a span called `name`."""
+    with span(name):
+        return function(*args, **kwargs)
+
+
+class ServerTiming(web.OutputTransform):
+    """An output transform that records the spans of each request (see `span`), and sends
+    them in a `Server-Timing` header.
+
+    It is added to the application's transforms if a `timing` section is configured.
+    """
+    def __init__(self, request):
+        self.request = request
+        self.spans = Spans()
+        # The handler runs in a task that copies the current context.
+        current_spans.set(self.spans)
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        headers['Server-Timing'] = self.spans.server_timing(total=self.request.request_time())
+        return status_code, headers, chunk
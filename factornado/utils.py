@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import asyncio
+import inspect
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+from tornado import ioloop
 
 
 class ArgParseError(Exception):
@@ -19,12 +27,116 @@ class SwaggerPath(str):
             uri=uri.replace("/([^/]*?)", ""), **kwargs)
 
 
+class Executor(object):
+    """A pool of threads, to run blocking calls without blocking the IOLoop.
+
+    Parameters
+    ----------
+    max_workers: int, default 10
+        The maximum number of threads in each process.
+    name: str, default 'factornado'
+        The prefix of the threads' names.
+    """
+    def __init__(self, max_workers=10, name='factornado'):
+        self.max_workers = max_workers
+        self.name = name
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        # Threads are not inherited by forked processes: each process needs its own pool.
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix=self.name)
+            self._pid = os.getpid()
+        return self._executor
+
+    def run(self, function, *args, **kwargs):
+        """Run `function(*args, **kwargs)` in the thread pool, and return an awaitable result."""
+        # The call sees the context of the caller (e.g. the spans of its request).
+        context = contextvars.copy_context()
+        return ioloop.IOLoop.current().run_in_executor(
+            self.executor, context.run, functools.partial(function, *args, **kwargs))
+
+
+async def maybe_await(value):
+    """Await `value` if it is awaitable, return it as is otherwise.
+
+    This lets code work the same way with `WebMethod` and `AsyncWebMethod` services.
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class SingleFlight(object):
+    """Deduplicates concurrent coroutine calls: calls with the same key share one execution.
+
+    This lets concurrent requests that need the same resource (a token, a key set...)
+    wait for a single outbound fetch.
+    """
+    def __init__(self):
+        self.pending = {}
+        self._pid = os.getpid()
+
+    def run(self, key, function, *args, **kwargs):
+        """Run the coroutine `function(*args, **kwargs)`, unless a call with the same `key` is
+        already running, and return an awaitable result."""
+        if self._pid != os.getpid():
+            # Pending calls do not survive a fork.
+            self.pending = {}
+            self._pid = os.getpid()
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function(*args, **kwargs))
+            self.pending[key] = future
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        # A cancelled caller shall not cancel the others.
+        return asyncio.shield(future)
+
+
 def tansform_bson_id(y):
     x = {key: val for key, val in y.items()}
-    x['id'] = str(x['id']) if x['id'] is not None else None
+    if 'id' in x:
+        x['id'] = str(x['id']) if x['id'] is not None else None
     return x
 
 
+def _differs(x, y):
+    """Tell whether two JSON-like values differ, as their JSON serializations would.
+
+    Unlike `==`, values of different types differ (`1`, `1.0` and `True` are not the same
+    data), and `NaN` is equal to itself.
+    """
+    if x is y:
+        return False
+    if isinstance(x, (list, tuple)) and isinstance(y, (list, tuple)):
+        return len(x) != len(y) or any(_differs(a, b) for a, b in zip(x, y))
+    if type(x) is not type(y):
+        return True
+    if isinstance(x, dict):
+        return x.keys() != y.keys() or any(_differs(x[key], y[key]) for key in x)
+    if isinstance(x, float) and x != x and y != y:
+        return False
+    return x != y
+
+
+def has_changed(before, after):
+    """Tell whether two task documents differ.
+
+    Fields are compared one by one, the small ones first, and the comparison stops at the
+    first difference. As `after['data']` is usually a shallow copy of `before['data']`,
+    the values it shares with it are compared by identity, without being traversed.
+    """
+    if before.keys() != after.keys():
+        return True
+    for key in sorted(before, key=lambda key: key == 'data'):
+        if _differs(before[key], after[key]):
+            return True
+    return False
+
+
 def to_ts(x):
     """Transforms a string, a timestamp or a timezoned-timestamp into a timestamp.
     """
@@ -53,11 +53,12 @@ config = dict(name='factornado',
               author_email='martin@journois.fr',
               url='https://github.com/factornado/factornado',
               keywords='microservices web tornado',
-              classifiers=['Programming Language :: Python :: 2.7',
-                           'Programming Language :: Python :: 3.4',
-                           'Programming Language :: Python :: 3.5',
+              classifiers=['Programming Language :: Python :: 3.7',
+                           'Programming Language :: Python :: 3.8',
+                           'Programming Language :: Python :: 3.9',
                            'License :: OSI Approved :: MIT License',
                            'Development Status :: 5 - Production/Stable'],
+              python_requires='>=3.7',
               packages=pkgs,
               package_data=pkg_data,
               setup_requires=['pytest-runner', ],
@@ -0,0 +1,38 @@
+import asyncio
+import threading
+
+import pytest
+from tornado import httpserver, netutil, web
+
+
+@pytest.fixture
+def serve():
+    """Run applications in threads, each on a free port: `url = serve(app)`.
+
+    `app` may also be a function that builds the application from its port.
+    The servers are stopped at teardown.
+    """
+    servers = []
+
+    def _serve(app):
+        sockets = netutil.bind_sockets(0, address='127.0.0.1')
+        port = sockets[0].getsockname()[1]
+        if not isinstance(app, web.Application):
+            app = app(port)
+        loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            httpserver.HTTPServer(app).add_sockets(sockets)
+            loop.run_forever()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        servers.append((loop, thread, sockets))
+        return 'http://127.0.0.1:{}'.format(port)
+
+    yield _serve
+    for loop, thread, sockets in reversed(servers):
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        for sock in sockets:
+            sock.close()
@@ -1,4 +1,10 @@
+import gzip
+import json
+
+from tornado import httputil
+
 import factornado
+from factornado.handlers import Swagger
 
 
 class Handler(factornado.RequestHandler):
@@ -14,7 +20,7 @@ class Handler(factornado.RequestHandler):
 
 app = factornado.Application(
     {'name': 'test', 'threads_nb': 1, 'log': {'stdout': False}},
-    [('/', Handler)],
+    [('/', Handler), ('/swagger.json', Swagger)],
     )
 
 
@@ -32,3 +38,25 @@ def test_post():
 
 def test_put():
     assert app.put('/') == b'This is PUT'
+
+
+def test_swagger():
+    doc = json.loads(app.get('/swagger.json'))
+    assert doc['info']['title'] == 'test'
+    assert '/test/swagger.json' in doc['paths']
+    assert app.swagger_document['json'] == app.get('/swagger.json')
+
+    etag = app.swagger_document['etag']
+    assert app.get('/swagger.json', headers=httputil.HTTPHeaders({'If-None-Match': etag})) == b''
+    body = app.get('/swagger.json', headers=httputil.HTTPHeaders({'Accept-Encoding': 'gzip'}))
+    assert gzip.decompress(body) == app.swagger_document['json']
+
+
+def test_swagger_components():
+    components_app = factornado.Application(
+        {'name': 'test', 'log': {'stdout': False}},
+        [('/swagger.json', Swagger)],
+        swagger_components={'schemas': {'Foo': {'type': 'object'}}},
+        )
+    doc = json.loads(components_app.get('/swagger.json'))
+    assert doc['components']['schemas'] == {'Foo': {'type': 'object'}}
@@ -0,0 +1,217 @@
+import json
+import time
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+import pytest
+import requests
+
+import factornado
+from factornado import authentication
+
+jwt = pytest.importorskip('jwt')
+rsa = pytest.importorskip('cryptography.hazmat.primitives.asymmetric.rsa')
+
+private_keys = {kid: rsa.generate_private_key(public_exponent=65537, key_size=2048)
+                for kid in ['kid1', 'kid2']}
+certs_url = 'https://sso/auth/realms/realm/protocol/openid-connect/certs'
+
+
+def make_jwks(*kids):
+    keys = []
+    for kid in kids:
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_keys[kid].public_key()))
+        jwk.update(kid=kid, alg='RS256', use='sig')
+        keys.append(jwk)
+    return {'keys': keys}
+
+
+def make_token(kid, exp=3600):
+    return jwt.encode({'sub': 'me', 'exp': int(time.time()) + exp}, private_keys[kid],
+                      algorithm='RS256', headers={'kid': kid})
+
+
+class FakeHTTPClient(object):
+    """Replaces tornado's AsyncHTTPClient: serves `jwks` and tokens, and records the fetches."""
+    jwks = None
+    token_exp = 3600
+    fetches = []
+
+    def respond(self, request):
+        url = getattr(request, 'url', request)
+        self.fetches.append(url)
+        if url.endswith('/token'):
+            body = {'access_token': make_token('kid1', exp=self.token_exp)}
+        else:
+            body = self.jwks
+        return FakeResponse(json.dumps(body).encode('utf-8'))
+
+    async def fetch(self, request, **kwargs):
+        await asyncio.sleep(0.05)
+        return self.respond(request)
+
+
+class FakeSyncHTTPClient(FakeHTTPClient):
+    """Replaces tornado's HTTPClient."""
+    def fetch(self, request, **kwargs):
+        time.sleep(0.05)
+        return self.respond(request)
+
+    def close(self):
+        pass
+
+
+class FakeResponse(object):
+    code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+
+@authentication.authenticated
+class Handler(factornado.RequestHandler):
+    def get(self):
+        self.write(getattr(self, authentication.AUTH_DATA)['sub'])
+
+
+@pytest.fixture
+def sso(monkeypatch):
+    monkeypatch.setattr(authentication.httpclient, 'AsyncHTTPClient', FakeHTTPClient)
+    monkeypatch.setattr(authentication.httpclient, 'HTTPClient', FakeSyncHTTPClient)
+    monkeypatch.setattr(authentication, 'jwks_cache', authentication.JWKSCache())
+    monkeypatch.setattr(authentication, 'token_cache', authentication.TokenCache())
+    monkeypatch.setattr(FakeHTTPClient, 'jwks', make_jwks('kid1'))
+    monkeypatch.setattr(FakeHTTPClient, 'fetches', [])
+    yield FakeHTTPClient
+
+
+@pytest.fixture
+def get(sso, serve):
+    app = factornado.Application(
+        {'name': 'test', 'threads_nb': 1, 'log': {'stdout': False},
+         'sso': {'url': 'https://sso/auth/', 'realm': 'realm', 'client_id': 'client',
+                 'client_secret': 'secret'}},
+        [('/', Handler)],
+        )
+    url = serve(app)
+
+    def _get(token):
+        return requests.get(url + '/', headers={'Authorization': 'bearer ' + token}).content
+    return _get
+
+
+def test_jwks_cache(sso, get):
+    for i in range(3):
+        assert get(make_token('kid1')) == b'me'
+    assert sso.fetches == [certs_url]
+    assert get(make_token('kid1', exp=-60)) == b'Unauthorized'
+    assert get('not.a.token') == b'Unauthorized'
+
+
+def test_jwks_cache_unknown_kid(sso, get):
+    assert get(make_token('kid1')) == b'me'
+    # The keys are rotated.
+    sso.jwks = make_jwks('kid1', 'kid2')
+    assert get(make_token('kid2')) == b'Unauthorized'  # Too soon to refresh.
+    authentication.jwks_cache.min_refresh_interval = 0
+    assert get(make_token('kid2')) == b'me'
+    assert sso.fetches == [certs_url, certs_url]
+
+
+def test_jwks_cache_ttl(sso, get):
+    assert get(make_token('kid1')) == b'me'
+    authentication.jwks_cache.ttl = 0
+    sso.jwks = make_jwks('kid2')
+    # The expired key set is served, and refreshed in the background.
+    assert get(make_token('kid1', exp=7200)) == b'me'
+    for i in range(100):
+        if list(authentication.jwks_cache.key_sets[certs_url]['keys']) == ['kid2']:
+            break
+        time.sleep(0.01)
+    assert list(authentication.jwks_cache.key_sets[certs_url]['keys']) == ['kid2']
+    assert len(sso.fetches) == 2
+
+
+def test_jwks_cache_single_flight(sso, get):
+    tokens = [make_token('kid1', exp=3600 + i) for i in range(5)]
+    with concurrent.futures.ThreadPoolExecutor(5) as executor:
+        assert list(executor.map(get, tokens)) == [b'me'] * 5
+    assert sso.fetches == [certs_url]
+
+
+token_url = 'https://sso/auth/realms/realm/protocol/openid-connect/token'
+
+
+@pytest.fixture
+def application(sso):
+    yield factornado.Application(
+        {'name': 'test', 'log': {'stdout': False},
+         'sso': {'url': 'https://sso/auth/', 'realm': 'realm', 'client_id': 'client',
+                 'client_secret': 'secret', 'token_skew': 60}},
+        [])
+
+
+def test_get_token_async(sso, application):
+    async def get_tokens():
+        return await asyncio.gather(*[
+            authentication.get_token_async(application) for i in range(5)])
+    tokens = asyncio.new_event_loop().run_until_complete(get_tokens())
+    assert len(set(tokens)) == 1
+    assert application.config['token'] == tokens[0]
+    assert sso.fetches == [token_url]
+
+
+def test_get_token_refresh(sso, application):
+    sso.token_exp = 30
+    token = authentication.get_token(application)
+    assert sso.fetches == [token_url]
+    sso.token_exp = 3600
+    # The token expires within the skew: it is returned, and refreshed in the background.
+    assert authentication.get_token(application) == token
+    for i in range(100):
+        if len(sso.fetches) == 2 and application.token_manager.token != token:
+            break
+        time.sleep(0.01)
+    assert authentication.get_token(application) != token
+    assert sso.fetches == [token_url, token_url]
+
+    async def get_token():
+        return await authentication.get_token_async(application)
+    assert asyncio.new_event_loop().run_until_complete(get_token()) == application.config['token']
+    assert len(sso.fetches) == 2
+
+
+def test_get_token_shared(sso, application):
+    """The token retrieved in a forked process is shared with the others."""
+    context = multiprocessing.get_context('fork')
+    child = context.Process(target=authentication.get_token, args=(application,))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+    token = authentication.get_token(application)
+    assert jwt.decode(token, options={'verify_signature': False})['sub'] == 'me'
+    assert sso.fetches == []
+
+
+def test_token_cache(sso, get):
+    token = make_token('kid1')
+    for i in range(3):
+        assert get(token) == b'me'
+    assert get(make_token('kid1', exp=-60)) == b'Unauthorized'
+    assert authentication.token_cache.stats() == {
+        'size': 1, 'hits': 2, 'misses': 2, 'hitRate': 0.5}
+
+
+def test_token_cache_lru():
+    cache = authentication.TokenCache(maxsize=2)
+    exp = time.time() + 3600
+    for token in ['a', 'b', 'a', 'c']:
+        if cache.get(token) is None:
+            cache.set(token, {'sub': token, 'exp': exp})
+    assert cache.get('a') == {'sub': 'a', 'exp': exp}
+    assert cache.get('b') is None
+    cache.set('d', {'sub': 'd', 'exp': time.time() - 1})
+    assert cache.get('d') is None
+    cache.set('e', {'sub': 'e'})
+    assert cache.get('e') is None
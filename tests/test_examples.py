@@ -240,6 +240,44 @@ class TestTasks(object):
         r.raise_for_status()
         assert r.status_code == 204
 
+    def test_tasks_assignMany(self, server):
+        while True:
+            r = requests.put(server.url + '/tasks/assignMany/task01', data={})
+            r.raise_for_status()
+            if r.status_code != 200:
+                assert r.status_code == 204
+                break
+
+        r = requests.put(server.url + '/tasks/force/task01/key01/todo', data={})
+        r.raise_for_status()
+
+        r = requests.put(server.url + '/tasks/force/task01/key02/todo', data={})
+        r.raise_for_status()
+
+        r = requests.put(server.url + '/tasks/assignMany/task01', params={'n': 5}, data={})
+        r.raise_for_status()
+        assert r.status_code == 200
+        doc = r.json()
+        assert [x['key'] for x in doc] == ['key01', 'key02']
+        assert all(x['status'] == 'todo' for x in doc)
+
+        r = requests.put(server.url + '/tasks/assignMany/task01', data={})
+        r.raise_for_status()
+        assert r.status_code == 204
+
+    def test_tasks_actions(self, server):
+        r = requests.put(server.url + '/tasks/force/task01/key01/doing', data={})
+        r.raise_for_status()
+
+        r = requests.put(server.url + '/tasks/actions', json=[
+            {'task': 'task01', 'key': 'key01', 'action': 'success', 'data': {}},
+            ['task01', 'key02', 'stack', {}],
+            ])
+        r.raise_for_status()
+        doc = r.json()
+        assert doc[0]['ok'] and doc[0]['after']['status'] == 'done'
+        assert doc[1]['ok'] and doc[1]['after']['status'] in ['todo', 'toredo']
+
     def test_get_by_key(self, server):
         r = requests.put(server.url + '/tasks/force/task01/key01/todo', data={})
         r.raise_for_status()
@@ -273,6 +311,16 @@ class TestTasks(object):
         assert 'task01/key02' in [x['_id'] for x in doc['done']]
         assert 'task01/key03' in [x['_id'] for x in doc['fail']]
 
+    def test_stats(self, server):
+        r = requests.put(server.url + '/tasks/force/task01/key01/todo', data={})
+        r.raise_for_status()
+
+        r = requests.get(server.url + '/tasks/stats/task01')
+        r.raise_for_status()
+        doc = r.json()
+        assert list(doc) == ['task01']
+        assert doc['task01']['todo']['count'] >= 1
+
     def test_tasks_multithreading(self, server):
         def log_function(thread_id, r, operation):
             r.raise_for_status()
@@ -1,5 +1,15 @@
-import factornado
 import io
+import os
+import json
+import time
+import logging
+import multiprocessing
+
+import requests
+
+import factornado
+from factornado.handlers import Log
+from factornado.logger import tail, tail_files, log_files, shard_filename
 
 
 def test_stream_logger():
@@ -12,3 +22,223 @@ def test_stream_logger():
     logger.info('info')
     logger.debug('debug')
     assert stream.getvalue() == ('INFO - info\n')
+
+
+def test_json_logger():
+    stream = io.StringIO()
+    logger = factornado.get_logger('test_json_logger', stdout=False, stream=stream, json=True)
+    logger.info('Got task %s', 'foo', extra={'task_key': 'foo', 'data': {'x': object}})
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception('Failed')
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert {key: first[key] for key in ['name', 'level', 'message', 'task_key', 'pid']} == {
+        'name': 'test_json_logger', 'level': 'INFO', 'message': 'Got task foo',
+        'task_key': 'foo', 'pid': os.getpid()}
+    assert first['data'] == {'x': str(object)}
+    assert first['file'] == 'test_logger.py' and first['time'].endswith('+00:00')
+    assert second['level'] == 'ERROR' and 'ZeroDivisionError' in second['exception']
+    assert 'exception' not in first
+
+
+def write_log(filename, nb):
+    with open(filename, 'w') as f:
+        for i in range(nb):
+            f.write('2020-01-01 (x:y.py:1)- {} - line {}\n'.format(
+                ['DEBUG', 'INFO', 'WARNING', 'ERROR'][i % 4], i))
+
+
+def test_tail(tmpdir):
+    filename = str(tmpdir.join('test.log'))
+    write_log(filename, 1000)
+    lines = tail(filename, n=5, block_size=64)
+    assert [line.split()[-1] for line in lines] == [b'995', b'996', b'997', b'998', b'999']
+    assert len(tail(filename, n=2000, block_size=100)) == 1000
+    lines = tail(filename, n=3, level='warning', block_size=64)
+    assert [line.split()[-1] for line in lines] == [b'995', b'998', b'999']
+    assert all(b'ERROR' in line for line in tail(filename, n=10, level=40))
+
+
+class FollowLog(Log):
+    follow_interval = 0.01
+    max_follow = 0.5
+
+
+def test_log_handler(tmpdir, serve):
+    filename = str(tmpdir.join('test.log'))
+    write_log(filename, 100)
+    app = factornado.Application({'log': {'stdout': False, 'file': filename}},
+                                 [('/log', FollowLog)],
+                                 logger=logging.getLogger('test_log_handler'))
+    url = serve(app)
+    r = requests.get(url + '/log', params={'n': 3})
+    assert r.text.splitlines()[-1].endswith('line 99')
+    assert len(r.text.splitlines()) == 3
+    assert requests.get(url + '/log', params={'n': 'x'}).status_code == 400
+    assert requests.get(url + '/log', params={'level': 'foo'}).status_code == 400
+
+    r = requests.get(url + '/log', params={'n': 1, 'level': 'ERROR', 'follow': 'true'},
+                     stream=True)
+    time.sleep(0.1)
+    with open(filename, 'a') as f:
+        f.write('2020-01-01 (x:y.py:1)- INFO - new info\n')
+        f.write('2020-01-01 (x:y.py:1)- ERROR - new error\n')
+    assert r.text.splitlines() == [
+        '2020-01-01 (x:y.py:1)- ERROR - line 99',
+        '2020-01-01 (x:y.py:1)- ERROR - new error',
+        ]
+
+
+def test_queue_logger():
+    stream = io.StringIO()
+    logger = factornado.get_logger(
+        'test_queue_logger',
+        format='%(levelname)s - %(message)s',
+        stdout=False,
+        stream=stream,
+        queue=True,
+        )
+    logger.info('info %s', 1)
+    logger.debug('debug')
+    handler, = logger.handlers
+    handler.stop()
+    assert stream.getvalue() == ('INFO - info 1\nDEBUG - debug\n')
+
+
+def test_json_queue_logger():
+    stream = io.StringIO()
+    logger = factornado.get_logger('test_json_queue_logger', stdout=False, stream=stream,
+                                   json=True, queue=True)
+    data = {'x': 1}
+    logger.info('Got %s', data, extra={'task_key': 'foo'})
+    data['x'] = 2
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception('Failed')
+    handler, = logger.handlers
+    handler.stop()
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert first['message'] == "Got {'x': 1}" and first['task_key'] == 'foo'
+    assert second['message'] == 'Failed' and 'ZeroDivisionError' in second['exception']
+    assert 'exception' not in first
+
+
+def test_queue_logger_drop():
+    class SlowStream(io.StringIO):
+        def write(self, s):
+            time.sleep(0.01)
+            return super(SlowStream, self).write(s)
+
+    stream = SlowStream()
+    logger = factornado.get_logger('test_queue_logger_drop', stdout=False, stream=stream,
+                                   format='%(message)s', queue=True, queue_size=5)
+    for i in range(100):
+        logger.info('line %s', i)
+    handler, = logger.handlers
+    # Purging the handlers stops the listener, once the queue is written.
+    factornado.get_logger('test_queue_logger_drop', stdout=False)
+    assert handler.dropped > 0
+    assert len(stream.getvalue().splitlines()) == 100 - handler.dropped
+
+
+def test_queue_logger_stopped():
+    stream = io.StringIO()
+    logger = factornado.get_logger('test_queue_logger_stopped', stdout=False, stream=stream,
+                                   format='%(message)s', queue=True, queue_size=1,
+                                   queue_policy='block')
+    handler, = logger.handlers
+    handler.stop()
+    assert handler not in factornado.logger._queue_handlers
+    # Once the listener is stopped, records are written at once instead of queued.
+    for i in range(3):
+        logger.info('line %s', i)
+    assert stream.getvalue() == 'line 0\nline 1\nline 2\n'
+
+
+def test_queue_logger_fork(tmpdir):
+    filename = str(tmpdir.join('test.log'))
+    logger = factornado.get_logger('test_queue_logger_fork', stdout=False, file=filename,
+                                   format='%(message)s', queue=True)
+
+    def child():
+        logger.info('from child')
+        logger.handlers[0].stop()
+    process = multiprocessing.get_context('fork').Process(target=child)
+    process.start()
+    process.join()
+    logger.handlers[0].stop()
+    assert open(filename).read() == 'from child\n'
+
+
+def test_rotation(tmpdir):
+    filename = str(tmpdir.join('test.log'))
+    logger = factornado.get_logger('test_rotation', stdout=False, file=filename,
+                                   format='%(message)s', max_bytes=100, backup_count=2)
+    for i in range(50):
+        logger.info('line %s', i)
+    assert sorted(os.listdir(str(tmpdir))) == ['test.log', 'test.log.1', 'test.log.2']
+    assert os.path.getsize(filename) <= 100
+    assert open(filename).read().splitlines()[-1] == 'line 49'
+    assert log_files(filename) == [filename]
+
+
+def test_per_process_logger(tmpdir):
+    filename = str(tmpdir.join('test.log'))
+    logger = factornado.get_logger('test_per_process_logger', stdout=False, file=filename,
+                                   per_process=True, max_bytes=10 ** 6)
+
+    def child():
+        time.sleep(0.01)
+        logger.info('from child')
+    logger.info('from parent')
+    process = multiprocessing.get_context('fork').Process(target=child)
+    process.start()
+    process.join()
+    shards = [shard_filename(filename, pid) for pid in [os.getpid(), process.pid]]
+    assert log_files(filename) == sorted(shards)
+    assert open(shards[0]).read().strip().endswith('from parent')
+    assert open(shards[1]).read().strip().endswith('from child')
+    lines = tail_files(log_files(filename), n=10)
+    assert [line.split()[-1] for line in lines] == [b'parent', b'child']
+
+
+def test_log_files_without_extension(tmpdir):
+    filename = str(tmpdir.join('service'))
+    logger = factornado.get_logger('test_log_files_without_extension', stdout=False,
+                                   file=filename, format='%(message)s', max_bytes=20)
+    for i in range(5):
+        logger.info('line %s', i)
+    logger = factornado.get_logger('test_log_files_without_extension', stdout=False,
+                                   file=filename, format='%(message)s', max_bytes=20,
+                                   per_process=True)
+    for i in range(5):
+        logger.info('line %s', i)
+    shard = shard_filename(filename, os.getpid())
+    assert os.path.exists(filename + '.1') and os.path.exists(shard + '.1')
+    assert log_files(filename) == [filename, shard]
+
+
+def test_log_handler_per_process(tmpdir, serve):
+    filename = str(tmpdir.join('test.log'))
+    for pid, seconds in [(123, [0, 2, 4]), (45, [1, 3])]:
+        with open(shard_filename(filename, pid), 'w') as f:
+            for second in seconds:
+                f.write('2020-01-01 00:00:0{0} (x:y.py:1)- INFO - {0}\n'.format(second))
+    app = factornado.Application({'log': {'stdout': False, 'file': filename}},
+                                 [('/log', FollowLog)],
+                                 logger=logging.getLogger('test_log_handler_per_process'))
+    url = serve(app)
+    r = requests.get(url + '/log', params={'n': 4})
+    assert [line.split()[-1] for line in r.text.splitlines()] == ['1', '2', '3', '4']
+
+    r = requests.get(url + '/log', params={'n': 0, 'follow': 'true'}, stream=True)
+    time.sleep(0.1)
+    with open(shard_filename(filename, 45), 'a') as f:
+        f.write('2020-01-02 (x:y.py:1)- INFO - new line\n')
+    write_log(shard_filename(filename, 6), 1)
+    assert sorted(r.text.splitlines()) == [
+        '2020-01-01 (x:y.py:1)- DEBUG - line 0',
+        '2020-01-02 (x:y.py:1)- INFO - new line',
+        ]
@@ -0,0 +1,127 @@
+import os
+import json
+import multiprocessing
+
+import pytest
+import requests
+from tornado import web
+
+import factornado
+import factornado.tasks
+from factornado.application import Kwargs
+from factornado.handlers import Metrics
+from factornado.metrics import MetricsRegistry, registry
+
+mongomock = pytest.importorskip('mongomock')
+
+
+class Hello(web.RequestHandler):
+    def get(self):
+        self.write('Hello')
+
+
+def test_render():
+    metrics = MetricsRegistry(buckets=(0.1, 1))
+    metrics.inc('requests_total', method='GET', status=200)
+    metrics.inc('requests_total', 2, method='GET', status=200)
+    metrics.inc('requests_total', handler='a"b')
+    for value in [0.05, 0.5, 5]:
+        metrics.observe('duration_seconds', value, handler='x')
+    assert metrics.render().splitlines() == [
+        '# TYPE requests_total counter',
+        'requests_total{handler="a\\"b"} 1',
+        'requests_total{method="GET",status="200"} 3',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{handler="x",le="0.1"} 1',
+        'duration_seconds_bucket{handler="x",le="1"} 2',
+        'duration_seconds_bucket{handler="x",le="+Inf"} 3',
+        'duration_seconds_sum{handler="x"} 5.55',
+        'duration_seconds_count{handler="x"} 3',
+        ]
+
+
+def test_processes(tmpdir):
+    metrics = MetricsRegistry(flush_interval=0.5)
+    metrics.set_directory(str(tmpdir))
+    metrics.inc('requests_total', status=200)
+
+    def child():
+        # The child does not count the parent's values.
+        metrics.inc('requests_total', status=200)
+        metrics.inc('requests_total', status=500)
+        metrics.flush()
+    process = multiprocessing.get_context('fork').Process(target=child)
+    process.start()
+    process.join()
+    assert sorted(os.listdir(str(tmpdir))) == ['{}.json'.format(process.pid)]
+    lines = metrics.render().splitlines()
+    assert 'requests_total{status="200"} 2' in lines
+    assert 'requests_total{status="500"} 1' in lines
+
+    # The parent's values are written at the latest after `flush_interval`.
+    metrics.flush()
+    assert len(os.listdir(str(tmpdir))) == 2
+    metrics.set_directory(str(tmpdir))
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_limit_label():
+    metrics = MetricsRegistry()
+    metrics.limit_label('task', ['foo'])
+    for task in ['foo', 'bar', 'baz']:
+        metrics.inc('actions_total', task=task, action='stack')
+    assert metrics.render().splitlines() == [
+        '# TYPE actions_total counter',
+        'actions_total{action="stack",task="foo"} 1',
+        'actions_total{action="stack",task="other"} 2',
+        ]
+
+
+def test_metrics_directory_cleanup(tmpdir):
+    directory = str(tmpdir.join('metrics'))
+    os.makedirs(directory)
+    # The exit hook of a forked process leaves the directory.
+    factornado.application._remove_directory(directory, os.getpid() + 1)
+    assert os.path.exists(directory)
+    factornado.application._remove_directory(directory, os.getpid())
+    assert not os.path.exists(directory)
+
+
+def test_metrics_handler(serve):
+    app = factornado.Application({'log': {'stdout': False}},
+                                 [('/hello', Hello), ('/metrics', Metrics)])
+    registry.reset()
+    url = serve(app)
+    for i in range(3):
+        requests.get(url + '/hello')
+    r = requests.get(url + '/metrics')
+    assert r.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    lines = r.text.splitlines()
+    assert 'http_requests_total{handler="Hello",method="GET",status="200"} 3' in lines
+    assert 'http_request_duration_seconds_count{handler="Hello",method="GET"} 3' in lines
+
+
+def test_tasks_metrics():
+    app = factornado.Application(
+        {'log': {'stdout': False}, 'metrics': {'tasks': ['foo']}, 'actions': {
+            'stack': {'none': 'todo'}, 'success': {'doing': 'done'}}},
+        [
+            ("/action/([^/]*?)/([^/]*?)/([^/]*?)", factornado.tasks.Action),
+            ("/assignOne/([^/]*?)", factornado.tasks.AssignOne),
+        ])
+    app.mongo = Kwargs(tasks=mongomock.MongoClient().db.tasks)
+    registry.reset()
+    for key in ['a', 'b']:
+        app.put('/action/foo/{}/stack'.format(key), body=b'')
+    doc = json.loads(app.put('/assignOne/foo', body=b''))
+    app.put('/action/foo/{}/success'.format(doc['key']), body=b'')
+    app.put('/action/bar/a/stack', body=b'')
+    counters, histograms = registry.collect()
+    assert counters[('factornado_tasks_claimed_total', (('task', 'foo'),))] == 1
+    assert counters[('factornado_task_actions_total',
+                     (('action', 'stack'), ('task', 'foo')))] == 2
+    assert counters[('factornado_task_actions_total',
+                     (('action', 'success'), ('task', 'foo')))] == 1
+    # Unknown tasks are not counted apart.
+    assert counters[('factornado_task_actions_total',
+                     (('action', 'stack'), ('task', 'other')))] == 1
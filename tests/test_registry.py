@@ -0,0 +1,292 @@
+import json
+import time
+import asyncio
+import hashlib
+
+import pytest
+import requests
+import pandas as pd
+from tornado import httpclient, simple_httpclient, web
+
+import factornado
+from factornado.handlers import Heartbeat
+from factornado.application import Kwargs
+from factornado.registry import (ServiceTable, UpstreamClient, Register, GetAll, Proxy,
+                                 StreamingProxy, StreamingHTTPClient, _StreamingHTTPConnection)
+
+mongomock = pytest.importorskip('mongomock')
+
+
+class Hello(web.RequestHandler):
+    def get(self):
+        self.write('Hello from {}'.format(self.request.host))
+
+
+class Data(web.RequestHandler):
+    """Serves `size` bytes, or returns the size and hash of the posted body."""
+    def get(self):
+        size = int(self.get_argument('size'))
+        self.set_header('Content-Type', 'application/octet-stream')
+        for i in range(0, size, 2 ** 16):
+            self.write(b'x' * min(2 ** 16, size - i))
+
+    def post(self):
+        self.write({'size': len(self.request.body),
+                    'md5': hashlib.md5(self.request.body).hexdigest()})
+
+    def delete(self):
+        raise web.HTTPError(404)
+
+
+class Slow(web.RequestHandler):
+    """Counts the requests being processed simultaneously."""
+    running = 0
+    max_running = 0
+
+    async def get(self):
+        Slow.running += 1
+        Slow.max_running = max(Slow.max_running, Slow.running)
+        await asyncio.sleep(0.05)
+        Slow.running -= 1
+        self.write('ok')
+
+
+@pytest.fixture
+def collection():
+    yield mongomock.MongoClient().db.registry
+
+
+def register(collection, name, url, age=0):
+    collection.replace_one({'_id': url}, {
+        '_id': url,
+        'name': name,
+        'id': pd.Timestamp.utcnow().value - int(age * 1e9),
+        'info': {},
+        }, upsert=True)
+
+
+def test_round_robin(collection):
+    for i in range(3):
+        register(collection, 'foo', 'http://foo{}'.format(i))
+    register(collection, 'bar', 'http://bar')
+    table = ServiceTable(collection)
+    table.load()
+    assert [table.choose('foo')['_id'] for i in range(4)] == [
+        'http://foo0', 'http://foo1', 'http://foo2', 'http://foo0']
+    assert table.choose('bar')['_id'] == 'http://bar'
+    assert table.choose('baz') is None
+
+
+def test_least_outstanding(collection):
+    for i in range(3):
+        register(collection, 'foo', 'http://foo{}'.format(i))
+    table = ServiceTable(collection, balancing='least_outstanding')
+    table.load()
+    chosen = [table.choose('foo') for i in range(2)]
+    for doc in chosen:
+        table.acquire(doc)
+    assert table.choose('foo')['_id'] == 'http://foo2'
+    table.release(chosen[0])
+    assert table.choose('foo')['_id'] == 'http://foo0'
+    assert table.outstanding == {'http://foo1': 1}
+
+
+def test_eviction(collection):
+    register(collection, 'foo', 'http://foo0', age=120)
+    register(collection, 'foo', 'http://foo1', age=10)
+    table = ServiceTable(collection, max_age=60)
+    table.load()
+    assert [doc['_id'] for doc in table.get('foo')] == ['http://foo1']
+    table.register(dict(collection.find_one({'_id': 'http://foo1'}),
+                        id=pd.Timestamp.utcnow().value - int(120e9)))
+    assert table.get('foo') == []
+    assert table.choose('foo') is None
+    assert table.get_all() == {}
+
+
+def test_proxy(collection, serve):
+    upstreams = [factornado.Application({'log': {'stdout': False}}, [('/hello', Hello)])
+                 for i in range(2)]
+    registry = factornado.Application(
+        {'log': {'stdout': False}, 'service_table': {'collection': 'registry', 'ttl': 60}},
+        [
+            ("/register/all", GetAll),
+            ("/register/([^/]*?)", Register),
+            ("/([^/]*?)/(.*)", Proxy),
+        ])
+    registry.mongo = Kwargs(registry=collection)
+    url0 = serve(upstreams[0])
+    url1 = serve(upstreams[1])
+    url = serve(registry)
+    for upstream_url in [url0, url1]:
+        r = requests.post(url + '/register/hello', data=json.dumps({'url': upstream_url}))
+        r.raise_for_status()
+    r = requests.get(url + '/register/all')
+    r.raise_for_status()
+    assert sorted(doc['_id'] for doc in r.json()['hello']) == sorted([url0, url1])
+
+    # The requests are balanced among instances.
+    hosts = {requests.get(url + '/hello/hello').text for i in range(4)}
+    assert hosts == {'Hello from ' + u[len('http://'):] for u in [url0, url1]}
+    assert requests.get(url + '/unknown/hello').status_code == 500
+
+
+def test_streaming_proxy(collection, serve):
+    upstream = factornado.Application({'log': {'stdout': False}}, [('/data', Data)])
+    registry = factornado.Application(
+        {'log': {'stdout': False}, 'service_table': {'collection': 'registry'}},
+        [("/([^/]*?)/(.*)", StreamingProxy)])
+    registry.mongo = Kwargs(registry=collection)
+    upstream_url = serve(upstream)
+    url = serve(registry)
+    register(collection, 'up', upstream_url)
+    size = 5 * 2 ** 20 + 3
+
+    r = requests.get(url + '/up/data', params={'size': size}, stream=True)
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == 'application/octet-stream'
+    assert sum(len(chunk) for chunk in r.iter_content(2 ** 16)) == size
+
+    body = b'y' * size
+    expected = {'size': size, 'md5': hashlib.md5(body).hexdigest()}
+    r = requests.post(url + '/up/data', data=body)
+    assert r.json() == expected
+    # A chunked upload.
+    r = requests.post(url + '/up/data',
+                      data=(body[i:i + 2 ** 16] for i in range(0, size, 2 ** 16)))
+    assert r.json() == expected
+
+    assert requests.delete(url + '/up/data').status_code == 404
+    assert requests.get(url + '/unknown/data').status_code == 500
+    collection.delete_many({})
+
+
+class CountingStreamingProxy(StreamingProxy):
+    received = 0
+
+    def on_chunk(self, chunk):
+        CountingStreamingProxy.received += len(chunk)
+        return super(CountingStreamingProxy, self).on_chunk(chunk)
+
+
+def test_streaming_proxy_backpressure(collection, serve):
+    upstream = factornado.Application({'log': {'stdout': False}}, [('/data', Data)])
+    registry = factornado.Application(
+        {'log': {'stdout': False}, 'service_table': {'collection': 'registry'}},
+        [("/([^/]*?)/(.*)", CountingStreamingProxy)])
+    registry.mongo = Kwargs(registry=collection)
+    upstream_url = serve(upstream)
+    url = serve(registry)
+    register(collection, 'up', upstream_url)
+    size = 2 ** 27
+    r = requests.get(url + '/up/data', params={'size': size}, stream=True)
+    chunks = r.iter_content(2 ** 16)
+    next(chunks)
+    time.sleep(0.5)
+    # The instance is not read faster than the client: only the sockets buffer data.
+    assert CountingStreamingProxy.received < size // 4
+    assert 2 ** 16 + sum(len(chunk) for chunk in chunks) == size
+    assert CountingStreamingProxy.received == size
+    collection.delete_many({})
+
+
+def test_streaming_client_internals(serve, monkeypatch):
+    # StreamingHTTPClient overrides private parts of tornado's simple_httpclient: this test
+    # fails if a tornado release changes them, instead of silently losing the backpressure.
+    assert simple_httpclient.SimpleAsyncHTTPClient._connection_class(None) is (
+        simple_httpclient._HTTPConnection)
+    assert callable(getattr(simple_httpclient._HTTPConnection, '_should_follow_redirect', None))
+    assert 'data_received' in vars(simple_httpclient._HTTPConnection)
+    url = serve(factornado.Application({'log': {'stdout': False}}, [('/data', Data)]))
+    size = 2 ** 20
+    pending, received, connections = [], [], []
+    data_received = _StreamingHTTPConnection.data_received
+
+    def recorded_data_received(self, chunk):
+        connections.append(self)
+        return data_received(self, chunk)
+    monkeypatch.setattr(_StreamingHTTPConnection, 'data_received', recorded_data_received)
+
+    def on_chunk(chunk):
+        # The connection does not read on while the previous future is pending.
+        assert all(future.done() for future in pending)
+        received.append(len(chunk))
+        future = asyncio.get_event_loop().create_future()
+        asyncio.get_event_loop().call_later(0.001, future.set_result, None)
+        pending.append(future)
+        return future
+
+    async def fetch():
+        client = StreamingHTTPClient(force_instance=True)
+        await client.fetch(url + '/data?size={}'.format(size), streaming_callback=on_chunk)
+        client.close()
+    asyncio.new_event_loop().run_until_complete(fetch())
+    assert sum(received) == size and len(received) > 1
+    assert len(connections) == len(received)
+
+
+def test_upstream_client(serve):
+    upstream = factornado.Application({'log': {'stdout': False}}, [('/slow', Slow)])
+    client = UpstreamClient(max_connections_per_host=2, connect_timeout=1, request_timeout=5)
+    url = serve(upstream)
+
+    async def fetch_all():
+        requests = [httpclient.HTTPRequest(url + '/slow') for i in range(6)]
+        responses = await asyncio.gather(*[client.fetch(r) for r in requests])
+        # Only streamed responses may exceed the default limit of 100 MiB.
+        assert client.get_client().max_body_size == 100 * 2 ** 20
+        assert client.get_client(streaming=True).max_body_size == 100 * 2 ** 30
+        return requests, responses
+    requests, responses = asyncio.new_event_loop().run_until_complete(fetch_all())
+    assert [r.body for r in responses] == [b'ok'] * 6
+    assert Slow.max_running == 2
+    assert requests[0].connect_timeout == 1 and requests[0].request_timeout == 5
+
+
+class RecordingRegister(Register):
+    bodies = []
+
+    async def post(self, name=None):
+        self.bodies.append(json.loads(self.request.body.decode('utf-8')))
+        await super(RecordingRegister, self).post(name=name)
+
+
+def test_heartbeat(collection, serve):
+    registry = factornado.Application(
+        {'log': {'stdout': False}, 'service_table': {'collection': 'registry'}},
+        [("/register/([^/]*?)", RecordingRegister)])
+    registry.mongo = Kwargs(registry=collection)
+    registry_url = serve(registry)
+    service = factornado.Application(
+        {'name': 'svc', 'log': {'stdout': False}, 'host_url': 'http://svc',
+         'registry': {'url': registry_url}},
+        [("/heartbeat", Heartbeat)])
+    url = serve(service)
+    for i in range(3):
+        assert requests.post(url + '/heartbeat').text == 'ok'
+    first, second, third = RecordingRegister.bodies
+    assert 'config' in first
+    assert second == third == {'url': 'http://svc', 'hash': first['hash']}
+    doc = collection.find_one({'_id': 'http://svc'})
+    assert doc['info']['config']['name'] == 'svc'
+
+    # The registry has lost the instance: it asks for the config.
+    collection.delete_many({})
+    assert requests.post(url + '/heartbeat').text == 'ok'
+    assert [set(body) for body in RecordingRegister.bodies[3:]] == [
+        {'url', 'hash'}, {'url', 'hash', 'config'}]
+    assert collection.find_one({'_id': 'http://svc'})['hash'] == first['hash']
+
+    # The config changes.
+    service.config['foo'] = 'bar'
+    assert requests.post(url + '/heartbeat').text == 'ok'
+    assert RecordingRegister.bodies[-1]['config']['foo'] == 'bar'
+    assert RecordingRegister.bodies[-1]['hash'] != first['hash']
+
+    # A new service token is neither sent nor a change of config.
+    service.config['token'] = 'secret'
+    assert requests.post(url + '/heartbeat').text == 'ok'
+    assert set(RecordingRegister.bodies[-1]) == {'url', 'hash'}
+    collection.delete_many({})
+    assert requests.post(url + '/heartbeat').text == 'ok'
+    assert 'token' not in RecordingRegister.bodies[-1]['config']
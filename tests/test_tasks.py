@@ -0,0 +1,488 @@
+import os
+import json
+import time
+import collections
+import threading
+from unittest import mock
+
+import yaml
+import pytest
+import requests
+from tornado import web
+
+import factornado
+import factornado.tasks
+from factornado.application import Kwargs
+from factornado.utils import has_changed, tansform_bson_id
+
+mongomock = pytest.importorskip('mongomock')
+
+config = yaml.safe_load(open(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'examples',
+    'tasks.yml')))
+config['log'] = {'stdout': False}
+
+app = factornado.Application(
+    config,
+    [
+        ("/action/([^/]*?)/([^/]*?)/([^/]*?)", factornado.tasks.Action),
+        ("/atomicAction/([^/]*?)/([^/]*?)/([^/]*?)", factornado.tasks.Action, {'atomic': True}),
+        ("/actions", factornado.tasks.Actions),
+        ("/force/([^/]*?)/([^/]*?)/([^/]*?)", factornado.tasks.Force),
+        ("/assignOne/([^/]*?)", factornado.tasks.AssignOne),
+        ("/assignMany/([^/]*?)", factornado.tasks.AssignMany),
+        ("/getByKey/([^/]*?)/([^/]*?)", factornado.tasks.GetByKey),
+        ("/getByStatus/([^/]*?)/([^/]*?)", factornado.tasks.GetByStatus),
+        ("/stats", factornado.tasks.Stats),
+        ("/stats/([^/]*?)", factornado.tasks.Stats),
+        ("/cachedStats", factornado.tasks.Stats, {'ttl': 60}),
+        ("/cachedStats/([^/]*?)", factornado.tasks.Stats, {'ttl': 60}),
+    ])
+
+
+@pytest.fixture
+def tasks():
+    app.mongo = Kwargs(tasks=mongomock.MongoClient().db.tasks)
+    yield app.mongo.tasks
+
+
+def test_assign_one_priority(tasks):
+    app.put('/force/task01/key01/todo', body=b'')
+    app.put('/force/task01/key02/todo?priority=1', body=b'')
+
+    doc = json.loads(app.put('/assignOne/task01', body=b''))
+    assert doc['key'] == 'key02'
+    assert doc['status'] == 'todo'
+    assert tasks.find_one({'_id': 'task01/key02'})['status'] == 'doing'
+    assert tasks.find_one({'_id': 'task01/key02'})['id'] != doc['id']
+
+    doc = json.loads(app.put('/assignOne/task01', body=b''))
+    assert doc['key'] == 'key01'
+
+    assert app.put('/assignOne/task01', body=b'') == b''
+
+
+def test_assign_one_task(tasks):
+    app.put('/force/task01/key01/todo', body=b'')
+    assert app.put('/assignOne/task02', body=b'') == b''
+    assert factornado.tasks.assign_one(tasks, 'task01')['key'] == 'key01'
+    assert factornado.tasks.assign_one(tasks, 'task01') is None
+
+
+def test_assign_many(tasks):
+    for i in range(5):
+        app.put('/force/task01/key0{}/todo?priority={}'.format(i, i % 2), body=b'')
+
+    docs = json.loads(app.put('/assignMany/task01?n=3', body=b''))
+    assert [doc['key'] for doc in docs] == ['key01', 'key03', 'key00']
+    assert all(doc['status'] == 'todo' for doc in docs)
+    assert tasks.count_documents({'status': 'doing'}) == 3
+
+    docs = json.loads(app.put('/assignMany/task01?n=3', body=b''))
+    assert [doc['key'] for doc in docs] == ['key02', 'key04']
+
+    assert app.put('/assignMany/task01?n=3', body=b'') == b''
+
+
+def test_actions(tasks):
+    app.put('/force/task01/key01/doing', body=b'')
+    app.put('/force/task01/key02/doing', body=b'')
+
+    out = json.loads(app.put('/actions', body=json.dumps([
+        {'task': 'task01', 'key': 'key01', 'action': 'success', 'data': {'a': 1}},
+        ['task01', 'key02', 'error', {'b': 2}],
+        ['task01', 'key03', 'success'],
+        ])))
+    assert [x['ok'] for x in out] == [True, True, False]
+    assert out[0]['after']['status'] == 'done'
+    assert out[1]['after']['try'] == 1
+    assert tasks.find_one({'_id': 'task01/key01'})['data'] == {'a': 1}
+    assert tasks.find_one({'_id': 'task01/key02'})['status'] == 'fail'
+    assert tasks.find_one({'_id': 'task01/key03'}) is None
+
+
+def test_actions_same_key(tasks):
+    out = json.loads(app.put('/actions', body=json.dumps([
+        ['task01', 'key01', 'stack', {'a': 1}],
+        ['task01', 'key01', 'assign', {}],
+        ['task01', 'key01', 'stack', {'b': 2}],
+        ])))
+    assert [x['after']['status'] for x in out] == ['todo', 'doing', 'toredo']
+    doc = tasks.find_one({'_id': 'task01/key01'})
+    assert doc['status'] == 'toredo'
+    assert doc['data'] == {'a': 1, 'b': 2}
+    assert str(doc['id']) == out[-1]['after']['id']
+
+
+def test_actions_conflict(tasks):
+    app.put('/force/task01/key01/todo', body=b'')
+    bulk_write = tasks.bulk_write
+
+    def concurrent_bulk_write(*args, **kwargs):
+        # Someone assigns the task in the meantime.
+        factornado.tasks.assign_one(tasks, 'task01')
+        return bulk_write(*args, **kwargs)
+    tasks.bulk_write = concurrent_bulk_write
+
+    out = json.loads(app.put('/actions', body=json.dumps([
+        ['task01', 'key01', 'stack', {'a': 1}],
+        ['task01', 'key02', 'stack', {}],
+        ])))
+    assert out[0]['ok'] and out[0]['before']['status'] == 'doing'
+    assert tasks.find_one({'_id': 'task01/key01'})['status'] == 'toredo'
+    assert tasks.find_one({'_id': 'task01/key01'})['data'] == {'a': 1}
+    assert tasks.find_one({'_id': 'task01/key02'})['status'] == 'todo'
+
+
+def test_actions_after_delete(tasks):
+    app.put('/force/task01/key01/doing', body=json.dumps({'x': 1}).encode('utf-8'))
+    out = json.loads(app.put('/actions', body=json.dumps([
+        ['task01', 'key01', 'error', {}],
+        ['task01', 'key01', 'delete', {}],
+        ['task01', 'key01', 'stack', {'a': 1}],
+        ])))
+    assert [x['after']['status'] for x in out] == ['fail', 'none', 'todo']
+    assert out[2]['before']['status'] == 'none'
+    doc = tasks.find_one({'_id': 'task01/key01'})
+    assert (doc['status'], doc['data'], doc['try']) == ('todo', {'a': 1}, 0)
+
+
+def test_actions_conflict_after_write(tasks):
+    app.put('/force/task01/key01/doing', body=b'')
+    app.put('/force/task01/key02/todo', body=b'')
+    bulk_write = tasks.bulk_write
+
+    def concurrent_bulk_write(*args, **kwargs):
+        # Someone assigns key02 before our write, and forces key01 back to doing after it.
+        factornado.tasks.assign_one(tasks, 'task01')
+        try:
+            return bulk_write(*args, **kwargs)
+        finally:
+            factornado.tasks.force_status(tasks, 'task01', 'key01', 'doing')
+    tasks.bulk_write = concurrent_bulk_write
+
+    out = json.loads(app.put('/actions', body=json.dumps([
+        ['task01', 'key01', 'error', {}],
+        ['task01', 'key02', 'stack', {'a': 1}],
+        ])))
+    assert out[0]['after']['try'] == 1 and out[1]['after']['status'] == 'toredo'
+    # Our write of key01 succeeded: it is not performed again.
+    doc = tasks.find_one({'_id': 'task01/key01'})
+    assert (doc['status'], doc['try']) == ('doing', 1)
+
+
+def test_action_atomic(tasks):
+    legacy = mongomock.MongoClient().db.tasks
+    actions = config['actions']
+    scenario = [
+        ('stack', {'a': 1}, None),
+        ('stack', {'a': 1}, None),
+        ('stack', {'b': {'c': 2}}, 3),
+        ('assign', {}, None),
+        ('stack', {'b': {'d': 3}}, None),
+        ('error', {'e': [1, 2]}, None),
+        ('stack', {}, None),
+        ('assign', {}, None),
+        ('success', {}, None),
+        ('delete', {}, None),
+        ('delete', {}, None),
+        ]
+    for action, data, priority in scenario:
+        expected = factornado.tasks.perform_action(
+            legacy, actions, 'task01', 'key01', action, data=data, priority=priority)
+        out = factornado.tasks.perform_action_atomic(
+            tasks, actions, 'task01', 'key01', action, data=data, priority=priority)
+        assert out['changed'] == expected['changed']
+        for state in ['before', 'after']:
+            for field in ['status', 'data', 'try', 'priority']:
+                assert out[state].get(field) == expected[state].get(field)
+        doc = tasks.find_one({'_id': 'task01/key01'})
+        if out['after']['status'] == 'none':
+            assert doc is None
+        else:
+            doc = tansform_bson_id(doc)
+            assert doc['id'] == out['after']['id']
+            assert doc['statusSince'] == out['after']['statusSince']
+            assert not has_changed(doc, out['after'])
+
+
+def test_action_atomic_conflict(tasks):
+    app.put('/force/task01/key01/doing', body=b'')
+    with pytest.raises(web.HTTPError) as e:
+        factornado.tasks.perform_action_atomic(
+            tasks, config['actions'], 'task01', 'key01', 'release')
+    assert e.value.status_code == 411
+
+    app.put('/force/task01/key02/todo', body=b'')
+    find_one_and_update = tasks.find_one_and_update
+
+    def concurrent_find_one_and_update(*args, **kwargs):
+        # Someone assigns the task in the meantime.
+        tasks.find_one_and_update = find_one_and_update
+        factornado.tasks.assign_one(tasks, 'task01')
+        return find_one_and_update(*args, **kwargs)
+    tasks.find_one_and_update = concurrent_find_one_and_update
+    with pytest.raises(web.HTTPError) as e:
+        factornado.tasks.perform_action_atomic(
+            tasks, config['actions'], 'task01', 'key02', 'assign')
+    assert e.value.status_code == 411
+    assert tasks.find_one({'_id': 'task01/key02'})['status'] == 'doing'
+
+    out = json.loads(app.put('/atomicAction/task01/key01/success', body=b'{"a": 1}'))
+    assert out['after']['status'] == 'done'
+    assert tasks.find_one({'_id': 'task01/key01'})['data'] == {'a': 1}
+
+
+def test_ensure_indexes(tasks):
+    assert app.get_indexes() == {'tasks': factornado.tasks.INDEXES}
+    app.ensure_indexes()
+    keys = [list(doc['key']) for doc in tasks.index_information().values()]
+    assert [('task', 1), ('status', 1), ('priority', -1), ('ldt', 1)] in keys
+    assert [('task', 1), ('key', 1)] in keys
+
+
+def test_ensure_indexes_keeps_client_open(tasks):
+    closed = []
+    tasks.database.client.close = lambda: closed.append(True)
+    find_one = tasks.find_one
+
+    def checked_find_one(*args, **kwargs):
+        assert not closed, 'Cannot use MongoClient after close'
+        return find_one(*args, **kwargs)
+    tasks.find_one = checked_find_one
+
+    app.ensure_indexes()
+    app.put('/force/task01/key01/todo', body=b'')
+    assert json.loads(app.get('/getByKey/task01/key01'))['status'] == 'todo'
+
+
+def test_mongo_executor(tasks):
+    app.put('/force/task01/key01/todo', body=b'')
+    find_one = tasks.find_one
+    threads = []
+
+    def recorded_find_one(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return find_one(*args, **kwargs)
+    tasks.find_one = recorded_find_one
+
+    doc = json.loads(app.get('/getByKey/task01/key01'))
+    assert doc['status'] == 'todo'
+    assert threads[0].startswith('factornado-mongo')
+
+
+class ToDo(factornado.Todo):
+    def todo_list(self, data):
+        task_list = [('key{:02d}'.format(data['nb'] + i), {'i': i}) for i in range(3)]
+        data['nb'] += 3
+        return task_list, data
+
+
+class Do(factornado.Do):
+    async def do_something(self, task_key, task_data):
+        if task_data['i'] == 2:
+            raise ValueError('Failed')
+        return task_key
+
+
+class DoBatch(Do):
+    batch_size = 10
+
+
+@pytest.fixture
+def server(tasks, serve):
+    # The service calls itself: this works only if service calls do not block the IOLoop.
+    def do_app(port):
+        app_ = factornado.Application(
+            dict(config,
+                 port=port,
+                 tasks={'todo': 'todo-task', 'do': 'do-task'},
+                 services_prefix='http://127.0.0.1:{}'.format(port),
+                 services_client={'async': True, 'max_connections': 4, 'request_timeout': 10},
+                 services={'tasks': {
+                     'action': {'put': '/action/{task}/{key}/{action}'},
+                     'actions': {'put': '/actions'},
+                     'assignOne': {'put': '/assignOne/{task}'},
+                     'assignMany': {'put': '/assignMany/{task}?n={n}'},
+                     }}),
+            app.handler_list + [
+                ("/todo", ToDo),
+                ("/do", Do),
+                ("/doBatch", DoBatch),
+            ])
+        app_.mongo = app.mongo
+        return app_
+    return serve(do_app)
+
+
+def test_todo_do(server, tasks):
+    r = requests.post(server + '/todo')
+    r.raise_for_status()
+    assert r.json() == {'nb': 3, 'nbLoops': 1}
+    assert tasks.count_documents({'task': 'do-task', 'status': 'todo'}) == 3
+
+    results = [requests.post(server + '/do').json() for i in range(4)]
+    assert [x['ok'] for x in results] == [True, True, False, False]
+    assert tasks.count_documents({'task': 'do-task', 'status': 'done'}) == 2
+    assert tasks.count_documents({'task': 'do-task', 'status': 'fail'}) == 1
+
+
+def test_todo_do_batch(server, tasks):
+    requests.post(server + '/todo').raise_for_status()
+    requests.post(server + '/todo').raise_for_status()
+
+    r = requests.post(server + '/doBatch')
+    r.raise_for_status()
+    out = r.json()
+    assert out['nb'] == 4
+    assert len(out['tasks']) == 6
+    assert tasks.count_documents({'task': 'do-task', 'status': 'done'}) == 4
+    assert tasks.count_documents({'task': 'do-task', 'status': 'fail'}) == 2
+
+    r = requests.post(server + '/doBatch')
+    assert r.status_code == 201
+
+
+def test_actions_bad_body(server, tasks):
+    for body in [{}, [5], [['task01', 'key01']], [['task01', 'key01', 1]],
+                 [{'task': 'task01', 'key': 2, 'action': 'stack'}],
+                 [['task01', 'key01', 'stack', [1]]]]:
+        r = requests.put(server + '/actions', data=json.dumps(body))
+        assert r.status_code == 409, body
+    assert tasks.count_documents({}) == 0
+
+
+def test_assign_many_bounds(server, tasks, monkeypatch):
+    monkeypatch.setattr(factornado.tasks.AssignMany, 'max_n', 2)
+    for i in range(3):
+        app.put('/force/task01/key{:02d}/todo'.format(i), body=b'')
+    for n in ['0', '-1', 'x']:
+        assert requests.put(server + '/assignMany/task01', params={'n': n}).status_code == 409
+    r = requests.put(server + '/assignMany/task01', params={'n': 100})
+    assert len(r.json()) == 2
+
+
+def test_get_by_status(server, tasks):
+    for i in range(5):
+        requests.put(server + '/force/task01/key0{}/todo'.format(i), json={'a': i})
+    requests.put(server + '/force/task01/key09/done', json={})
+
+    r = requests.get(server + '/getByStatus/task01/todo%2Cdone%2Cfail')
+    r.raise_for_status()
+    doc = r.json()
+    assert sorted(x['key'] for x in doc['todo']) == ['key00', 'key01', 'key02', 'key03', 'key04']
+    assert [x['key'] for x in doc['done']] == ['key09']
+    assert doc['fail'] == []
+
+    # Pages are read one status at a time: the last `_id` is the next resume token.
+    pages, after = [], ''
+    while True:
+        r = requests.get(server + '/getByStatus/task01/todo',
+                         params={'limit': 2, 'after': after, 'exclude': 'data,_id'})
+        r.raise_for_status()
+        page = r.json()['todo']
+        if not len(page):
+            break
+        assert 'data' not in page[0]
+        pages.append([x['key'] for x in page])
+        after = page[-1]['_id']
+    assert pages == [['key00', 'key01'], ['key02', 'key03'], ['key04']]
+    r = requests.get(server + '/getByStatus/task01/todo%2Cdone', params={'after': 'a'})
+    assert r.status_code == 409
+
+
+def test_get_by_status_disconnect(server, tasks, monkeypatch):
+    monkeypatch.setattr(factornado.tasks.GetByStatus, 'batch_size', 1)
+    tasks.insert_many([{'_id': 'task01/key{:04d}'.format(i), 'task': 'task01',
+                        'status': 'todo', 'data': {'x': 'x' * 1000}} for i in range(2000)])
+
+    class RecordingCursor(object):
+        def __init__(self, cursor):
+            self.cursor = cursor
+            self.read = 0
+            self.closed = False
+
+        def __iter__(self):
+            for doc in self.cursor:
+                self.read += 1
+                yield doc
+
+        def close(self):
+            self.closed = True
+            self.cursor.close()
+
+    cursors = []
+    find = tasks.find
+
+    def recording_find(*args, **kwargs):
+        cursors.append(RecordingCursor(find(*args, **kwargs)))
+        return cursors[-1]
+    monkeypatch.setattr(tasks, 'find', recording_find)
+
+    r = requests.get(server + '/getByStatus/task01/todo', stream=True)
+    next(r.iter_content(10))
+    r.close()
+    for i in range(100):
+        if len(cursors) and cursors[0].closed:
+            break
+        time.sleep(0.05)
+    assert cursors[0].closed and 0 < cursors[0].read < 2000
+
+
+def test_get_by_status_ndjson(server, tasks, monkeypatch):
+    # The response is flushed every 2 tasks.
+    monkeypatch.setattr(factornado.tasks.GetByStatus, 'batch_size', 2)
+    for i in range(5):
+        requests.put(server + '/force/task01/key0{}/todo'.format(i), json={'a': i})
+
+    r = requests.get(server + '/getByStatus/task01/todo',
+                     params={'format': 'ndjson', 'fields': 'key', 'limit': 3}, stream=True)
+    r.raise_for_status()
+    assert r.headers['Content-Type'] == 'application/x-ndjson'
+    lines = [json.loads(line) for line in r.iter_lines()]
+    assert lines == [{'_id': 'task01/key0{}'.format(i), 'key': 'key0{}'.format(i)}
+                     for i in range(3)]
+
+
+def test_stats(tasks):
+    app.put('/force/task01/key01/todo', body=b'')
+    app.put('/force/task01/key02/todo', body=b'')
+    app.put('/force/task01/key03/done', body=b'')
+    app.put('/force/task02/key01/fail', body=b'')
+    oldest = tasks.find_one({'_id': 'task01/key01'})['statusSince']
+
+    stats = json.loads(app.get('/stats'))
+    assert stats['task01']['todo'] == {'count': 2, 'oldestStatusSince': oldest}
+    assert stats['task01']['done']['count'] == 1
+    assert stats['task02'] == {'fail': {'count': 1, 'oldestStatusSince': mock.ANY}}
+
+    stats = json.loads(app.get('/stats/task02'))
+    assert list(stats) == ['task02']
+
+
+def test_stats_cache(tasks):
+    app.put('/force/task01/key01/todo', body=b'')
+    assert json.loads(app.get('/cachedStats'))['task01']['todo']['count'] == 1
+    app.put('/force/task01/key02/todo', body=b'')
+    assert json.loads(app.get('/cachedStats'))['task01']['todo']['count'] == 1
+    assert json.loads(app.get('/stats'))['task01']['todo']['count'] == 2
+
+
+def test_stats_cache_size(tasks, monkeypatch):
+    monkeypatch.setattr(factornado.tasks.Stats, 'cache', collections.OrderedDict())
+    monkeypatch.setattr(factornado.tasks.Stats, 'cache_size', 2)
+    for task in ['task01', 'task02', 'task01', 'task03']:
+        app.get('/cachedStats/' + task)
+    cache = factornado.tasks.Stats.cache
+    assert [task for collection, task in cache] == ['task01', 'task03']
+
+
+def test_has_changed():
+    before = {'id': 'key01', 'status': 'todo', 'data': {'a': 1, 'b': [0, 1.5], 'c': float('nan')}}
+    assert not has_changed(before, dict(before, data=dict(before['data'])))
+    assert not has_changed(before, json.loads(json.dumps(before)))
+    assert has_changed(before, dict(before, data=dict(before['data'], a=True)))
+    assert has_changed(before, dict(before, data=dict(before['data'], a=1.0)))
+    assert has_changed(before, dict(before, data=dict(before['data'], b=[False, 1.5])))
+    assert has_changed(before, dict(before, status='doing'))
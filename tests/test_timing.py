@@ -0,0 +1,78 @@
+import time
+import logging
+
+import pytest
+import requests
+from tornado import web
+
+import factornado
+from factornado.application import Kwargs
+from factornado.timing import Spans, span, current_spans
+
+mongomock = pytest.importorskip('mongomock')
+
+
+class Hello(web.RequestHandler):
+    def get(self):
+        self.write('Hello')
+
+
+class Instrumented(web.RequestHandler):
+    async def get(self):
+        await self.application.mongo_executor.run(self.application.mongo.docs.find_one, {})
+        await self.application.mongo_executor.run(self.application.mongo.docs.find_one, {})
+        self.application.services.hello.hello.get()
+        self.write('ok')
+
+
+def test_spans():
+    with span('foo'):
+        pass  # No request is instrumented: nothing happens.
+    spans = Spans()
+    token = current_spans.set(spans)
+    for i in range(2):
+        with span('foo'):
+            time.sleep(0.01)
+    with span('bar'):
+        pass
+    current_spans.reset(token)
+    assert spans.to_dict()['foo']['count'] == 2
+    assert spans.to_dict()['foo']['ms'] >= 20
+    header = spans.server_timing(total=0.5)
+    assert header.startswith('bar;dur=0.')
+    assert header.endswith(';desc="2 calls", total;dur=500.000')
+
+
+def test_server_timing(caplog, serve):
+    upstream = factornado.Application({'log': {'stdout': False}}, [('/hello', Hello)])
+    upstream_url = serve(upstream)
+    app = factornado.Application(
+        {
+            'log': {'stdout': False},
+            'timing': {'slow_request': 0},
+            'services': {'hello': {'hello': {'get': upstream_url + '/hello'}}},
+            'services_client': {'async': False},
+        },
+        [('/instrumented', Instrumented), ('/hello', Hello)])
+    app.mongo = Kwargs(docs=mongomock.MongoClient().db.docs)
+    url = serve(app)
+    with caplog.at_level(logging.WARNING, logger='factornado'):
+        r = requests.get(url + '/instrumented')
+        assert r.text == 'ok'
+        metrics = [metric.split(';')[0] for metric in r.headers['Server-Timing'].split(', ')]
+        assert metrics == ['http', 'mongo', 'total']
+        assert 'mongo;dur=' in r.headers['Server-Timing']
+        assert '2 calls' in r.headers['Server-Timing']
+
+        r = requests.get(url + '/hello')
+        assert r.headers['Server-Timing'].startswith('total;dur=')
+
+    record, = [record for record in caplog.records if '/instrumented' in record.getMessage()]
+    assert record.getMessage().startswith('Slow request: GET /instrumented')
+    assert set(record.spans) == {'mongo', 'http'} and record.spans['mongo']['count'] == 2
+
+
+def test_no_timing(serve):
+    app = factornado.Application({'log': {'stdout': False}}, [('/hello', Hello)])
+    url = serve(app)
+    assert 'Server-Timing' not in requests.get(url + '/hello').headers